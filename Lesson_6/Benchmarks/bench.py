@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the OpenStreetMap exercises
+
+Runs count_tags, key_type (tags.process_map), users.process_map, audit,
+data.process_map and the single pass run_analyzers over one OSM file and
+measures elements per second and peak resident memory of each. Every
+benchmark runs in a process of its own so the peak memory of one does not
+hide the next.
+
+The results are appended to a JSON file together with the file, its size
+and the python version, and each run is compared with the previous run on
+the same file so a slowdown shows up before it reaches production:
+
+    python bench.py --nodes 200000
+    python bench.py --file Alaska.xml --label "compiled normalizer"
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+LESSON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for lesson in ("IterativeParsing", "TagTypes", "ExploringUsers",
+               "ImprovingStreetNames", "PreparingForDatabaseV2"):
+    sys.path.append(os.path.join(LESSON_DIR, lesson))
+import osmgen
+
+RESULTS_FILE = "bench_results.json"
+
+# A drop in elements per second larger than this is reported as a regression
+REGRESSION = 0.10
+
+
+def bench_count_tags(filename):
+    import mapparser
+    mapparser.count_tags(filename)
+
+def bench_key_type(filename):
+    import tags
+    tags.process_map(filename)
+
+def bench_users(filename):
+    import users
+    users.process_map(filename)
+
+def bench_audit(filename):
+    import audit
+    audit.audit(filename)
+
+def bench_process_map(filename):
+    import data
+    data.process_map(filename, keep_data=False)
+    os.remove("{0}.2.json".format(filename))
+
+def bench_single_pass(filename):
+    import singlepass
+    singlepass.run_analyzers(filename)
+    os.remove("{0}.2.json".format(filename))
+
+BENCHMARKS = [("count_tags", bench_count_tags),
+              ("key_type", bench_key_type),
+              ("users", bench_users),
+              ("audit", bench_audit),
+              ("process_map", bench_process_map),
+              ("single_pass", bench_single_pass)]
+
+
+def measure(func, filename, queue):
+    '''Child process: run the benchmark, send back (seconds, peak rss in MB)'''
+    # The exercises print as they go, keep the output readable
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull
+    start = time.time()
+    func(filename)
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on linux and bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak /= 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    queue.put((seconds, peak))
+
+
+def run_one(func, filename):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=measure, args=(func, filename, queue))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError("benchmark failed with exit code {0}".format(p.exitcode))
+    return queue.get()
+
+
+def count_elements(filename):
+    '''Number of nodes, ways and relations in the file'''
+    import mapparser
+    counts = mapparser.count_tags(filename)
+    return sum(counts.get(k, 0) for k in ("node", "way", "relation"))
+
+
+def run_benchmarks(filename, names=None, elements=None, label=None):
+    '''Run the benchmarks on the file and return the run record'''
+    if elements is None:
+        elements = count_elements(filename)
+    run = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "label": label,
+           "file": os.path.abspath(filename),
+           "bytes": os.path.getsize(filename),
+           "elements": elements,
+           "python": platform.python_version(),
+           "results": {}}
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        seconds, peak = run_one(func, filename)
+        run["results"][name] = {"seconds": round(seconds, 3),
+                                "elements_per_sec": round(elements / seconds, 1) if seconds else None,
+                                "peak_rss_mb": round(peak, 1)}
+    return run
+
+
+def load_runs(results_file=RESULTS_FILE):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return json.load(f)
+
+
+def save_run(run, results_file=RESULTS_FILE):
+    runs = load_runs(results_file)
+    runs.append(run)
+    with open(results_file, "w") as f:
+        json.dump(runs, f, indent=2, sort_keys=True)
+
+
+def previous_run(runs, run):
+    '''The latest saved run on a file of the same size, None if there is none'''
+    for old in reversed(runs):
+        if old["bytes"] == run["bytes"] and old["elements"] == run["elements"]:
+            return old
+    return None
+
+
+def report(run, previous=None):
+    '''Print the results next to the previous run, returns the regressions'''
+    regressions = []
+    print "{0} elements, {1:.1f} MB".format(run["elements"], run["bytes"] / 1048576.0)
+    print "{0:<14}{1:>10}{2:>14}{3:>12}{4:>10}".format(
+        "benchmark", "seconds", "elements/s", "peak MB", "change")
+    for name, func in BENCHMARKS:
+        result = run["results"].get(name)
+        if result is None:
+            continue
+        change = ""
+        old = previous["results"].get(name) if previous else None
+        if old and old["elements_per_sec"] and result["elements_per_sec"]:
+            ratio = result["elements_per_sec"] / old["elements_per_sec"] - 1
+            change = "{0:+.1%}".format(ratio)
+            if ratio < -REGRESSION:
+                change += " !"
+                regressions.append(name)
+        print "{0:<14}{1:>10.3f}{2:>14.0f}{3:>12.1f}{4:>10}".format(
+            name, result["seconds"], result["elements_per_sec"] or 0,
+            result["peak_rss_mb"], change)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the OSM exercises")
+    parser.add_argument("--file", help="OSM file to use, generated when not given")
+    parser.add_argument("--nodes", type=int, default=100000,
+                        help="nodes in the generated file (default 100000)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", help="comma separated benchmarks to run")
+    parser.add_argument("--label", help="note saved with the run")
+    parser.add_argument("--results", default=RESULTS_FILE,
+                        help="JSON file the runs are saved in")
+    args = parser.parse_args(argv)
+
+    elements = None
+    filename = args.file
+    if filename is None:
+        filename = "synthetic_{0}.osm".format(args.nodes)
+        if not os.path.exists(filename):
+            counts = osmgen.generate(filename, args.nodes, seed=args.seed)
+            elements = counts["node"] + counts["way"] + counts["relation"]
+
+    names = args.only.split(",") if args.only else None
+    run = run_benchmarks(filename, names, elements, args.label)
+    regressions = report(run, previous_run(load_runs(args.results), run))
+    save_run(run, args.results)
+    if regressions:
+        print "Slower than the previous run:", ", ".join(regressions)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic OpenStreetMap files for the benchmarks
+
+generate writes an OSM XML file of any size that looks like the Alaska
+extract: nodes around Anchorage, ways over those nodes, a few relations,
+a long tail of users and the tags we audit. The addresses come with the
+same problems we clean in shape_element:
+
+    - abbreviated street types, "Main St", "Old Seward Hwy", "Ashwood"
+    - zip codes with junk, "AK 99501-2129", "Homer, AK 99603"
+    - states other than "AK", "Alaska", "ak"
+    - misspelled cities, "Anchoage"
+    - tag keys with problem characters and second colons
+
+The file is written element by element, the generator never holds more
+than one element in memory, and the same seed always gives the same file.
+"""
+import random
+import time
+from xml.sax.saxutils import quoteattr
+
+# Anchorage and around, minlat, minlon, maxlat, maxlon
+BOUNDS = (61.0, -150.1, 61.4, -149.4)
+
+START_TIME = 1199145600   # 2008-01-01
+END_TIME = 1420070400     # 2015-01-01
+
+STREET_NAMES = ["Main", "Northern Lights", "Benson", "Spenard", "Tudor", "Dimond",
+                "Minnesota", "Lake Otis", "Muldoon", "Boniface", "Jewel Lake",
+                "Old Seward", "Huffman", "Abbott", "Raspberry", "Dowling", "Arctic",
+                "Fireweed", "Debarr", "Glenn", "Klatt", "O'Malley", "Rabbit Creek",
+                "Elmore", "Baxter", "Bragaw", "Lois", "Juneau", "Denali", "Eagle"]
+
+# Street types and how often they come up, the abbreviations are the
+# keys of map_old_to_new
+STREET_TYPES = [("Street", 20), ("Avenue", 15), ("Road", 12), ("Drive", 10),
+                ("Lane", 6), ("Circle", 5), ("Court", 4), ("Boulevard", 3),
+                ("Highway", 3), ("Loop", 3), ("Place", 3), ("Trail", 2),
+                ("Parkway", 1), ("St", 4), ("St.", 2), ("Ave", 3), ("Ave.", 1),
+                ("Rd", 3), ("Rd.", 1), ("Dr", 2), ("Dr.", 1), ("Ln", 1),
+                ("LN", 1), ("Cir", 1), ("Blvd", 1), ("Hwy", 1), ("Pl", 1),
+                ("Lp", 1), ("Tr", 1), ("Crt", 1), ("Sq", 1)]
+
+# A few names with no street type at all
+BARE_STREETS = ["Ashwood", "Klatt", "Muldoon"]
+
+ZIPCODES = [("99501", 10), ("99502", 8), ("99503", 8), ("99504", 8), ("99507", 6),
+            ("99508", 6), ("99515", 5), ("99516", 4), ("99517", 4),
+            ("AK 99501-2129", 1), ("AK 99501-2118", 1), ("Homer, AK 99603", 1),
+            ("99501-1234", 1), ("AK", 1), ("Alaska", 1)]
+
+CITIES = [("Anchorage", 40), ("Eagle River", 4), ("Girdwood", 2), ("Chugiak", 2),
+          ("Anchoage", 1), ("anchorage", 1), ("Anchorge", 1)]
+
+STATES = [("AK", 30), ("Alaska", 2), ("ak", 1), ("AK ", 1)]
+
+AMENITIES = ["restaurant", "cafe", "fast_food", "school", "place_of_worship",
+             "parking", "fuel", "bank", "pharmacy", "post_office", "bar", "library"]
+
+HIGHWAYS = [("residential", 40), ("service", 20), ("footway", 10), ("tertiary", 8),
+            ("secondary", 5), ("primary", 3), ("track", 5), ("path", 5), ("unclassified", 4)]
+
+# Plain tags for nodes and ways, lower and lower_colon keys
+OTHER_TAGS = [("source", "Bing"), ("tiger:county", "Anchorage, AK"),
+              ("tiger:cfcc", "A41"), ("name:en", "Anchorage"), ("surface", "asphalt"),
+              ("lanes", "2"), ("oneway", "yes"), ("created_by", "JOSM"),
+              ("building:levels", "2"), ("is_in:state", "AK")]
+
+# Keys we expect key_type and is_valid_tag to reject or flag
+ODD_KEYS = [("addr:street:name", "Main"), ("addr:street:type", "Street"),
+            ("name_1", "Old Name"), ("FIXME", "check"), ("note 1", "bad key"),
+            ("phone.number", "907-555-0100"), ("gnis:feature_id", "1234")]
+
+
+def weighted(pairs):
+    '''Expand (value, weight) pairs into a list to pick from'''
+    out = []
+    for value, weight in pairs:
+        out.extend([value] * weight)
+    return out
+
+STREET_TYPE_CHOICES = weighted(STREET_TYPES)
+ZIPCODE_CHOICES = weighted(ZIPCODES)
+CITY_CHOICES = weighted(CITIES)
+STATE_CHOICES = weighted(STATES)
+HIGHWAY_CHOICES = weighted(HIGHWAYS)
+
+
+def attrs(pairs):
+    return " ".join("{0}={1}".format(k, quoteattr(v)) for k, v in pairs)
+
+
+def tag_lines(tags):
+    return "".join('    <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v)) for k, v in tags)
+
+
+class Generator(object):
+    '''Everything random comes from self.rnd, seeded once'''
+    def __init__(self, seed=1, users=2000):
+        self.rnd = random.Random(seed)
+        self.users = ["user{0}".format(i) for i in range(users)]
+        self.changeset = 10000000
+        # The open changeset of each user, a changeset has one user
+        self.open_changesets = {}
+
+    def user(self):
+        # A few mappers make most of the edits
+        i = min(int(self.rnd.paretovariate(1.2)) - 1, len(self.users) - 1)
+        return str(i + 1), self.users[i]
+
+    def meta(self, element_id):
+        uid, user = self.user()
+        changeset = self.open_changesets.get(uid)
+        if changeset is None or self.rnd.random() < 0.3:
+            self.changeset += 1
+            changeset = self.open_changesets[uid] = self.changeset
+        timestamp = self.rnd.randint(START_TIME, END_TIME)
+        return [("id", str(element_id)), ("visible", "true"),
+                ("version", str(self.rnd.randint(1, 6))),
+                ("changeset", str(changeset)),
+                ("timestamp", format_time(timestamp)),
+                ("user", user), ("uid", uid)]
+
+    def street(self):
+        rnd = self.rnd
+        if rnd.random() < 0.02:
+            return rnd.choice(BARE_STREETS)
+        name = rnd.choice(STREET_NAMES)
+        if rnd.random() < 0.2:
+            name = rnd.choice(["East", "West", "North", "South"]) + " " + name
+        return name + " " + rnd.choice(STREET_TYPE_CHOICES)
+
+    def address(self):
+        rnd = self.rnd
+        tags = [("addr:housenumber", str(rnd.randint(1, 20000))),
+                ("addr:street", self.street())]
+        if rnd.random() < 0.7:
+            tags.append(("addr:postcode", rnd.choice(ZIPCODE_CHOICES)))
+        if rnd.random() < 0.6:
+            tags.append(("addr:city", rnd.choice(CITY_CHOICES)))
+        if rnd.random() < 0.4:
+            tags.append(("addr:state", rnd.choice(STATE_CHOICES)))
+        return tags
+
+    def node_tags(self):
+        rnd = self.rnd
+        r = rnd.random()
+        # Most nodes are bare way vertices
+        if r < 0.80:
+            return []
+        tags = []
+        if r < 0.90:
+            tags.append(("amenity", rnd.choice(AMENITIES)))
+            tags.append(("name", rnd.choice(STREET_NAMES) + " " + rnd.choice(["Cafe", "Market", "Center", "Church"])))
+            if rnd.random() < 0.5:
+                tags.extend(self.address())
+        elif r < 0.96:
+            tags.extend(self.address())
+        else:
+            tags.append(rnd.choice(OTHER_TAGS))
+        if rnd.random() < 0.05:
+            tags.append(rnd.choice(ODD_KEYS))
+        return tags
+
+    def way_tags(self):
+        rnd = self.rnd
+        tags = []
+        if rnd.random() < 0.6:
+            tags.append(("highway", rnd.choice(HIGHWAY_CHOICES)))
+            tags.append(("name", self.street()))
+        else:
+            tags.append(("building", "yes"))
+            if rnd.random() < 0.3:
+                tags.extend(self.address())
+        tags.extend(rnd.sample(OTHER_TAGS, rnd.randint(0, 3)))
+        if rnd.random() < 0.05:
+            tags.append(rnd.choice(ODD_KEYS))
+        return tags
+
+
+def format_time(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def generate(filename, nodes=100000, ways=None, relations=None, seed=1, users=2000):
+    '''
+    Write a synthetic OSM file with nodes nodes, ways defaults to one way
+    for every 8 nodes and relations to one for every 20 ways.
+    Returns the count of each element written.
+    '''
+    if ways is None:
+        ways = nodes // 8
+    if relations is None:
+        relations = max(ways // 20, 1)
+    gen = Generator(seed, users)
+    rnd = gen.rnd
+    minlat, minlon, maxlat, maxlon = BOUNDS
+    counts = {"node": 0, "way": 0, "relation": 0, "tag": 0, "nd": 0, "member": 0}
+
+    with open(filename, "wb") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osm version="0.6" generator="osmgen">\n')
+        f.write(' <bounds minlat="{0}" minlon="{1}" maxlat="{2}" maxlon="{3}"/>\n'.format(*BOUNDS))
+
+        for i in range(1, nodes + 1):
+            pairs = gen.meta(i)
+            pairs.append(("lat", "{0:.7f}".format(rnd.uniform(minlat, maxlat))))
+            pairs.append(("lon", "{0:.7f}".format(rnd.uniform(minlon, maxlon))))
+            tags = gen.node_tags()
+            if tags:
+                f.write(" <node {0}>\n{1} </node>\n".format(attrs(pairs), tag_lines(tags)))
+            else:
+                f.write(" <node {0}/>\n".format(attrs(pairs)))
+            counts["node"] += 1
+            counts["tag"] += len(tags)
+
+        way_base = 100000000
+        for i in range(1, ways + 1):
+            start = rnd.randint(1, max(nodes - 20, 1))
+            refs = range(start, min(start + rnd.randint(2, 20), nodes + 1))
+            if rnd.random() < 0.2:
+                refs.append(refs[0])   # closed way
+            tags = gen.way_tags()
+            nds = "".join('    <nd ref="{0}"/>\n'.format(r) for r in refs)
+            f.write(" <way {0}>\n{1}{2} </way>\n".format(attrs(gen.meta(way_base + i)), nds, tag_lines(tags)))
+            counts["way"] += 1
+            counts["nd"] += len(refs)
+            counts["tag"] += len(tags)
+
+        for i in range(1, relations + 1):
+            members = []
+            for j in range(rnd.randint(1, 6)):
+                if rnd.random() < 0.7 and ways:
+                    members.append(("way", str(way_base + rnd.randint(1, ways)), rnd.choice(["outer", "inner", ""])))
+                else:
+                    members.append(("node", str(rnd.randint(1, nodes)), rnd.choice(["stop", ""])))
+            kind = rnd.choice(["multipolygon", "route", "boundary"])
+            tags = [("type", kind), ("name", rnd.choice(STREET_NAMES) + " " + kind)]
+            lines = "".join('    <member type="{0}" ref="{1}" role={2}/>\n'.format(t, r, quoteattr(role))
+                            for t, r, role in members)
+            f.write(" <relation {0}>\n{1}{2} </relation>\n".format(attrs(gen.meta(i)), lines, tag_lines(tags)))
+            counts["relation"] += 1
+            counts["member"] += len(members)
+            counts["tag"] += len(tags)
+
+        f.write("</osm>\n")
+    return counts
+
+
+def test():
+    counts = generate("synthetic.osm", 10000)
+    print counts
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
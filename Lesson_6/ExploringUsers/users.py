@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
 import pprint
+import os
+import sys
+# The shared streaming reader lives with the iterative parsing lesson
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements
+from distinct import distinct_counter
+from userstats import UserStats
 
 """
 Your task is to explore the data a bit more.
@@ -9,6 +16,10 @@ The first task is a fun one - find out how many unique users
 have contributed to the map in this particular area!
 
 The function process_map should return a set of unique user IDs ("uid")
+With an error rate like 0.01 it returns an estimate of their number instead,
+counted in a fixed amount of memory, see distinct.py
+
+user_stats goes further and counts what each user did, see userstats.py
 """
 
 #Get the user id from the element
@@ -16,36 +27,38 @@ def get_user(element):
     uid = element.attrib["uid"]
     return uid
 
+# Read file and collect the counts of each user in one pass
+# Each node/way/relation is released once its user has been counted
+def user_stats(filename, max_rss_mb=None):
+    stats = UserStats()
+    for _, element in iter_elements(filename, max_rss_mb=max_rss_mb):
+        stats.add(element)
+
+    return stats
+
 # Read file and count the users
-def process_map(filename):
-    
+def process_map(filename, max_rss_mb=None, error=None):
+
+    if error is not None:
+        #Estimate the number of users without keeping every uid
+        uids = distinct_counter(error)
+        for _, element in iter_elements(filename, max_rss_mb=max_rss_mb):
+            if "uid" in element.attrib:
+                uids.add(get_user(element))
+        return uids.count()
+
+    stats = user_stats(filename, max_rss_mb)
+
     #Create a users collection to hold the all of the users
     #the collection will only contain unique users ("uid")    
-    users = set() 
-
-    #Create error collection to capture those elements with no uuid
-    errors = set()
-    users_in_node_way_elements = set()
-
-    #iterate over the file and each element   
-    for _, element in ET.iterparse(filename):
-        key = element.tag
-        
-        #For each tag iterate over the records and attempt to reteive the uuid
-        for tag in element.iter(key):
-            #attempt to get the uuid, 
-            #error out the elements which do not have uuid
-            try:
-                uid = get_user(element)
-                users.add(uid)
-                # Check code added to review the data in mongodb
-                if key == "node" or key == "way":
-                    users_in_node_way_elements.add(uid)   
-            except:
-                errors.add(key)
+    users = set(str(uid) for uid in stats.uids)
+
+    # Check code added to review the data in mongodb
+    users_in_node_way_elements = set(str(stats.uids[i]) for i in xrange(len(stats))
+                                     if stats.nodes[i] or stats.ways[i])
     
     #print out the elements with no uuid              
-    #pprint.pprint("Has no uuid :", str(errors)
+    #pprint.pprint("Has no uuid :", stats.anonymous)
     pprint.pprint(len(users_in_node_way_elements))
     pprint.pprint(users_in_node_way_elements)
     
@@ -56,6 +69,7 @@ def test():
 
     users = process_map('Alaska.xml')
     pprint.pprint(len(users))
+    pprint.pprint(user_stats('Alaska.xml').top(10))
     #pprint.pprint(len(users))
     #pprint.pprint(users)
     #assert len(users) == 6
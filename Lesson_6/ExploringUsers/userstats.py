@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+What each user contributed, counted while the file is parsed
+
+The top contributor reports used to come out of MongoDB aggregations over
+the loaded collection. UserStats collects them in the same pass that reads
+the file, one row per user (integer uid) in parallel arrays:
+
+    nodes, ways, relations   the elements last edited by the user
+    changesets               distinct changesets of those edits
+    first, last              the oldest and the newest edit, seconds since
+                             1970 UTC
+
+    stats = UserStats()
+    for _, element in iter_elements("Alaska.xml"):
+        stats.add(element)
+    stats.top(10)
+    [{"uid": 1219059, "user": "linuxUser16", "edits": 8210, ...}, ...]
+
+A changeset only ever belongs to one user, so one table of the changeset
+ids seen, to the row of their user, is enough to count the distinct
+changesets of every user and to merge the counts of two parts of a file.
+There are millions of changesets in a large extract, ChangesetTable keeps
+them in two arrays with open addressing, 16 bytes a slot, instead of a
+dictionary of Python ints.
+"""
+from array import array
+import os
+import sys
+import time
+# The timestamp parser is shared with the other lessons
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from timestamps import timestamp_seconds
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Empty ChangesetTable slot, the smallest value of an array("l")
+EMPTY = -(2 ** (8 * array("l").itemsize - 1))
+
+def format_timestamp(seconds):
+    return time.strftime(TIME_FORMAT, time.gmtime(seconds))
+
+
+class ChangesetTable(object):
+    '''changeset id => row of its user, open addressing in two arrays'''
+    def __init__(self, size=1024):
+        self.keys = array("l", [EMPTY]) * size
+        self.values = array("l", [0]) * size
+        self.mask = size - 1
+        self.count = 0
+
+    def slot(self, changeset):
+        '''Index of changeset in keys, or of the empty slot it would go in'''
+        keys, mask = self.keys, self.mask
+        # Changeset ids are close to sequential, spread them over the table
+        i = (changeset * 0x9E3779B1) & mask
+        while keys[i] != changeset and keys[i] != EMPTY:
+            i = (i + 1) & mask
+        return i
+
+    def add(self, changeset, row):
+        '''Remember the row of changeset, False when it was already there'''
+        i = self.slot(changeset)
+        if self.keys[i] == changeset:
+            return False
+        self.keys[i] = changeset
+        self.values[i] = row
+        self.count += 1
+        # Keep the table at most half full
+        if self.count * 2 > len(self.keys):
+            self.grow()
+        return True
+
+    def get(self, changeset, default=None):
+        i = self.slot(changeset)
+        return self.values[i] if self.keys[i] == changeset else default
+
+    def grow(self):
+        items = list(self.iteritems())
+        size = len(self.keys) * 2
+        self.keys = array("l", [EMPTY]) * size
+        self.values = array("l", [0]) * size
+        self.mask = size - 1
+        for changeset, row in items:
+            i = self.slot(changeset)
+            self.keys[i] = changeset
+            self.values[i] = row
+
+    def iteritems(self):
+        for i, changeset in enumerate(self.keys):
+            if changeset != EMPTY:
+                yield changeset, self.values[i]
+
+    def __contains__(self, changeset):
+        return self.keys[self.slot(changeset)] == changeset
+
+    def __len__(self):
+        return self.count
+
+
+class UserStats(object):
+    '''Per user counts, see the module docstring'''
+    def __init__(self):
+        # uid => row
+        self.rows = {}
+        self.uids = array("l")
+        self.names = []
+        self.nodes = array("l")
+        self.ways = array("l")
+        self.relations = array("l")
+        self.changesets = array("l")
+        # No timestamp yet is -1
+        self.first = array("l")
+        self.last = array("l")
+        # changeset id => row of its user
+        self.changeset_rows = ChangesetTable()
+        # Elements without a (numeric) uid
+        self.anonymous = 0
+        self.counters = {"node": self.nodes, "way": self.ways, "relation": self.relations}
+
+    def row(self, uid, name=None):
+        i = self.rows.get(uid)
+        if i is None:
+            i = self.rows[uid] = len(self.uids)
+            self.uids.append(uid)
+            self.names.append(name)
+            for column in (self.nodes, self.ways, self.relations, self.changesets):
+                column.append(0)
+            self.first.append(-1)
+            self.last.append(-1)
+        return i
+
+    def add(self, element):
+        '''Count a node, way or relation element, anything else is skipped'''
+        counter = self.counters.get(element.tag)
+        if counter is None:
+            return
+        attrib = element.attrib
+        try:
+            uid = int(attrib["uid"])
+        except (KeyError, ValueError):
+            self.anonymous += 1
+            return
+        i = self.row(uid, attrib.get("user"))
+        counter[i] += 1
+
+        try:
+            changeset = int(attrib["changeset"])
+        except (KeyError, ValueError):
+            changeset = None
+        if changeset is not None and self.changeset_rows.add(changeset, i):
+            self.changesets[i] += 1
+
+        seconds = timestamp_seconds(attrib.get("timestamp"))
+        if seconds is not None:
+            if self.first[i] < 0 or seconds < self.first[i]:
+                self.first[i] = seconds
+            if seconds > self.last[i]:
+                self.last[i] = seconds
+
+    def merge(self, other):
+        '''Add the counts of other, collected from another part of the file'''
+        for j, uid in enumerate(other.uids):
+            i = self.row(uid, other.names[j])
+            self.nodes[i] += other.nodes[j]
+            self.ways[i] += other.ways[j]
+            self.relations[i] += other.relations[j]
+            if other.first[j] >= 0 and (self.first[i] < 0 or other.first[j] < self.first[i]):
+                self.first[i] = other.first[j]
+            if other.last[j] > self.last[i]:
+                self.last[i] = other.last[j]
+        # A changeset both parts saw is counted once
+        for changeset, j in other.changeset_rows.iteritems():
+            i = self.rows[other.uids[j]]
+            if self.changeset_rows.add(changeset, i):
+                self.changesets[i] += 1
+        self.anonymous += other.anonymous
+        return self
+
+    def __len__(self):
+        return len(self.uids)
+
+    def user_ids(self):
+        return set(self.uids)
+
+    def report(self, i):
+        '''The counts of row i as a dictionary'''
+        nodes, ways, relations = self.nodes[i], self.ways[i], self.relations[i]
+        return {"uid": self.uids[i],
+                "user": self.names[i],
+                "nodes": nodes,
+                "ways": ways,
+                "relations": relations,
+                "edits": nodes + ways + relations,
+                "changesets": self.changesets[i],
+                "first": format_timestamp(self.first[i]) if self.first[i] >= 0 else None,
+                "last": format_timestamp(self.last[i]) if self.last[i] >= 0 else None}
+
+    def get(self, uid):
+        i = self.rows.get(uid)
+        return self.report(i) if i is not None else None
+
+    def top(self, n=10, by="edits"):
+        '''The n users with the most edits, nodes, ways, relations or changesets'''
+        if by == "edits":
+            column = [self.nodes[i] + self.ways[i] + self.relations[i] for i in xrange(len(self.uids))]
+        else:
+            column = getattr(self, by)
+        order = sorted(xrange(len(self.uids)), key=column.__getitem__, reverse=True)
+        return [self.report(i) for i in order[:n]]
+
+
+def test():
+    from xml.etree.ElementTree import Element
+    stats = UserStats()
+    for tag, uid, changeset, ts in [("node", "1", "10", "2013-08-03T16:43:42Z"),
+                                    ("node", "1", "10", "2013-08-04T10:00:00Z"),
+                                    ("way", "1", "11", "2012-01-01T00:00:00Z"),
+                                    ("node", "2", "12", "2014-01-01T00:00:00Z")]:
+        stats.add(Element(tag, uid=uid, user="user" + uid, changeset=changeset, timestamp=ts))
+    print stats.top(2)
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -9,10 +9,16 @@ Your task in this exercise has two steps:
     The function takes a string with street name as an argument and should return the fixed name
     We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+import os
+import sys
+# The shared streaming reader lives with the iterative parsing lesson
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements
+from streetnames import normalizer_for
 
 OSMFILE = "Alaska.xml"
 
@@ -75,17 +81,19 @@ map_old_to_new = {
             "Ashwood": "Ashwood Street"
             }
             
-def audit(osmfile):
+def audit(osmfile, max_rss_mb=None):
     '''
     Audit the addresses in the file and return a list of street_types
     A street_type being Road, Drive, Lane, Highway etc...
-    '''
-    osm_file = open(osmfile, "r")
 
+    The "end" event is used so the <tag> children are parsed when we look
+    at them, the node/way is released right after it has been audited
+    '''
     #Create collection to hold the streets we find
     street_types = defaultdict(set)
     
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    #iter_elements opens the file, compressed or not
+    for event, elem in iter_elements(osmfile, events=("end",), max_rss_mb=max_rss_mb):
         #We are expecting the nodes and way to contain an address
         #check only these for address attributes
         if elem.tag == "node" or elem.tag == "way":
@@ -123,14 +131,10 @@ def update_name(name, map_old_to_new):
     '''
     Update name compares current name to the map of bad values to good values
     and provides the updated name back to the method    
+
+    Only the last word of the name is looked up, see streetnames.py
     '''
-    for iName in map_old_to_new.keys():
-        #Check to see if we find a match for a bad value in our map        
-        match = re.search(iName, name)
-        #if match is found then remap the old value with new value        
-        if match:
-            name = re.sub(iName+'$', map_old_to_new[iName], name)
-    return name
+    return normalizer_for(map_old_to_new).normalize(name)
 
 def test():
     st_types = audit(OSMFILE)
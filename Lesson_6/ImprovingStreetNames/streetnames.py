@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Street name normalizer
+
+update_name used to loop over every key of map_old_to_new for each street,
+running an uncompiled re.search and re.sub per key. That is a lot of regex
+work per address tag, and since the keys were used as patterns they also
+matched in the middle of a word ("KingSt" became "KingStreet").
+
+StreetNormalizer only looks at the last word of the name and replaces it
+with one dictionary lookup. The same few thousand street names come up
+over and over again in an extract, so the fixed names are kept in a small
+LRU cache, hits and misses are counted so we can see how well it works.
+The address rules and the city matcher of PreparingForDatabaseV2 keep
+their answers per distinct value for the same reason.
+"""
+from collections import OrderedDict
+import re
+
+# The last word of the street name, the street type (St, Ave., Rd ...)
+last_word_re = re.compile(r'\S+$')
+
+# Number of fixed street names to remember
+CACHE_SIZE = 10000
+
+
+class StreetNormalizer(object):
+    '''
+    Replace the abbreviated street type at the end of a name with the
+    full one from the mapping, "West Lexington St." => "West Lexington Street"
+    '''
+    def __init__(self, mapping, cache_size=CACHE_SIZE):
+        self.mapping = mapping
+        # Copy the mapping, the lookup must not change under the cache
+        self.suffixes = dict(mapping)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def normalize(self, name):
+        '''Return the name with its street type fixed'''
+        cache = self.cache
+        if name in cache:
+            self.hits += 1
+            # Move the name to the end, it is now the most recently used
+            fixed = cache.pop(name)
+            cache[name] = fixed
+            return fixed
+
+        self.misses += 1
+        fixed = name
+        m = last_word_re.search(name)
+        if m:
+            new = self.suffixes.get(m.group())
+            if new is not None:
+                fixed = name[:m.start()] + new
+
+        cache[name] = fixed
+        if len(cache) > self.cache_size:
+            # Drop the least recently used name
+            cache.popitem(last=False)
+        return fixed
+
+    __call__ = normalize
+
+    def stats(self):
+        '''Cache statistics, hits, misses, current size and maximum size'''
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.cache),
+                "maxsize": self.cache_size}
+
+    def clear(self):
+        '''Empty the cache and reset the statistics'''
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        '''Copy the mapping again after it was edited in place, the cache is emptied'''
+        self.suffixes = dict(self.mapping)
+        self.cache.clear()
+
+
+# One normalizer per mapping, so callers can keep passing the mapping
+# around like update_name(name, map_old_to_new) always did
+normalizers = {}
+
+
+def normalizer_for(mapping):
+    '''
+    Return the shared normalizer for this mapping, creating it on first use
+    The normalizer works on a copy of the mapping, after editing the
+    mapping in place call refresh() on it to see the changes
+    '''
+    normalizer = normalizers.get(id(mapping))
+    if normalizer is None or normalizer.mapping is not mapping:
+        normalizer = StreetNormalizer(mapping)
+        normalizers[id(mapping)] = normalizer
+    return normalizer
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Count distinct values exactly or in a fixed amount of memory
+
+Counting the distinct uids, tag keys, values of each key or street names
+with a set() keeps every value, on a continent sized extract that is more
+memory than the machine has. A HyperLogLog sketch estimates the count
+from 2**p one byte registers, whatever the number of values:
+
+    error    registers    memory
+    0.05     512          512 B
+    0.01     16384        16 KB
+    0.005    65536        64 KB
+
+error is the standard error of the estimate, 1.04 / sqrt(registers). Until
+it has seen a few hundred values a sketch keeps their hashes and counts
+them exactly, so the thousands of tag keys with only a couple of values
+each stay small.
+
+Sketches with the same error can be merged, the sketch of a file is the
+merge of the sketches of its parts, so the chunks of a parallel run can
+be counted on their own. ExactCount does the same with a set, to compare
+the estimate against:
+
+    counter = distinct_counter(error=0.01)     # error=None is exact
+    for uid in uids:
+        counter.add(uid)
+    len(counter)
+
+The values are hashed with hash(), which is the same in every Python 2
+process unless hash randomization (-R, PYTHONHASHSEED) is switched on.
+"""
+import math
+
+DEFAULT_ERROR = 0.01
+
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+MASK64 = (1 << 64) - 1
+
+# 2 ** -rank for every rank a register can hold
+INVERSE_POWERS = [2.0 ** -r for r in range(65)]
+
+
+def hash64(value):
+    '''64 bit hash of value, hash() mixed so that small ints spread out too'''
+    x = hash(value) & MASK64
+    # splitmix64 finalizer, hash() of an int is the int itself
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+
+def precision_for(error):
+    '''Number of index bits p for a standard error of error'''
+    if not 0 < error < 1:
+        raise ValueError("error must be between 0 and 1, not {0!r}".format(error))
+    p = int(math.ceil(math.log((1.04 / error) ** 2, 2)))
+    return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+
+def alpha(m):
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog(object):
+    '''Distinct count estimate in 2**p bytes, see the module docstring'''
+    def __init__(self, error=DEFAULT_ERROR):
+        self.p = precision_for(error)
+        self.m = 1 << self.p
+        self.error = 1.04 / math.sqrt(self.m)
+        # Hashes seen, counted exactly until there are too many of them
+        self.small = set()
+        self.max_small = self.m // 32
+        self.registers = None
+
+    def add(self, value):
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h):
+        if self.registers is None:
+            self.small.add(h)
+            if len(self.small) > self.max_small:
+                self.to_registers()
+            return
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def to_registers(self):
+        self.registers = bytearray(self.m)
+        small, self.small = self.small, None
+        for h in small:
+            self.add_hash(h)
+
+    def merge(self, other):
+        '''Add the values counted by other, a sketch with the same error'''
+        if other.p != self.p:
+            raise ValueError("can not merge a sketch of {0} registers into one of {1}".format(
+                other.m, self.m))
+        if other.registers is None:
+            for h in other.small:
+                self.add_hash(h)
+            return self
+        if self.registers is None:
+            self.to_registers()
+        registers = self.registers
+        for i, r in enumerate(other.registers):
+            if r > registers[i]:
+                registers[i] = r
+        return self
+
+    def count(self):
+        if self.registers is None:
+            return len(self.small)
+        m = self.m
+        estimate = alpha(m) * m * m / sum(INVERSE_POWERS[r] for r in self.registers)
+        if estimate <= 2.5 * m:
+            # Small range correction, linear counting on the empty registers
+            zeros = self.registers.count("\0")
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+
+class ExactCount(object):
+    '''Same interface as HyperLogLog, with a set'''
+    error = 0.0
+
+    def __init__(self):
+        self.values = set()
+
+    def add(self, value):
+        self.values.add(value)
+
+    def merge(self, other):
+        self.values |= other.values
+        return self
+
+    def count(self):
+        return len(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+
+def distinct_counter(error=None):
+    '''ExactCount when error is None, a HyperLogLog of that error otherwise'''
+    if error is None:
+        return ExactCount()
+    return HyperLogLog(error)
+
+
+class KeyedCounts(object):
+    '''A distinct counter per key, the number of distinct values of each tag key'''
+    def __init__(self, error=None):
+        self.error = error
+        self.counters = {}
+
+    def add(self, key, value):
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = distinct_counter(self.error)
+        counter.add(value)
+
+    def merge(self, other):
+        for key, counter in other.counters.iteritems():
+            mine = self.counters.get(key)
+            if mine is None:
+                # A counter of our own, other must not change when we do
+                mine = self.counters[key] = distinct_counter(self.error)
+            mine.merge(counter)
+        return self
+
+    def counts(self):
+        '''{key: distinct values}'''
+        return dict((key, counter.count()) for key, counter in self.counters.iteritems())
+
+
+def test():
+    exact = distinct_counter()
+    sketch = distinct_counter(0.01)
+    for i in xrange(200000):
+        exact.add("user{0}".format(i % 150000))
+        sketch.add("user{0}".format(i % 150000))
+    print len(exact), len(sketch), "error {0:.2%}".format(sketch.error)
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -14,10 +14,10 @@ and number of times this tag can be encountered in the map as value.
 
 Note that your code will be tested with a different data file than the 'example.osm'
 """
-import xml.etree.ElementTree as ET
 import pprint
+from osmstream import iter_elements
 
-def count_tags(filename):
+def count_tags(filename, max_rss_mb=None):
         # YOUR CODE HERE
         # Key, Value {Key = element tag name, value is the # of occurances of tag
         # default_data['item3'] = 0, else 
@@ -34,6 +34,9 @@ def count_tags(filename):
         
         http://effbot.org/elementtree/iterparse.htm
         http://effbot.org/zone/element-iterparse.htm
+
+        iter_elements releases each node/way/relation once it has been
+        counted, max_rss_mb is the optional memory ceiling in megabytes
         '''
         #Find only the start tags in the element in the XML doc     
         events = ("start",)
@@ -42,7 +45,7 @@ def count_tags(filename):
         tags={}
         
         #Search the start tags in each element in the XML file
-        for event, elem in ET.iterparse(filename, events=events):
+        for event, elem in iter_elements(filename, events=events, max_rss_mb=max_rss_mb):
             # assign the tag found to key            
             key = elem.tag            
             #If we have already hve this key, increment the count by 1            
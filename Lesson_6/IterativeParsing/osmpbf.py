@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Read .osm.pbf files
+
+The PBF format is several times smaller than the XML and much faster to
+decode. iter_pbf_events reads a PBF file and produces the same ("start",
+element) and ("end", element) events ET.iterparse gives for the XML file,
+with the same tags and attributes, so shape_element, count_tags, key_type
+and the audits work on it unchanged.
+
+Everything is decoded here without the protobuf library:
+
+    file           repeated (4 byte length, BlobHeader, Blob)
+    Blob           raw or zlib compressed HeaderBlock / PrimitiveBlock
+    PrimitiveBlock string table + groups of nodes, dense nodes, ways
+                   and relations, ids and coordinates delta coded
+
+The blocks do not depend on each other, they are decoded on a process pool
+and handed back in file order.
+
+http://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import collections
+import multiprocessing
+import struct
+import time
+import zlib
+
+# Features of the file we know how to read
+SUPPORTED_FEATURES = set(["OsmSchema-V0.6", "DenseNodes", "HistoricalInformation"])
+
+MEMBER_TYPES = ("node", "way", "relation")
+
+# Largest blob header and blob the format allows
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BLOB_BYTES = 32 * 1024 * 1024
+
+
+'''
+Protocol buffer decoding
+
+Only the wire types used by the OSM messages are needed, varints (0),
+64 bit (1), length delimited (2) and 32 bit (5).
+'''
+
+def read_varint(buf, pos):
+    '''Decode the varint at pos, returns the value and the next position'''
+    result = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(buf):
+    '''Yield (field number, value) of each field of the message'''
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {0}".format(wire))
+        yield key >> 3, value
+
+
+def unpack_varints(buf):
+    '''Decode a packed repeated varint field'''
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = ord(buf[pos])
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def repeated(value):
+    '''Values of a repeated varint field, packed or not'''
+    if isinstance(value, str):
+        return unpack_varints(value)
+    return [value]
+
+
+def signed(n):
+    '''int32/int64 fields, negative numbers are sent as 64 bit two's complement'''
+    if n >= 1 << 63:
+        return n - (1 << 64)
+    return n
+
+
+def zigzag(n):
+    '''sint32/sint64 fields'''
+    return (n >> 1) ^ -(n & 1)
+
+
+def delta_decode(values):
+    '''Undo the delta coding of a packed sint64 field'''
+    out = []
+    total = 0
+    for v in values:
+        total += (v >> 1) ^ -(v & 1)
+        out.append(total)
+    return out
+
+
+def text(s):
+    '''
+    Strings the way ElementTree returns them in Python 2, plain str for
+    ascii and unicode for the rest
+    '''
+    try:
+        s.decode("ascii")
+        return s
+    except UnicodeDecodeError:
+        return s.decode("utf-8")
+
+
+'''
+OSM formatting, the attribute values are written like the XML files
+'''
+
+def format_coord(nanodegrees):
+    '''Degrees with 7 decimals, the precision of the OSM database'''
+    units = int(round(nanodegrees / 100.0))
+    sign = "-" if units < 0 else ""
+    units = abs(units)
+    return "{0}{1}.{2:07d}".format(sign, units // 10000000, units % 10000000)
+
+
+def format_timestamp(milliseconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(milliseconds // 1000))
+
+
+'''
+Blocks
+'''
+
+def read_blob(data):
+    '''Return the uncompressed content of a Blob message'''
+    raw = None
+    raw_size = None
+    for field, value in iter_fields(data):
+        if field == 1:
+            raw = value
+        elif field == 2:
+            raw_size = value
+        elif field == 3:
+            raw = zlib.decompress(value)
+            if raw_size is not None and len(raw) != raw_size:
+                raise IOError("PBF blob is {0} bytes, expected {1}".format(len(raw), raw_size))
+        elif field in (4, 5, 6, 7):
+            raise IOError("PBF blob compression (field {0}) is not supported, "
+                          "only raw and zlib".format(field))
+    if raw is None:
+        raise IOError("PBF blob has no data")
+    return raw
+
+
+def decode_header(data):
+    '''Return the bounds attributes of the HeaderBlock, None without a bbox'''
+    bounds = None
+    for field, value in iter_fields(read_blob(data)):
+        if field == 1:
+            box = {}
+            for f, v in iter_fields(value):
+                box[f] = zigzag(v)
+            bounds = {"minlon": format_coord(box.get(1, 0)),
+                      "maxlon": format_coord(box.get(2, 0)),
+                      "maxlat": format_coord(box.get(3, 0)),
+                      "minlat": format_coord(box.get(4, 0))}
+        elif field == 4 and value not in SUPPORTED_FEATURES:
+            raise IOError("PBF file needs feature {0}, which is not supported".format(value))
+    return bounds
+
+
+class Block(object):
+    '''String table and the coordinate and date scales of a PrimitiveBlock'''
+    def __init__(self):
+        self.strings = []
+        self.granularity = 100
+        self.date_granularity = 1000
+        self.lat_offset = 0
+        self.lon_offset = 0
+
+    def info(self, buf, attrib):
+        '''Add the Info message fields to the attributes'''
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib["version"] = str(signed(value))
+            elif field == 2:
+                attrib["timestamp"] = format_timestamp(signed(value) * self.date_granularity)
+            elif field == 3:
+                attrib["changeset"] = str(signed(value))
+            elif field == 4:
+                attrib["uid"] = str(signed(value))
+            elif field == 5:
+                attrib["user"] = self.strings[value]
+            elif field == 6:
+                attrib["visible"] = "true" if value else "false"
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def lat(self, value):
+        return format_coord(self.lat_offset + self.granularity * value)
+
+    def lon(self, value):
+        return format_coord(self.lon_offset + self.granularity * value)
+
+
+'''
+Entities are (tag, attributes, tags, children), children being the nd
+refs of a way or the (type, ref, role) members of a relation, plain
+tuples so they can be sent back from the worker processes.
+'''
+
+def decode_node(block, buf):
+    attrib = {}
+    keys = vals = ()
+    lat = lon = 0
+    for field, value in iter_fields(buf):
+        if field == 1:
+            attrib["id"] = str(zigzag(value))
+        elif field == 2:
+            keys = repeated(value)
+        elif field == 3:
+            vals = repeated(value)
+        elif field == 4:
+            block.info(value, attrib)
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+    attrib["lat"] = block.lat(lat)
+    attrib["lon"] = block.lon(lon)
+    return ("node", attrib, block.tags(keys, vals), ())
+
+
+def decode_dense(block, buf, entities):
+    ids = lats = lons = ()
+    keys_vals = ()
+    info = {}
+    for field, value in iter_fields(buf):
+        if field == 1:
+            ids = delta_decode(repeated(value))
+        elif field == 5:
+            for f, v in iter_fields(value):
+                if f == 1:
+                    info[f] = [signed(n) for n in repeated(v)]
+                elif f == 6:
+                    info[f] = repeated(v)
+                else:
+                    info[f] = delta_decode(repeated(v))
+        elif field == 8:
+            lats = delta_decode(repeated(value))
+        elif field == 9:
+            lons = delta_decode(repeated(value))
+        elif field == 10:
+            keys_vals = repeated(value)
+
+    strings = block.strings
+    versions = info.get(1)
+    timestamps = info.get(2)
+    changesets = info.get(3)
+    uids = info.get(4)
+    users = info.get(5)
+    visibles = info.get(6)
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {"id": str(node_id)}
+        if versions:
+            attrib["version"] = str(versions[i])
+            attrib["timestamp"] = format_timestamp(timestamps[i] * block.date_granularity)
+            attrib["changeset"] = str(changesets[i])
+            attrib["uid"] = str(uids[i])
+            attrib["user"] = strings[users[i]]
+        if visibles:
+            attrib["visible"] = "true" if visibles[i] else "false"
+        attrib["lat"] = block.lat(lats[i])
+        attrib["lon"] = block.lon(lons[i])
+
+        # keys_vals holds k, v, k, v, ..., 0 for every node
+        tags = []
+        if keys_vals:
+            while keys_vals[kv] != 0:
+                tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+        entities.append(("node", attrib, tags, ()))
+
+
+def decode_way(block, buf):
+    attrib = {}
+    keys = vals = refs = ()
+    for field, value in iter_fields(buf):
+        if field == 1:
+            attrib["id"] = str(signed(value))
+        elif field == 2:
+            keys = repeated(value)
+        elif field == 3:
+            vals = repeated(value)
+        elif field == 4:
+            block.info(value, attrib)
+        elif field == 8:
+            refs = delta_decode(repeated(value))
+    return ("way", attrib, block.tags(keys, vals), [str(r) for r in refs])
+
+
+def decode_relation(block, buf):
+    attrib = {}
+    keys = vals = roles = memids = types = ()
+    for field, value in iter_fields(buf):
+        if field == 1:
+            attrib["id"] = str(signed(value))
+        elif field == 2:
+            keys = repeated(value)
+        elif field == 3:
+            vals = repeated(value)
+        elif field == 4:
+            block.info(value, attrib)
+        elif field == 8:
+            roles = [signed(r) for r in repeated(value)]
+        elif field == 9:
+            memids = delta_decode(repeated(value))
+        elif field == 10:
+            types = repeated(value)
+    strings = block.strings
+    members = [(MEMBER_TYPES[t], str(m), strings[r]) for t, m, r in zip(types, memids, roles)]
+    return ("relation", attrib, block.tags(keys, vals), members)
+
+
+def decode_block(data):
+    '''Worker: decode one OSMData blob into a list of entities'''
+    block = Block()
+    groups = []
+    for field, value in iter_fields(read_blob(data)):
+        if field == 1:
+            block.strings = [text(s) for f, s in iter_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block.granularity = value
+        elif field == 18:
+            block.date_granularity = value
+        elif field == 19:
+            block.lat_offset = signed(value)
+        elif field == 20:
+            block.lon_offset = signed(value)
+
+    entities = []
+    for group in groups:
+        for field, value in iter_fields(group):
+            if field == 1:
+                entities.append(decode_node(block, value))
+            elif field == 2:
+                decode_dense(block, value, entities)
+            elif field == 3:
+                entities.append(decode_way(block, value))
+            elif field == 4:
+                entities.append(decode_relation(block, value))
+    return entities
+
+
+'''
+File
+'''
+
+def is_pbf(filename):
+    '''True when the file starts with a PBF blob header'''
+    with open(filename, "rb") as f:
+        start = f.read(64)
+    return len(start) > 4 and "OSMHeader" in start[4:]
+
+
+def iter_blobs(f):
+    '''Yield (type, blob) for each blob of the open file'''
+    while True:
+        size = f.read(4)
+        if not size:
+            return
+        if len(size) < 4:
+            raise IOError("PBF file is truncated")
+        size = struct.unpack(">I", size)[0]
+        if size > MAX_HEADER_BYTES:
+            raise IOError("PBF blob header of {0} bytes, is this a PBF file?".format(size))
+        blob_type = None
+        data_size = 0
+        for field, value in iter_fields(f.read(size)):
+            if field == 1:
+                blob_type = value
+            elif field == 3:
+                data_size = value
+        if data_size > MAX_BLOB_BYTES:
+            raise IOError("PBF blob of {0} bytes is too large".format(data_size))
+        data = f.read(data_size)
+        if len(data) < data_size:
+            raise IOError("PBF file is truncated")
+        yield blob_type, data
+
+
+def iter_entities(filename, processes=None):
+    '''
+    Yield the bounds and every entity of the file in order, the data blocks
+    are decoded on processes workers (default one per core)
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    # A few blocks in flight per worker, memory does not grow with the file
+    window = max(processes, 1) * 2
+    pending = collections.deque()
+    try:
+        with open(filename, "rb") as f:
+            for blob_type, data in iter_blobs(f):
+                if blob_type == "OSMHeader":
+                    bounds = decode_header(data)
+                    if bounds:
+                        pending.append([("bounds", bounds, (), ())])
+                elif blob_type == "OSMData":
+                    if pool is None:
+                        pending.append(decode_block(data))
+                    else:
+                        pending.append(pool.apply_async(decode_block, (data,)))
+                # Unknown blob types are skipped, as the format asks
+                while len(pending) >= window or (pending and isinstance(pending[0], list)):
+                    for entity in wait(pending.popleft()):
+                        yield entity
+            while pending:
+                for entity in wait(pending.popleft()):
+                    yield entity
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def wait(result):
+    if isinstance(result, list):
+        return result
+    return result.get()
+
+
+def build_element(entity):
+    '''Build the ElementTree element of the entity, laid out like the XML'''
+    tag, attrib, tags, children = entity
+    elem = ET.Element(tag, attrib)
+    if tag == "way":
+        for ref in children:
+            ET.SubElement(elem, "nd", {"ref": ref})
+    elif tag == "relation":
+        for member_type, ref, role in children:
+            ET.SubElement(elem, "member", {"type": member_type, "ref": ref, "role": role})
+    for k, v in tags:
+        ET.SubElement(elem, "tag", {"k": k, "v": v})
+    return elem
+
+
+def iter_pbf_events(filename, processes=None):
+    '''
+    Yield ("start", element) and ("end", element) for the PBF file the way
+    ET.iterparse(filename, events=("start", "end")) does for the XML file
+    '''
+    root = ET.Element("osm", {"version": "0.6"})
+    yield "start", root
+    for entity in iter_entities(filename, processes):
+        elem = build_element(entity)
+        yield "start", elem
+        for child in elem:
+            yield "start", child
+            yield "end", child
+        yield "end", elem
+    yield "end", root
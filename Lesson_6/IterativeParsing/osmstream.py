@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared streaming reader for the OpenStreetMap exercises
+
+ET.iterparse only hands us the elements, it does not forget them. Every
+element parsed stays attached to the <osm> root, so on a full state extract
+the whole tree ends up in memory and the process runs out of RAM.
+
+iter_elements wraps iterparse and releases each top level element
+(bounds, node, way, relation, ...) as soon as the caller is done with it,
+so memory stays flat no matter how large the input file is.
+
+Compressed extracts (.osm.bz2, .osm.gz) are read as they are, there is no
+need to decompress them to disk first. bz2 files are decompressed block
+by block on all cores, see pbz2.py. .osm.pbf files are decoded into the
+same elements the XML gives, see osmpbf.py.
+
+http://effbot.org/zone/element-iterparse.htm
+"""
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import gzip
+import os
+import resource
+from pbz2 import ParallelBZ2Reader
+from osmpbf import is_pbf, iter_pbf_events
+
+'''
+MAX_RSS_MB
+
+Default resident memory ceiling in megabytes, None means no ceiling.
+Can be set from the environment with OSM_MAX_RSS_MB so the workers can
+be capped without touching the code.
+'''
+MAX_RSS_MB = os.environ.get("OSM_MAX_RSS_MB")
+if MAX_RSS_MB:
+    MAX_RSS_MB = float(MAX_RSS_MB)
+
+# Check the memory every CHECK_EVERY top level elements, reading the
+# process status on every element would cost more than the parse
+CHECK_EVERY = 10000
+
+
+# Number of processes decompressing bz2 input or decoding pbf blocks,
+# None is one per core
+DECOMPRESS_PROCESSES = None
+
+
+class MemoryCeilingExceeded(MemoryError):
+    '''Raised when the reader grows past the configured RSS ceiling'''
+    pass
+
+
+def current_rss_mb():
+    '''
+    Return the resident set size of this process in megabytes
+    Uses /proc when we have it, otherwise the peak RSS from getrusage
+    '''
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def osm_format(filename):
+    '''
+    Return "xml", "bz2", "gzip" or "pbf", found from the first bytes of the
+    file, not the file name
+    '''
+    with open(filename, "rb") as f:
+        magic = f.read(3)
+    if magic == "BZh":
+        return "bz2"
+    if magic[:2] == "\x1f\x8b":
+        return "gzip"
+    if is_pbf(filename):
+        return "pbf"
+    return "xml"
+
+
+def open_osm(filename, processes=None):
+    '''
+    Open the XML file for reading, bz2 and gzip files are decompressed on
+    the fly
+    '''
+    kind = osm_format(filename)
+    if kind == "bz2":
+        if processes is None:
+            processes = DECOMPRESS_PROCESSES
+        return ParallelBZ2Reader(filename, processes)
+    if kind == "gzip":
+        return gzip.GzipFile(filename, "rb")
+    if kind == "pbf":
+        raise ValueError("{0} is a PBF file, read it with iter_elements".format(filename))
+    return open(filename, "rb")
+
+
+def iter_elements(source, events=("end",), max_rss_mb=None, check_every=CHECK_EVERY):
+    '''
+    Iterate over the OSM file like ET.iterparse and yield (event, element)
+
+    source is a filename or an open file object, events are the iterparse
+    events the caller wants to see ("start" and/or "end"). A filename may
+    point to a bz2 or gzip compressed file, see open_osm, or a PBF file.
+
+    Once the "end" event of a top level element has been handed out the
+    element is cleared and dropped from the root, so the caller must be
+    done with it (and all of its <tag> and <nd> children) before asking
+    for the next one.
+
+    max_rss_mb sets the memory ceiling, MemoryCeilingExceeded is raised as
+    soon as the process grows past it instead of waiting on the OOM killer.
+    '''
+    if max_rss_mb is None:
+        max_rss_mb = MAX_RSS_MB
+
+    if isinstance(source, basestring):
+        if osm_format(source) == "pbf":
+            parsed = iter_pbf_events(source, DECOMPRESS_PROCESSES)
+        else:
+            f = open_osm(source)
+            try:
+                for event, elem in iter_elements(f, events, max_rss_mb, check_every):
+                    yield event, elem
+            finally:
+                f.close()
+            return
+    else:
+        parsed = ET.iterparse(source, events=("start", "end"))
+
+    want_start = "start" in events
+    want_end = "end" in events
+
+    root = None
+    depth = 0
+    count = 0
+
+    # We need both events to track the depth of the tree, even if the
+    # caller only asked for one of them
+    for event, elem in parsed:
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            if want_start:
+                yield event, elem
+            continue
+
+        depth -= 1
+        if want_end:
+            yield event, elem
+
+        # depth 1 is a direct child of <osm>, the element is finished
+        # release it and everything it holds
+        if depth == 1:
+            elem.clear()
+            root.clear()
+            count += 1
+            if max_rss_mb and count % check_every == 0:
+                check_memory(max_rss_mb, count, source)
+
+
+def check_memory(max_rss_mb, count, source=None):
+    '''Fail fast with a clear message when RSS is over the ceiling'''
+    rss = current_rss_mb()
+    if rss > max_rss_mb:
+        name = getattr(source, "name", source)
+        raise MemoryCeilingExceeded(
+            "RSS {0:.0f} MB exceeds the {1:.0f} MB ceiling after {2} elements of {3}".format(
+                rss, max_rss_mb, count, name))
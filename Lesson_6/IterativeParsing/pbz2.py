@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Block parallel bz2 decompression
+
+Geofabrik ships the extracts as .osm.bz2 and bz2 is slow to decompress,
+on one core the parser spends most of its time waiting for data.
+
+A bz2 file is a series of independent blocks of up to 900k of input, each
+one starting with the 48 bit magic number 0x314159265359 (pi) and the last
+one followed by the end of stream magic 0x177245385090 (sqrt pi). The
+blocks are not byte aligned, so we look for the magic numbers at every bit
+offset, cut the file into blocks and turn each block back into a bz2
+stream of its own:
+
+    "BZh9" + block bits + end of stream magic + stream CRC + padding
+
+A stream with one block has the block CRC as its stream CRC. The blocks
+are decompressed on a process pool and handed back in order. Multi stream
+files (pbzip2, lbzip2) work the same way, which the Python 2 bz2 module
+does not handle at all.
+
+The magic numbers can show up by chance inside the compressed data. A
+block cut by a false block magic fails its CRC check, it is then joined
+with the next one and decompressed again. An end of stream magic only
+counts when the stream CRC after it is followed by the end of the file or
+by the "BZh" header of the next stream, a false one is skipped.
+
+http://en.wikipedia.org/wiki/Bzip2#File_format
+"""
+import binascii
+import bz2
+import collections
+import multiprocessing
+import struct
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+
+# Header of the rebuilt streams, 9 is the largest block size so any
+# block fits whatever level the file was written with
+STREAM_HEADER = "BZh9"
+
+# Bytes read from the compressed file at a time
+READ_BYTES = 4 * 1024 * 1024
+
+# Bytes kept unsearched at the end of the buffer until more is read, the
+# 8 byte window of a magic number, the stream CRC and the next header
+LOOKAHEAD_BYTES = 16
+
+# Times a failed block is joined with the next one before giving up
+MAX_JOINS = 3
+
+
+def magic_patterns(magic):
+    '''
+    For each of the 8 bit shifts return (shift, first byte, pattern), the
+    bytes of the window that are fully covered by the magic number. The
+    window starts on the byte holding the first bit of the magic.
+    '''
+    patterns = []
+    for shift in range(8):
+        window = struct.pack(">Q", magic << (16 - shift))
+        first = 1 if shift else 0
+        patterns.append((shift, first, window[first:6]))
+    return patterns
+
+BLOCK_PATTERNS = magic_patterns(BLOCK_MAGIC)
+EOS_PATTERNS = magic_patterns(EOS_MAGIC)
+
+
+def read_bits(buf, index, shift):
+    '''The 48 bits at bit shift of byte index of buf'''
+    window = buf[index:index + 8]
+    window += "\0" * (8 - len(window))
+    return (struct.unpack(">Q", window)[0] >> (16 - shift)) & ((1 << MAGIC_BITS) - 1)
+
+
+def find_magic(buf, start, stop):
+    '''
+    Return the sorted (bit offset, is_block) of every magic number whose
+    window starts between bytes start and stop of buf
+    '''
+    found = []
+    for magic, patterns, is_block in ((BLOCK_MAGIC, BLOCK_PATTERNS, True),
+                                      (EOS_MAGIC, EOS_PATTERNS, False)):
+        for shift, first, pattern in patterns:
+            p = buf.find(pattern, start + first)
+            while p >= 0:
+                index = p - first
+                if index >= stop:
+                    break
+                if index >= start and read_bits(buf, index, shift) == magic:
+                    found.append((index * 8 + shift, is_block))
+                p = buf.find(pattern, p + 1)
+    found.sort()
+    return found
+
+
+def is_stream_end(buf, index, shift, eof):
+    '''
+    True when the end of stream magic at bit shift of byte index of buf is
+    a real one, the stream CRC and padding are followed by the end of the
+    file (eof and nothing left in buf) or by the header of the next stream
+    '''
+    end = index + (shift + MAGIC_BITS + 32 + 7) // 8
+    following = buf[end:end + 4]
+    if not following:
+        return eof
+    return len(following) == 4 and following[:3] == "BZh" and following[3] in "123456789"
+
+
+def to_long(data):
+    return long(binascii.hexlify(data), 16) if data else 0L
+
+
+def from_long(value, nbytes):
+    return binascii.unhexlify("%0*x" % (nbytes * 2, value))
+
+
+def block_stream(raw, lead, nbits):
+    '''
+    Build a bz2 stream out of one block, raw are the bytes holding the
+    block, the block starts lead bits into raw and is nbits long
+    '''
+    value = to_long(raw)
+    value >>= len(raw) * 8 - lead - nbits
+    value &= (1 << nbits) - 1
+    # The block CRC comes right after the block magic
+    crc = (value >> (nbits - MAGIC_BITS - 32)) & 0xffffffff
+    value = (value << MAGIC_BITS) | EOS_MAGIC
+    value = (value << 32) | crc
+    total = nbits + MAGIC_BITS + 32
+    pad = -total % 8
+    return STREAM_HEADER + from_long(value << pad, (total + pad) // 8)
+
+
+def decompress_block(block):
+    '''Worker: decompress one (raw, lead, nbits) block, None if it is broken'''
+    try:
+        return bz2.decompress(block_stream(*block))
+    except (IOError, EOFError, ValueError):
+        return None
+
+
+def join_blocks(first, second):
+    '''Join two (raw, lead, nbits) blocks that follow each other'''
+    raw, lead, nbits = first
+    raw2, lead2, nbits2 = second
+    # second starts on the byte where first ends
+    keep = (lead + nbits) // 8
+    return raw[:keep] + raw2, lead, nbits + nbits2
+
+
+def iter_blocks(f, read_bytes=READ_BYTES):
+    '''Yield the (raw, lead, nbits) blocks of the open bz2 file in order'''
+    buf = ""
+    base = 0          # offset in the file of buf[0], in bytes
+    searched = 0      # bytes of buf already searched
+    start = None      # bit offset in the file of the current block
+    eof = False
+    while not eof:
+        data = f.read(read_bytes)
+        eof = not data
+        buf += data
+        # Leave room for a whole window and what follows it at the end
+        # unless we are done
+        stop = len(buf) if eof else max(len(buf) - LOOKAHEAD_BYTES, searched)
+        for bit, is_block in find_magic(buf, searched, stop):
+            if not is_block and not is_stream_end(buf, bit // 8, bit % 8, eof):
+                # Chance match inside a block, the block goes on
+                continue
+            bit += base * 8
+            if start is not None:
+                first = start // 8 - base
+                last = (bit + 7) // 8 - base
+                yield buf[first:last], start % 8, bit - start
+            start = bit if is_block else None
+        searched = stop
+        # Drop what we no longer need
+        keep = (start // 8 if start is not None else base + searched) - base
+        if keep > 0:
+            buf = buf[keep:]
+            base += keep
+            searched -= keep
+    if start is not None:
+        raise IOError("bz2 file ends inside a block, is it truncated?")
+
+
+class ParallelBZ2Reader(object):
+    '''
+    File like object returning the decompressed data of a bz2 file,
+    the blocks are decompressed on processes workers (default all cores)
+    '''
+    def __init__(self, filename, processes=None):
+        self.name = filename
+        self.f = open(filename, "rb")
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(processes) if processes > 1 else None
+        # Keep a few blocks in flight per worker, no more, so memory does
+        # not grow with the file
+        self.window = max(processes, 1) * 2
+        self.blocks = iter_blocks(self.f)
+        self.pending = collections.deque()
+        self.current = ""
+        self.pos = 0
+        self.done = False
+
+    def submit(self):
+        '''Queue blocks until the window is full'''
+        while len(self.pending) < self.window:
+            block = next(self.blocks, None)
+            if block is None:
+                return
+            if self.pool is None:
+                result = decompress_block(block)
+            else:
+                result = self.pool.apply_async(decompress_block, (block,))
+            self.pending.append((block, result))
+
+    def next_data(self):
+        '''Decompressed data of the next block, None at the end of the file'''
+        self.submit()
+        if not self.pending:
+            return None
+        block, result = self.pending.popleft()
+        data = result if self.pool is None else result.get()
+        joins = 0
+        while data is None:
+            # A false magic number split the block, or the file is broken
+            self.submit()
+            if not self.pending or joins >= MAX_JOINS:
+                raise IOError("Invalid bz2 data in {0}".format(self.name))
+            block = join_blocks(block, self.pending.popleft()[0])
+            data = decompress_block(block)
+            joins += 1
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.current[self.pos:]]
+            data = self.next_data()
+            while data is not None:
+                parts.append(data)
+                data = self.next_data()
+            self.current, self.pos = "", 0
+            return "".join(parts)
+
+        while self.pos >= len(self.current):
+            data = self.next_data()
+            if data is None:
+                return ""
+            self.current, self.pos = data, 0
+        out = self.current[self.pos:self.pos + size]
+        self.pos += len(out)
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.f.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+OSM timestamps as datetimes or as seconds since 1970
+
+shape_element used to keep created.timestamp as the "2013-08-03T16:43:42Z"
+string, which MongoDB can only compare as text. parse_timestamp turns it
+into a datetime, which pymongo stores as a BSON date and JsonSink writes
+in MongoDB extended JSON for mongoimport:
+
+    "timestamp": {"$date": "2013-08-03T16:43:42Z"}
+
+Every OSM file writes its timestamps in that one format, so there is no
+strptime: the fields are cut out at fixed positions, the year, month and
+day once per distinct date (OSM started in 2004, a planet file has fewer
+than ten thousand days) and the hours, minutes and seconds from a table
+of the two digit strings. That is about ten times faster than
+datetime.strptime.
+
+The same cache of dates gives the seconds since 1970 UTC of a timestamp,
+which UserStats (ExploringUsers/userstats.py) keeps for the first and last
+edit of each user:
+
+    timestamp_seconds("2013-08-03T16:43:42Z")     1375548222
+
+A timestamp in any other format is kept as it is.
+"""
+import calendar
+from datetime import datetime
+
+# "00" .. "59" => int
+TWO_DIGITS = dict(("%02d" % i, i) for i in range(60))
+
+# "YYYY-MM-DD" => (year, month, day, seconds since 1970 of its midnight),
+# only the valid dates, there can only be so many of them while there is
+# no end to the junk a file can hold
+dates = {}
+
+
+def parse_date(prefix):
+    '''The dates entry of prefix, None when it is not a date'''
+    if prefix[4:5] != "-" or prefix[7:8] != "-":
+        return None
+    try:
+        ymd = (int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]))
+        # Check that the day exists
+        datetime(*ymd)
+    except ValueError:
+        return None
+    day = dates[prefix] = ymd + (calendar.timegm(ymd + (0, 0, 0)),)
+    return day
+
+
+def split_timestamp(ts):
+    '''(date, hours, minutes, seconds) of ts, the date as in dates, None if it is not a timestamp'''
+    if not ts or len(ts) != 20 or ts[10] != "T" or ts[19] != "Z":
+        return None
+    prefix = ts[:10]
+    day = dates.get(prefix)
+    if day is None:
+        day = parse_date(prefix)
+        if day is None:
+            return None
+    try:
+        hours = TWO_DIGITS[ts[11:13]]
+        minutes = TWO_DIGITS[ts[14:16]]
+        seconds = TWO_DIGITS[ts[17:19]]
+    except KeyError:
+        return None
+    if hours > 23:
+        return None
+    return day, hours, minutes, seconds
+
+
+def parse_timestamp(ts):
+    '''"2013-08-03T16:43:42Z" as a naive UTC datetime, None if it is not one'''
+    parts = split_timestamp(ts)
+    if parts is None:
+        return None
+    day, hours, minutes, seconds = parts
+    return datetime(day[0], day[1], day[2], hours, minutes, seconds)
+
+
+def timestamp_seconds(ts):
+    '''"2013-08-03T16:43:42Z" in seconds since 1970 UTC, None if it is not one'''
+    parts = split_timestamp(ts)
+    if parts is None:
+        return None
+    day, hours, minutes, seconds = parts
+    return day[3] + hours * 3600 + minutes * 60 + seconds
+
+
+def to_date(ts):
+    '''The datetime of ts, or ts itself when it is not an OSM timestamp'''
+    parsed = parse_timestamp(ts)
+    return ts if parsed is None else parsed
+
+
+def json_default(obj):
+    '''JSONEncoder default, a datetime as {"$date": "2013-08-03T16:43:42Z"}'''
+    if isinstance(obj, datetime):
+        return {"$date": obj.isoformat() + "Z"}
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+def test():
+    for ts in ["2013-08-03T16:43:42Z", "2013-02-30T16:43:42Z", "2013-08-03 16:43:42", "yesterday"]:
+        print repr(ts), repr(to_date(ts)), timestamp_seconds(ts)
+    print json_default(to_date("2013-08-03T16:43:42Z"))
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
 import pprint
 import re
 import codecs
 import json
+import os
+import sys
+# The shared streaming reader lives with the iterative parsing lesson
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements
 
 """
 Your task is to wrangle the data and transform the shape of the data
@@ -232,11 +237,13 @@ def is_valid_tag(element):
             
     return isValid
 
-def process_map(file_in, pretty = False):
+def process_map(file_in, pretty = False, max_rss_mb = None):
     '''
     Process map reads in the OpenStreet Map file
     and writes out to file the JSON data structure
     file_in is the path and filename, pretty parameter formats the json
+    max_rss_mb is the optional memory ceiling in megabytes, each element
+    is released from the parser as soon as it has been shaped
     '''
     
     # Keep the same filename and just append .json to the filename
@@ -244,7 +251,7 @@ def process_map(file_in, pretty = False):
     data = []
     with codecs.open(file_out, "w") as fo:
         # Go element by element to read the file        
-        for _, element in ET.iterparse(file_in):
+        for _, element in iter_elements(file_in, max_rss_mb=max_rss_mb):
             el = shape_element(element)
             
             # If we have an element add it to the dictionary
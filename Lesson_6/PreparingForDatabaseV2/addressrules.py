@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Address cleaning rules per region, read from a config file
+
+The addr:* cleaning used to be a chain of if newKey == ... branches in
+shape_element with Alaska written into it, the state was forced to "AK"
+and update_city knew one typo. The rules now live in regions/<region>.json,
+one list of steps per address field, applied in order:
+
+    {"region": "AK",
+     "fields": {
+        "street":   [{"suffix": {"St": "Street", "Ave.": "Avenue", ...}}],
+        "postcode": [{"sub": "\\\\D", "repl": ""}],
+        "state":    [{"set": "AK"}],
+        "city":     [{"map": {"Anchoage": "Anchorage"}},
+                     {"fuzzy": "AK_cities.txt", "min_confidence": 0.8}]}}
+
+    {"map": {...}}             replace a whole value found in the map
+    {"suffix": {...}}          replace the last word, the street type, see
+                               ImprovingStreetNames/streetnames.py
+    {"sub": re, "repl": s}     re.sub with a pattern compiled once
+    {"set": value}             always this value
+    {"case": "upper"}          upper, lower or title case
+    {"strip": true}            drop the white space around the value
+    {"fuzzy": "AK_cities.txt", "max_distance": 2, "min_confidence": 0.8}
+                               the closest name of a reference list, one
+                               name per line, when it is close enough, see
+                               fuzzymatch.py
+
+AddressRules compiles the file into a table of field => steps. The cleaned
+value of each distinct value is kept per field, like StreetNormalizer
+keeps its names, so the steps run once per value, not once per tag. clean_documents does the
+same for a batch of shaped documents, collecting the distinct values first.
+
+    rules = rules_for("AK")
+    rules.clean("city", "Anchoage")    "Anchorage"
+"""
+import json
+import os
+import re
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "ImprovingStreetNames"))
+from streetnames import StreetNormalizer
+from fuzzymatch import FuzzyMatcher, read_names, MAX_DISTANCE, MIN_CONFIDENCE
+
+# The region config files
+REGIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions")
+
+# Stop remembering new values of a field past this many
+MAX_VALUES = 200000
+
+CASES = {"upper": lambda v: v.upper(),
+         "lower": lambda v: v.lower(),
+         "title": lambda v: v.title()}
+
+
+def compile_step(step):
+    '''One step of a field as a function of the value'''
+    if "map" in step:
+        mapping = dict(step["map"])
+        return lambda v: mapping.get(v, v)
+    if "suffix" in step:
+        return StreetNormalizer(step["suffix"]).normalize
+    if "sub" in step:
+        pattern = re.compile(step["sub"])
+        repl = step.get("repl", "")
+        return lambda v: pattern.sub(repl, v)
+    if "set" in step:
+        value = step["set"]
+        return lambda v: value
+    if "case" in step:
+        if step["case"] not in CASES:
+            raise ValueError("unknown case {0!r}, use {1}".format(step["case"], ", ".join(sorted(CASES))))
+        return CASES[step["case"]]
+    if step.get("strip"):
+        return lambda v: v.strip()
+    if "fuzzy" in step:
+        names = read_names(os.path.join(REGIONS_DIR, step["fuzzy"]))
+        return FuzzyMatcher(names, step.get("max_distance", MAX_DISTANCE),
+                            step.get("min_confidence", MIN_CONFIDENCE)).correct
+    raise ValueError("unknown address rule step {0!r}, use map, suffix, sub, set, case, "
+                     "strip or fuzzy".format(step))
+
+
+class AddressRules(object):
+    '''The compiled rules of a region, see the module docstring'''
+    def __init__(self, config):
+        self.region = config.get("region")
+        # field => [step functions]
+        self.table = dict((field, [compile_step(step) for step in steps])
+                          for field, steps in config.get("fields", {}).iteritems())
+        # field => {value: cleaned value}
+        self.cleaned = dict((field, {}) for field in self.table)
+        self.hits = 0
+        self.misses = 0
+
+    def clean(self, field, value):
+        '''The cleaned value of the addr:<field> tag'''
+        cleaned = self.cleaned.get(field)
+        if cleaned is None:
+            # No rules for the field
+            return value
+        fixed = cleaned.get(value)
+        if fixed is not None:
+            self.hits += 1
+            return fixed
+        self.misses += 1
+        fixed = value
+        for step in self.table[field]:
+            fixed = step(fixed)
+        if len(cleaned) < MAX_VALUES:
+            cleaned[value] = fixed
+        return fixed
+
+    def clean_distinct(self, field, values):
+        '''{value: cleaned value} of the distinct values, each cleaned once'''
+        return dict((v, self.clean(field, v)) for v in set(values))
+
+    def clean_documents(self, docs):
+        '''
+        Clean the address of each shaped document in place, every distinct
+        field and value is cleaned once for the whole batch
+        '''
+        values = {}
+        for doc in docs:
+            for field, v in doc.get("address", {}).iteritems():
+                values.setdefault(field, set()).add(v)
+        fixed = dict((field, self.clean_distinct(field, vs)) for field, vs in values.iteritems())
+        for doc in docs:
+            address = doc.get("address")
+            if address:
+                for field, v in address.items():
+                    address[field] = fixed[field][v]
+        return docs
+
+    def stats(self):
+        return {"region": self.region, "hits": self.hits, "misses": self.misses,
+                "values": dict((field, len(c)) for field, c in self.cleaned.iteritems())}
+
+
+# region or file name => AddressRules
+loaded = {}
+
+
+def rules_for(region):
+    '''The AddressRules of regions/<region>.json, or of a config file path'''
+    rules = loaded.get(region)
+    if rules is None:
+        filename = region if region.endswith(".json") else \
+            os.path.join(REGIONS_DIR, "{0}.json".format(region))
+        if not os.path.exists(filename):
+            raise ValueError("no address rules for {0!r}, add {1}".format(region, filename))
+        with open(filename) as f:
+            rules = loaded[region] = AddressRules(json.load(f))
+    return rules
+
+
+def test():
+    rules = rules_for("AK")
+    for field, value in [("street", "W 4th Ave."), ("postcode", "AK 99501-2129"),
+                         ("state", "Alaska"), ("city", "Anchoage"), ("housenumber", "12")]:
+        print field, repr(value), "=>", repr(rules.clean(field, value))
+    print rules.stats()
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Keep only the part of the map inside a bounding box or polygon
+
+Most of a statewide extract is thrown away when all we want is the metro
+area. process_map(clip=Clip(...)) drops what is outside while the file is
+read, before shape_element builds any dictionaries for it:
+
+    nodes       kept when they are inside
+    ways        kept when any of their nodes was kept, with all their
+                node_refs, the nodes outside are not in the output
+    relations   kept when any node or way member was kept
+
+The ids of the nodes and ways kept are set in IdBitmap, one bit per id in
+8 KB blocks of 65536 ids made as they are needed, so a metro area of a few
+million nodes takes a few MB whatever the ids are. Nodes come before the
+ways and ways before the relations in an OSM file, which is what makes one
+pass enough.
+
+A node is tested against a grid laid over the bounding box of the polygon.
+Each cell is marked inside, outside or on an edge when it is built, only a
+node in an edge cell is tested against the polygon, with the edges that
+cross its row of cells:
+
+    Clip.bbox(61.0, -150.1, 61.4, -149.5)        min lat, min lon, max lat, max lon
+    Clip([(61.1, -150.0), (61.3, -149.6), ...])   (lat, lon) ring
+    Clip(read_poly("anchorage.poly"))            osmosis .poly file, holes too
+"""
+from bisect import bisect_left
+
+# Grid cells along each side
+GRID = 64
+
+OUTSIDE, INSIDE, EDGE = 0, 1, 2
+
+# Ids per IdBitmap block
+BLOCK_BITS = 16
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+
+class IdBitmap(object):
+    '''Set of integer ids, one bit each in blocks allocated on first use'''
+    def __init__(self):
+        self.blocks = {}
+
+    def add(self, i):
+        block = self.blocks.get(i >> BLOCK_BITS)
+        if block is None:
+            block = self.blocks[i >> BLOCK_BITS] = bytearray((BLOCK_MASK + 1) >> 3)
+        block[(i & BLOCK_MASK) >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, i):
+        block = self.blocks.get(i >> BLOCK_BITS)
+        return block is not None and block[(i & BLOCK_MASK) >> 3] & (1 << (i & 7)) != 0
+
+    def nbytes(self):
+        return len(self.blocks) * ((BLOCK_MASK + 1) >> 3)
+
+
+def read_poly(filename):
+    '''
+    The rings of an osmosis .poly file as lists of (lat, lon), the holes
+    ("!" sections) are rings like the others, see Clip
+    '''
+    rings = []
+    with open(filename) as f:
+        lines = [line.strip() for line in f]
+    ring = None
+    # The first line is the name of the polygon
+    for line in lines[1:]:
+        if not line:
+            continue
+        if ring is None:
+            if line == "END":
+                break
+            ring = []
+        elif line == "END":
+            rings.append(ring)
+            ring = None
+        else:
+            lon, lat = line.split()[:2]
+            ring.append((float(lat), float(lon)))
+    return rings
+
+
+def as_id(value):
+    '''The int of an id or ref attribute, None when it is missing or not a number'''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Clip(object):
+    '''
+    Decides which elements of the file to keep, see the module docstring
+    polygon is a ring of (lat, lon) points or a list of rings, a point is
+    inside when it is inside an odd number of rings, so holes are rings too
+    '''
+    def __init__(self, polygon, grid=GRID):
+        rings = [polygon] if polygon and isinstance(polygon[0][0], (int, float)) else polygon
+        # (lat1, lon1, lat2, lon2) of every side of every ring
+        self.edges = []
+        for ring in rings:
+            for i in range(len(ring)):
+                (lat1, lon1), (lat2, lon2) = ring[i - 1], ring[i]
+                if lat1 != lat2 or lon1 != lon2:
+                    self.edges.append((lat1, lon1, lat2, lon2))
+        if not self.edges:
+            raise ValueError("the clip polygon has no area")
+        lats = [e[0] for e in self.edges]
+        lons = [e[1] for e in self.edges]
+        self.min_lat, self.max_lat = min(lats), max(lats)
+        self.min_lon, self.max_lon = min(lons), max(lons)
+        self.grid = grid
+        self.cell_lat = (self.max_lat - self.min_lat) / grid or 1.0
+        self.cell_lon = (self.max_lon - self.min_lon) / grid or 1.0
+        self.build_grid()
+        self.is_box = False
+        self.reset()
+
+    @classmethod
+    def bbox(cls, min_lat, min_lon, max_lat, max_lon):
+        clip = cls([(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon)])
+        # Every point of the bounding box is inside
+        clip.is_box = True
+        return clip
+
+    def build_grid(self):
+        grid = self.grid
+        # The edges that cross each row of cells
+        self.rows = [[] for _ in range(grid)]
+        self.cells = bytearray(grid * grid)
+        for edge in self.edges:
+            lat1, lon1, lat2, lon2 = edge
+            for row in range(self.row_of(min(lat1, lat2)), self.row_of(max(lat1, lat2)) + 1):
+                self.rows[row].append(edge)
+                # The cells of the row the edge can pass through
+                bottom = self.min_lat + row * self.cell_lat
+                top = bottom + self.cell_lat
+                lo, hi = self.lon_range(edge, bottom, top)
+                for col in range(self.col_of(lo), self.col_of(hi) + 1):
+                    self.cells[row * grid + col] = EDGE
+        # The cells no edge passes through are all in or all out, the
+        # status of their centre is the status of the whole cell
+        for row in range(grid):
+            lat = self.min_lat + (row + 0.5) * self.cell_lat
+            crossings = sorted(self.crossing_lon(edge, lat) for edge in self.rows[row]
+                               if (edge[0] > lat) != (edge[2] > lat))
+            for col in range(grid):
+                if self.cells[row * grid + col] != EDGE:
+                    lon = self.min_lon + (col + 0.5) * self.cell_lon
+                    if bisect_left(crossings, lon) % 2:
+                        self.cells[row * grid + col] = INSIDE
+
+    def row_of(self, lat):
+        return min(max(int((lat - self.min_lat) / self.cell_lat), 0), self.grid - 1)
+
+    def col_of(self, lon):
+        return min(max(int((lon - self.min_lon) / self.cell_lon), 0), self.grid - 1)
+
+    @staticmethod
+    def crossing_lon(edge, lat):
+        lat1, lon1, lat2, lon2 = edge
+        return lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+
+    @staticmethod
+    def lon_range(edge, bottom, top):
+        '''Smallest and largest lon of the part of edge between two lats'''
+        lat1, lon1, lat2, lon2 = edge
+        if lat1 == lat2:
+            return min(lon1, lon2), max(lon1, lon2)
+        lons = [lon for lat, lon in ((lat1, lon1), (lat2, lon2)) if bottom <= lat <= top]
+        for lat in (bottom, top):
+            if min(lat1, lat2) <= lat <= max(lat1, lat2):
+                lons.append(Clip.crossing_lon(edge, lat))
+        if not lons:
+            # Rounding at the border of the row, take the whole edge
+            return min(lon1, lon2), max(lon1, lon2)
+        return min(lons), max(lons)
+
+    def contains(self, lat, lon):
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon):
+            return False
+        if self.is_box:
+            return True
+        row = self.row_of(lat)
+        cell = self.cells[row * self.grid + self.col_of(lon)]
+        if cell != EDGE:
+            return cell == INSIDE
+        # Ray casting towards the west, only the edges of the row can cross it
+        inside = False
+        for lat1, lon1, lat2, lon2 in self.rows[row]:
+            if (lat1 > lat) != (lat2 > lat) and \
+               lon > lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                inside = not inside
+        return inside
+
+    def reset(self):
+        '''Forget the nodes and ways kept, before reading a file'''
+        self.nodes = IdBitmap()
+        self.ways = IdBitmap()
+
+    def keep(self, element):
+        '''True when the node, way or relation element is to be shaped'''
+        tag = element.tag
+        attrib = element.attrib
+        if tag == "node":
+            try:
+                inside = self.contains(float(attrib["lat"]), float(attrib["lon"]))
+            except (KeyError, ValueError):
+                return False
+            node_id = as_id(attrib.get("id"))
+            if inside and node_id is not None:
+                self.nodes.add(node_id)
+            return inside
+        if tag == "way":
+            nodes = self.nodes
+            for nd in element.iter("nd"):
+                # A missing or bad ref is not in the clip
+                ref = as_id(nd.attrib.get("ref"))
+                if ref is not None and ref in nodes:
+                    way_id = as_id(attrib.get("id"))
+                    if way_id is not None:
+                        self.ways.add(way_id)
+                    return True
+            return False
+        if tag == "relation":
+            members_kept = {"node": self.nodes, "way": self.ways}
+            for member in element.iter("member"):
+                kept = members_kept.get(member.attrib.get("type"))
+                ref = as_id(member.attrib.get("ref"))
+                if kept is not None and ref is not None and ref in kept:
+                    return True
+            return False
+        return False
+
+
+def test():
+    box = Clip.bbox(61.0, -150.1, 61.4, -149.5)
+    print box.contains(61.2, -149.9), box.contains(60.0, -149.9)
+    triangle = Clip([(61.0, -150.0), (61.0, -149.0), (62.0, -149.5)])
+    print triangle.contains(61.1, -149.5), triangle.contains(61.9, -149.1)
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
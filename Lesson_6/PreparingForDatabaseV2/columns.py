@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Columnar NumPy store of the nodes
+
+Doing spatial stats on pos meant loading the .2.json file back into Python,
+parsing gigabytes of JSON again. process_map(columns=True) also writes the
+nodes as a directory of .npy files next to the input, one array per column:
+
+    Alaska.xml.columns/
+        id.npy          int64, -1 when missing
+        lat.npy         float64
+        lon.npy         float64
+        version.npy     int32, -1 when missing
+        changeset.npy   int64, -1 when missing
+        uid.npy         int64, -1 when missing
+        timestamp.npy   datetime64[s], NaT when missing
+        tag_row.npy     int64  \\
+        tag_key.npy     int32   > one entry per tag, the row of the node and
+        tag_value.npy   int32  /  the codes of the key and of the value
+        keys_offsets.npy, keys_bytes.npy       the distinct keys and values,
+        values_offsets.npy, values_bytes.npy   utf-8 one after the other
+        meta.json       number of rows and tags, written last
+
+The tags are the fields the node has in the JSON output, address fields as
+addr:street and so on. Each distinct key and value is stored once, the
+tag columns hold their codes.
+
+ColumnStore maps the files with numpy.load(mmap_mode="r"), opening a store
+takes milliseconds whatever its size and only the pages a query touches
+are read:
+
+    store = ColumnStore("Alaska.xml.columns")
+    inside = (store.lat > 61.1) & (store.lat < 61.2)
+    store.id[inside]
+    store.rows_with("amenity", "cafe")
+
+The columns are written to temporary raw files while the file is read and
+turned into .npy files at the end, only the distinct keys and values are
+kept in memory. A resumable writer also logs each new key and value as a
+line of JSON, so a run resumed from a checkpoint gets its codes back, see
+resumable.py. Needs numpy:
+    pip install numpy
+"""
+import json
+import os
+import shutil
+from datetime import datetime
+from nodeindex import truncate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (column, dtype) of the node columns, see the module docstring for the
+# value of a missing attribute
+NODE_COLUMNS = [("id", "<i8"),
+                ("lat", "<f8"),
+                ("lon", "<f8"),
+                ("version", "<i4"),
+                ("changeset", "<i8"),
+                ("uid", "<i8"),
+                ("timestamp", "<M8[s]")]
+
+TAG_COLUMNS = [("tag_row", "<i8"), ("tag_key", "<i4"), ("tag_value", "<i4")]
+
+# Fields of a shaped node that are not tags
+NOT_TAGS = set(["id", "type", "pos", "created", "visible", "address"])
+
+# Rows buffered before they are written to the raw files
+FLUSH_ROWS = 65536
+
+EPOCH = datetime(1970, 1, 1)
+
+# datetime64 NaT as an int64
+NAT = -2 ** 63
+
+
+def as_number(v, missing):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return missing
+
+
+def epoch_seconds(ts):
+    '''Seconds since 1970 of the datetime timestamp, NaT for anything else'''
+    if isinstance(ts, datetime):
+        delta = ts - EPOCH
+        return delta.days * 86400 + delta.seconds
+    return NAT
+
+
+def read_log(filename, size):
+    '''{string: code} of the first size bytes of a keys or values log'''
+    truncate(filename, size)
+    codes = {}
+    with open(filename, "rb") as f:
+        for line in f:
+            codes[json.loads(line)] = len(codes)
+    return codes
+
+
+def write_npy(filename, raw_file, raw_dtype, dtype, count):
+    '''
+    Turn a raw file of count values of raw_dtype into a .npy file of dtype,
+    the bytes are the same, datetime64[s] is written as int64 seconds
+    '''
+    out = numpy.lib.format.open_memmap(filename, mode="w+", dtype=numpy.dtype(dtype), shape=(count,))
+    with open(raw_file, "rb") as f:
+        done = 0
+        while done < count:
+            block = numpy.fromfile(f, dtype=raw_dtype, count=min(FLUSH_ROWS * 16, count - done))
+            out[done:done + len(block)] = block.view(dtype)
+            done += len(block)
+    out.flush()
+    del out
+
+
+class ColumnWriter(object):
+    '''
+    Collect the shaped nodes into the columns of directory
+    A resumable writer keeps its files when the run fails, resume_from is
+    the checkpoint() position to carry on from
+    '''
+    def __init__(self, directory, resumable=False, resume_from=None):
+        if numpy is None:
+            raise ImportError("the columnar store needs numpy, pip install numpy")
+        self.directory = directory
+        self.resumable = resumable or resume_from is not None
+        self.names = [name for name, _ in NODE_COLUMNS + TAG_COLUMNS]
+        self.dtypes = dict(NODE_COLUMNS + TAG_COLUMNS)
+        # Timestamps are buffered as int64 seconds
+        self.buffer_dtypes = dict(self.dtypes, timestamp="<i8")
+        self.buffers = dict((name, []) for name in self.names)
+        # key or value => code, in the order they were first seen
+        self.keys = {}
+        self.values = {}
+        self.rows = 0
+        self.tags = 0
+        if resume_from is None:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            mode = "wb"
+        else:
+            self.rows = resume_from["rows"]
+            self.tags = resume_from["tags"]
+            for name in self.names:
+                count = self.tags if name.startswith("tag_") else self.rows
+                truncate(self.raw_name(name), count * numpy.dtype(self.buffer_dtypes[name]).itemsize)
+            self.keys = read_log(self.log_name("keys"), resume_from["keys_log"])
+            self.values = read_log(self.log_name("values"), resume_from["values_log"])
+            mode = "ab"
+        self.raw = dict((name, open(self.raw_name(name), mode)) for name in self.names)
+        # The keys and values not logged yet, in code order
+        self.new_strings = {"keys": [], "values": []}
+        self.logs = {}
+        if self.resumable:
+            self.logs = dict((name, open(self.log_name(name), mode)) for name in self.new_strings)
+
+    def raw_name(self, name):
+        return os.path.join(self.directory, name + ".raw")
+
+    def log_name(self, name):
+        return os.path.join(self.directory, name + ".log")
+
+    def add(self, el):
+        '''Add a shaped element, anything but a node is skipped'''
+        if el.get("type") != "node":
+            return
+        b = self.buffers
+        created = el.get("created", {})
+        pos = el.get("pos") or (0, 0)
+        b["id"].append(as_number(el.get("id"), -1))
+        b["lat"].append(pos[0])
+        b["lon"].append(pos[1])
+        b["version"].append(as_number(created.get("version"), -1))
+        b["changeset"].append(as_number(created.get("changeset"), -1))
+        b["uid"].append(as_number(created.get("uid"), -1))
+        b["timestamp"].append(epoch_seconds(created.get("timestamp")))
+        row = self.rows
+        for k, v in el.iteritems():
+            if k not in NOT_TAGS:
+                self.add_tag(row, k, v)
+        for k, v in el.get("address", {}).iteritems():
+            self.add_tag(row, "addr:" + k, v)
+        self.rows += 1
+        if len(b["id"]) >= FLUSH_ROWS:
+            self.flush()
+
+    def add_tag(self, row, k, v):
+        keys, values = self.keys, self.values
+        key = keys.get(k)
+        if key is None:
+            key = keys[k] = len(keys)
+            if self.logs:
+                self.new_strings["keys"].append(k)
+        value = values.get(v)
+        if value is None:
+            value = values[v] = len(values)
+            if self.logs:
+                self.new_strings["values"].append(v)
+        b = self.buffers
+        b["tag_row"].append(row)
+        b["tag_key"].append(key)
+        b["tag_value"].append(value)
+        self.tags += 1
+
+    def flush(self):
+        for name in self.names:
+            if self.buffers[name]:
+                numpy.array(self.buffers[name], dtype=self.buffer_dtypes[name]).tofile(self.raw[name])
+                self.buffers[name] = []
+
+    def checkpoint(self):
+        '''Write the rows so far to disk, returns the position to resume from'''
+        self.flush()
+        for name, strings in self.new_strings.iteritems():
+            self.logs[name].write("".join(json.dumps(s) + "\n" for s in strings))
+            del strings[:]
+        for f in self.raw.values() + self.logs.values():
+            f.flush()
+            os.fsync(f.fileno())
+        return {"rows": self.rows, "tags": self.tags,
+                "keys_log": self.logs["keys"].tell(), "values_log": self.logs["values"].tell()}
+
+    def write_strings(self, name, codes):
+        '''The strings of codes, in code order, as offsets and utf-8 bytes'''
+        encoded = [None] * len(codes)
+        for s, code in codes.iteritems():
+            encoded[code] = s.encode("utf-8") if isinstance(s, unicode) else str(s)
+        offsets = numpy.zeros(len(encoded) + 1, dtype="<i8")
+        numpy.cumsum([len(s) for s in encoded], out=offsets[1:])
+        numpy.save(os.path.join(self.directory, name + "_offsets.npy"), offsets)
+        blob = "".join(encoded)
+        # frombuffer does not take an empty string on older numpy
+        data = numpy.frombuffer(blob, dtype=numpy.uint8) if blob else numpy.zeros(0, dtype=numpy.uint8)
+        numpy.save(os.path.join(self.directory, name + "_bytes.npy"), data)
+
+    def close(self):
+        '''Write the .npy files and meta.json, the store is complete once it is there'''
+        self.flush()
+        for f in self.raw.values() + self.logs.values():
+            f.close()
+        for name in self.logs:
+            os.remove(self.log_name(name))
+        self.logs = {}
+        for name in self.names:
+            count = self.tags if name.startswith("tag_") else self.rows
+            write_npy(os.path.join(self.directory, name + ".npy"), self.raw_name(name),
+                      self.buffer_dtypes[name], self.dtypes[name], count)
+            os.remove(self.raw_name(name))
+        self.write_strings("keys", self.keys)
+        self.write_strings("values", self.values)
+        with open(os.path.join(self.directory, "meta.json"), "wb") as f:
+            json.dump({"rows": self.rows, "tags": self.tags, "columns": self.names}, f)
+        self.raw = {}
+
+    def abort(self):
+        '''Remove what was written, when the run failed, a resumable store is kept'''
+        for f in self.raw.values() + self.logs.values():
+            f.close()
+        self.raw = {}
+        self.logs = {}
+        if not self.resumable and os.path.exists(self.directory) and \
+           not os.path.exists(os.path.join(self.directory, "meta.json")):
+            shutil.rmtree(self.directory)
+
+
+class Strings(object):
+    '''The keys or values of a store, code => string'''
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        self.codes = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        start, end = self.offsets[code], self.offsets[code + 1]
+        return self.data[start:end].tostring().decode("utf-8")
+
+    def code(self, s):
+        '''The code of s, None when the store does not have it'''
+        if self.codes is None:
+            self.codes = dict((self[i], i) for i in xrange(len(self)))
+        if isinstance(s, str):
+            s = s.decode("utf-8")
+        return self.codes.get(s)
+
+
+class ColumnStore(object):
+    '''The columns of a store directory, memory mapped, see the module docstring'''
+    def __init__(self, directory):
+        if numpy is None:
+            raise ImportError("the columnar store needs numpy, pip install numpy")
+        meta = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta):
+            raise ValueError("{0} is not a finished column store".format(directory))
+        with open(meta, "rb") as f:
+            self.meta = json.load(f)
+        self.directory = directory
+        self.arrays = {}
+        self.keys = Strings(self.load("keys_offsets"), self.load("keys_bytes"))
+        self.values = Strings(self.load("values_offsets"), self.load("values_bytes"))
+
+    def load(self, name):
+        array = self.arrays.get(name)
+        if array is None:
+            array = self.arrays[name] = numpy.load(
+                os.path.join(self.directory, name + ".npy"), mmap_mode="r")
+        return array
+
+    def __getitem__(self, name):
+        if name not in self.meta["columns"]:
+            raise KeyError(name)
+        return self.load(name)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name in ("meta", "arrays", "directory"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def rows_with(self, key, value=None):
+        '''Rows of the nodes that have the tag key, with that value when given'''
+        key_code = self.keys.code(key)
+        if key_code is None:
+            return numpy.zeros(0, dtype="<i8")
+        mask = self.load("tag_key") == key_code
+        if value is not None:
+            value_code = self.values.code(value)
+            if value_code is None:
+                return numpy.zeros(0, dtype="<i8")
+            mask &= self.load("tag_value") == value_code
+        return self.load("tag_row")[mask]
+
+    def column(self, key):
+        '''Value code of key for every row, -1 where the node does not have it'''
+        codes = numpy.full(len(self), -1, dtype="<i4")
+        key_code = self.keys.code(key)
+        if key_code is not None:
+            mask = self.load("tag_key") == key_code
+            codes[self.load("tag_row")[mask]] = self.load("tag_value")[mask]
+        return codes
+
+
+def test():
+    store = ColumnStore('Alaska_Small.xml.columns')
+    inside = (store.lat > 61.1) & (store.lat < 61.2)
+    print len(store), inside.sum(), store.timestamp.min(), store.timestamp.max()
+    print len(store.rows_with("amenity"))
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
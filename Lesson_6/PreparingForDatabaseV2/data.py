@@ -1,82 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
 import pprint
-import re
-import codecs
-import json
+import os
+import sys
+# The shared streaming reader and the key classifier live with their
+# lessons, the street name normalizer is reached through addressrules
+LESSON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for lesson in ("IterativeParsing", "TagTypes"):
+    sys.path.append(os.path.join(LESSON_DIR, lesson))
+from osmstream import iter_elements
+from keyclass import is_valid_key
+from sinks import JsonSink, output_name
+from stageprof import StageProfile, instrument
+from records import to_record
+from nodeindex import NodeIndex, node_index_for, add_geometry, truncate
+from memberindex import MemberIndexWriter
+from timestamps import to_date
+from filters import element_filter
+from addressrules import rules_for
+from columns import ColumnWriter
+from resumable import Checkpoint, CHECKPOINT_BYTES, CHECKPOINT_ELEMENTS
 
 """
    Clean, format the osm data into a JSON format for import into mongodb
 """
 
-# REGEX to check for all lower case characters in a string
-lower = re.compile(r'^([a-z]|_)*$')
-
-# REGEX to check for colon values
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-
-# REGEX to check for mongodb specific characters
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-
-'''
-street_type_re
-
-Regex which scans for the following items listed below to determine
-if we have a match for a street name which is shortened, abbriviated and
-is only comparing the last word at the end of the string.
-
-https://docs.python.org/2/library/re.html
-
-\b assert position at a word boundary (^\w|\w$|\W\w|\w\W)
-\S+ match any non-white space character [^\r\n\t\f ]
-Quantifier: + Between one and unlimited times, as many times as possible, giving back as needed [greedy]
-\.? matches the character . literally
-Quantifier: ? Between zero and one time, as many times as possible, giving back as needed [greedy]
-$ assert position at end of the string
-https://www.regex101.com/#python
-'''
-street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
-
-# The expected street names
-expected_street_names = ["Avenue", "Boulevard", "Circle", "Commons", "Court", "Drive", "Highway", "Lane", "Loop", "Parkway", "Place", "Road",
-             "Sqaure", "Street", "Trail"]
-
-'''
-map_old_to_new
-Create Dictionary to map abreiviations to full street's suffix
-'''
-map_old_to_new = {
-            "Ave" : "Avenue",
-            "Ave." : "Avenue",
-            "Blvd" : "Boulevard",
-            "Blvd." : "Boulevard",
-            "Cir" : "Circle",
-            "Cmn" : "Commons",
-            "Crt" : "Court",
-            "Crt." : "Court",
-            "Dr" : "Drive",
-            "Dr." : "Drive",
-            "Hwy" : "Highway",
-            "Ln" : "Lane",
-            "Ln." : "Lane",
-            "LN" : "Lane",
-            "Lp" : "Loop",
-            "PARK":"Park",
-            "Pk" : "Parkway",
-            "Pk." : "Parkway",
-            "Pl" : "Place",
-            "Pl." : "Place",
-            "Rd.": "Road",
-            "Rd" : "Road",
-            "Sq": "Sqaure",
-            "Sq.": "Sqaure",
-            "St": "Street",
-            "St.": "Street",
-            "Tr": "Trail",
-            "Tr.": "Trail",
-            "Ashwood": "Ashwood Street"
-            }
+# The REGEX to check for all lower case characters, colon values and
+# mongodb specific characters in a key (lower, lower_colon, problemchars)
+# are in TagTypes/keyclass.py, shared with tags.key_type
+from keyclass import lower, lower_colon, problemchars
 
 '''
  Create the CREATED dictionary to store the a node's meta data
@@ -101,41 +53,28 @@ def shape_element(element):
           same as any other tag.
         - if there is a second ":" that separates the type/direction of a street,
           the tag should be ignored, for example:
+        - relations get their members as a list of
+          {"type": "way", "ref": "209809850", "role": "outer"} in 'members'
+          and their "type" tag (multipolygon, route, ...) as 'relation_type'
     '''
-    # Create the node dictionary
-    node = {}
-    # Add the created object to the node dictionary
-    node['created'] = {}
-
-    # For Lat and Lon we will store these in a 'pos' (position)
-    # we need lat, lon and in specific order (LAT, LON)
-    node['pos'] =[0 for i in range(2)]
+    # Search only through the node, way and relation types, nothing is
+    # allocated for the <tag>, <nd> and <member> elements
+    if element.tag == "node" or element.tag == "way" or element.tag == "relation":
+        # Create the node dictionary
+        node = {}
+        # Add the created object to the node dictionary
+        node['created'] = {}
+
+        # For Lat and Lon we will store these in a 'pos' (position)
+        # we need lat, lon and in specific order (LAT, LON)
+        node['pos'] =[0 for i in range(2)]
 
-    # Search only through the node and way types
-    if element.tag == "node" or element.tag == "way" :
         # add the type to the node, the tag of the element
         node['type'] = element.tag
 
         # Search through the node and way types
         # to build the CREATED and POSITION dictionaries
-        for k,v in element.attrib.iteritems():
-            # CREATE VALUES {"version", "changeset", "timestamp", "user", "uid"}
-            if k in CREATED:
-                node['created'][k] = v
-
-            #TODO: make sure time is formated from string to date
-
-            # Lat is in first position, Lon second position
-            # In JSON and mongodb we need to represent the Lat and Lon as floats
-            elif k in POSITION:
-                if k=="lat":
-                    node['pos'][0]=(float(v))
-                else: # Lon
-                    node['pos'][1]=(float(v))
-            # Key was not in the CREATED or POSITION dictionary
-            # Add a new key value pair
-            else:
-                node[k] = v
+        shape_attributes(element, node)
         '''
         Setup processing for the TAGS - Addresses and other meta data for the
         node and way objects
@@ -161,31 +100,18 @@ def shape_element(element):
                         print "found colon, and it's not address - ignoring it", newKey
                     else:
                         # Add new key to the address object, and assign the
-                        # value to the key
-                        address[newKey] = tag.attrib['v']
-                        # Clean the Address
-                        if newKey == "street":
-                            clean_name = update_streetname(tag.attrib['v'], map_old_to_new)
-                            address[newKey] = clean_name
-
-                        # Clean the postcode
-                        if newKey == "postcode":
-                            clean_zip = update_zipcode(tag.attrib['v'] )
-                            address[newKey] = clean_zip
-
-                        # Clean the state, assume all states should be AK
-                        if newKey == "state":
-                            if  tag.attrib['v'] != "AK":
-                                 address[newKey] = "AK"
-
-                        # clean the city name
-                        if newKey == "city":
-                            clean_city = update_city(tag.attrib['v'])
-                            address[newKey] = clean_city
+                        # cleaned value to the key, the street, postcode,
+                        # state and city rules of the region are in
+                        # regions/<region>.json, see addressrules.py
+                        address[newKey] = clean_address(newKey, tag.attrib['v'])
 
                 # we have a generic tag item with no colon, to be added root on the node/way object
                 elif tag.attrib['k'].count(":") < 1:
                     plainKey = tag.attrib['k']
+                    # Every relation has a "type" tag, keep it from
+                    # replacing the element type
+                    if plainKey == "type" and element.tag == "relation":
+                        plainKey = "relation_type"
                     #print "Plain KEY", tag.attrib['k'], tag.attrib['v']
                     node[plainKey] = tag.attrib['v']
 
@@ -214,6 +140,15 @@ def shape_element(element):
         if len(node_refs) > 0:
             node['node_refs'] = node_refs
 
+        # The members of a relation, in order, with their type and role
+        if element.tag == "relation":
+            members = []
+            for member in element.iter("member"):
+                members.append({"type": member.attrib.get('type'),
+                                "ref": member.attrib.get('ref'),
+                                "role": member.attrib.get('role', "")})
+            node['members'] = members
+
         # Check to see if we have any addresses, if we have addresses add the addresses to the node
         if len(address)>0:
             node['address'] = address
@@ -223,88 +158,235 @@ def shape_element(element):
         return None
 
 
-def is_valid_tag(element):
+def shape_attributes(element, node):
     '''
-    Check for Valid Tags and return true for valid tags false for invalid
+    Copy the attributes of the node/way element into the node dictionary,
+    the CREATED attributes go into node['created'] and lat, lon into node['pos']
     '''
-    isValid = True
-    if problemchars.search(element.attrib['k']):
-        isValid = False
+    for k,v in element.attrib.iteritems():
+        # CREATE VALUES {"version", "changeset", "timestamp", "user", "uid"}
+        # The timestamp becomes a datetime, see IterativeParsing/timestamps.py
+        if k in CREATED:
+            node['created'][k] = to_date(v) if k == "timestamp" else v
+
+        # Lat is in first position, Lon second position
+        # In JSON and mongodb we need to represent the Lat and Lon as floats
+        elif k in POSITION:
+            if k=="lat":
+                node['pos'][0]=(float(v))
+            else: # Lon
+                node['pos'][1]=(float(v))
+        # Key was not in the CREATED or POSITION dictionary
+        # Add a new key value pair
+        else:
+            node[k] = v
 
-    else:  # Count all the others as valid
-         isValid = True
 
-    return isValid
+def is_valid_tag(element):
+    '''
+    Check for Valid Tags and return true for valid tags false for invalid
+    The verdict on each distinct key is remembered, see keyclass.py
+    '''
+    return is_valid_key(element.attrib['k'])
 
-def process_map(file_in, pretty = False):
+def iter_shaped(file_in, max_rss_mb = None, profile = None, clip = None, select = None,
+                elements = None):
+    '''
+    Generator version of process_map, yields the shaped node/way/relation
+    dictionaries one at a time and keeps none of them
+    profile is an optional StageProfile, the parse time is added to it
+    clip is an optional clip.Clip, the elements it does not keep are
+    skipped before they are shaped
+    select is an optional filter spec, see filters.py, the elements it
+    does not match are skipped before they are shaped as well
+    elements are the (event, element) pairs to shape instead of those of
+    file_in, a resumable run passes what comes after its checkpoint
+    '''
+    if select is not None:
+        select = element_filter(select)
+    if elements is None:
+        elements = iter_elements(file_in, max_rss_mb=max_rss_mb)
+    if profile is not None:
+        elements = profile.timed_iter("parse", elements)
+    if clip is not None:
+        clip.reset()
+    for _, element in elements:
+        if clip is not None and not clip.keep(element):
+            continue
+        if select is not None and not select.keep(element):
+            continue
+        el = shape_element(element)
+        if el:
+            yield el
+
+def process_map(file_in, pretty = False, max_rss_mb = None, keep_data = True,
+                compression = None, profile = False, compact = False,
+                geometry = False, member_index = False, clip = None,
+                select = None, columns = False, resume = None,
+                checkpoint_bytes = CHECKPOINT_BYTES,
+                checkpoint_elements = CHECKPOINT_ELEMENTS):
     '''
     Process map reads in the OpenStreet Map file
     and writes out to file the JSON data structure
     file_in is the path and filename, pretty parameter formats the json
+    max_rss_mb is the optional memory ceiling in megabytes, each element
+    is released from the parser as soon as it has been shaped
+
+    With keep_data=False the shaped elements are only written to the file,
+    not kept in memory, and the summary counts are returned instead of the
+    list, see new_summary
+
+    compression is None, "gzip", "bz2" or "zstd", the output file gets
+    the matching extension, see sinks.py
+
+    profile=True times each stage of the pipeline (parsing, shape_element,
+    the cleaners, json) and prints the breakdown at the end, see stageprof.py
+
+    compact=True keeps NodeRecord/WayRecord objects in the returned list
+    instead of dictionaries, a fraction of the memory on a large file,
+    record.to_dict() gives the dictionary back, see records.py
+
+    geometry=True reads the file twice, the first pass writes the node
+    coordinates to file_in.nodes, the second adds the [lat, lon] of each
+    node of a way in node_pos, see nodeindex.py
+
+    member_index=True writes the reverse index of the relation members,
+    member to relation ids, to file_in.members, see memberindex.py
+
+    clip is a clip.Clip of a bounding box or polygon, only the nodes
+    inside it and the ways and relations that use them are shaped and
+    written, see clip.py
+
+    select is a filter spec of the element types and tags to keep, a
+    dictionary, a JSON file or a preset name like "amenities", checked on
+    each element before it is shaped, see filters.py
+
+    columns=True also writes the nodes to file_in.columns, a directory of
+    NumPy .npy arrays of id, lat, lon, version, changeset, uid, timestamp
+    and the tags, memory mapped by columns.ColumnStore, needs numpy
+
+    resume=False or True writes the output in pieces with a checkpoint
+    after each one, checkpoint_bytes of plain XML input or
+    checkpoint_elements elements of compressed input. resume=True carries
+    on from the checkpoint of a run that did not finish, resume=False
+    starts over. Needs keep_data=False and no bz2 output, see resumable.py
     '''
 
     # Keep the same filename and just append .json to the filename
     file_out = "{0}.2.json".format(file_in)
     data = []
-    with codecs.open(file_out, "w") as fo:
-        # Go element by element to read the file
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-
-            # If we have an element add it to the dictionary
-            # and write the data to a file
-            if el:
-                data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
+    # Intern table of the compact records, one copy of each key and value
+    strings = {}
+    checkpoint = None
+    if resume is not None:
+        if keep_data:
+            raise ValueError("a resumable run keeps no data, use keep_data=False")
+        if compression == "bz2":
+            raise ValueError("bz2 output can not be resumed, use gzip or zstd")
+        # What the checkpoint has to agree with to be resumed from
+        settings = {"pretty": pretty, "compression": compression, "geometry": geometry,
+                    "member_index": member_index, "columns": columns,
+                    "clip": clip is not None,
+                    "select": select if isinstance(select, (basestring, dict)) else select is not None}
+        checkpoint = Checkpoint(file_in, output_name(file_out, compression), settings,
+                                resume, checkpoint_bytes, checkpoint_elements)
+    resumed = checkpoint is not None and checkpoint.resumed
+    position = checkpoint.position if resumed else lambda name: None
+    stages = StageProfile() if profile else None
+    nodes = NodeIndex(node_index_for(file_in, max_rss_mb)) if geometry else None
+    members = MemberIndexWriter("{0}.members".format(file_in), resumable=checkpoint is not None,
+                                resume_from=position("members")) if member_index else None
+    store = ColumnWriter("{0}.columns".format(file_in), resumable=checkpoint is not None,
+                         resume_from=position("columns")) if columns else None
+    elements = None
+    if checkpoint is not None:
+        elements = checkpoint.elements(max_rss_mb, clip.keep if clip is not None else None)
+    if resumed:
+        # Drop what the dead run wrote after its checkpoint
+        truncate(output_name(file_out, compression), position("output"))
+    try:
+        with JsonSink(file_out, pretty, compression, append=resumed) as fo, \
+             instrument(sys.modules[__name__], stages):
+            summary = position("summary") or new_summary(fo.file_out)
+            if checkpoint is not None:
+                checkpoint.add_part("output", fo.checkpoint)
+                checkpoint.add_part("summary", lambda: summary)
+                if members is not None:
+                    checkpoint.add_part("members", members.checkpoint)
+                if store is not None:
+                    checkpoint.add_part("columns", store.checkpoint)
+            if stages is not None:
+                fo.encode = stages.wrap("json", fo.encode)
+            # Go element by element to read the file
+            for el in iter_shaped(file_in, max_rss_mb, stages, clip, select, elements):
+                if nodes is not None:
+                    add_geometry(el, nodes)
+                if members is not None:
+                    members.add(el)
+                if store is not None:
+                    store.add(el)
+                # If we have an element add it to the dictionary
+                # and write the data to a file
+                if keep_data and compact:
+                    data.append(to_record(el, strings))
+                elif keep_data:
+                    data.append(el)
                 else:
-                    fo.write(json.dumps(el) + "\n")
-    return data
-
-def update_streetname(name, map_old_to_new):
+                    add_to_summary(summary, el)
+                fo.write(el)
+        if members is not None:
+            members.close()
+        if store is not None:
+            store.close()
+        if checkpoint is not None:
+            checkpoint.done()
+    finally:
+        if nodes is not None:
+            nodes.close()
+        if members is not None:
+            members.abort()
+        if store is not None:
+            store.abort()
+    if stages is not None:
+        stages.report()
+    if keep_data:
+        return data
+    return summary
+
+def new_summary(file_out):
     '''
-    Update name compares current name to the map of bad values to good values
-    and provides the updated name back to the method
+    Summary counts of a streamed run
+    {"file_out": "Alaska.xml.2.json", "elements": 5, "node": 3, "way": 1, "relation": 1}
     '''
-    for iName in map_old_to_new.keys():
-        #Check to see if we find a match for a bad value in our map
-        match = re.search(iName, name)
-        #if match is found then remap the old value with new value
-        if match:
-            name = re.sub(iName+'$', map_old_to_new[iName], name)
-    return name
+    return {"file_out": file_out, "elements": 0, "node": 0, "way": 0, "relation": 0}
 
+def add_to_summary(summary, el):
+    '''Count one shaped element in the summary'''
+    summary["elements"] += 1
+    summary[el["type"]] = summary.get(el["type"], 0) + 1
 
-def update_zipcode(zipcode):
-    '''
-        Clean the zip code
-
-        These are a few of the errors one might encounter
-        { "_id" : "Homer, AK 99603", "count" : 2 }
-        { "_id" : "AK", "count" : 1 }
-        { "_id" : "Alaska", "count" : 1 }
-        { "_id" : "AK 99501-2129", "count" : 1 }
-        { "_id" : "AK 99501-2118", "count" : 1 }
-    '''
-    # use regex to remove all strings from zipcode, this
-    # will leave us with a numeric number which should be
-    # 5 or 9 characters long
-    zipcode_clean = re.sub(r"\D", "", zipcode)
+def merge_summary(summary, other):
+    '''Add the counts of other into summary, for runs made of several parts'''
+    for k, v in other.iteritems():
+        if k != "file_out":
+            summary[k] = summary.get(k, 0) + v
+    return summary
 
-    return zipcode_clean
+# The region whose address rules shape_element applies, see use_region
+REGION = "AK"
+address_rules = rules_for(REGION)
 
-
-def update_city(cityname):
+def use_region(region):
     '''
-        TODO
-        Scan the dictionary of city names and
-        fix bad spellings, improve alogrithim over time
+    Clean the addresses with the rules of regions/<region>.json, or of a
+    rules file, from now on. Parallel workers started afterwards inherit it
     '''
-    if cityname == "Anchoage":
-        cityname = "Anchorage"
-
-    return cityname
+    global address_rules
+    address_rules = rules_for(region)
 
+def clean_address(field, value):
+    '''The value of addr:<field> cleaned by the rules of the region'''
+    return address_rules.clean(field, value)
 
 def test():
     # NOTE: if you are running this code on your computer, with a larger dataset,
@@ -312,6 +394,7 @@ def test():
     # additional spaces to the output, making it significantly larger.
     data = process_map('Alaska_Small.xml', False)
     pprint.pprint(len(data))
+    pprint.pprint(address_rules.stats())
     print "DONE"
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pick the elements to shape before shaping them
+
+A job that only wants the amenities still has shape_element build the
+dictionary of every node and way, clean its street names and encode it
+before we throw it away. process_map(select=...) takes a filter spec,
+compiles it once and runs it on the element straight from the parser:
+
+    {"types": ["node", "way"],
+     "include": [{"key": "amenity"}],
+     "exclude": [{"key": "amenity", "value": ["parking", "bench"]}]}
+
+    types     element types kept, node, way and/or relation, all of them
+              when left out
+    include   rules, an element is kept when any of them matches, every
+              element when left out
+    exclude   rules, an element is dropped when any of them matches
+
+A rule matches when all of its conditions hold for the tags of the element:
+
+    "key": "building"                 has this tag, "keys" for a list of them
+    "prefix": "addr:"                 has a key starting with this, or any of
+                                      a list of prefixes
+    "value": "^(yes|house)$"          with "key", its value matches this
+                                      regular expression (re.search)
+    "value": ["yes", "house"]         with "key", its value is one of these
+    "values": {"shop": "^super"}      value conditions of several keys
+
+    {"types": ["way"], "include": [{"key": "building", "prefix": "addr:"}]}
+
+keeps the buildings with an address. A spec can be a dictionary, a JSON
+file of one or the name of one of PRESETS.
+
+Filtering on tags drops the untagged nodes of the ways kept, their node_refs
+point at nodes that are not in the output. geometry=True still adds their
+coordinates, the node index is built from the whole file.
+"""
+import json
+import os
+import re
+
+TOP_LEVEL = ("node", "way", "relation")
+
+RULE_FIELDS = ("key", "keys", "prefix", "value", "values")
+
+PRESETS = {
+    "amenities": {"types": ["node", "way"], "include": [{"key": "amenity"}]},
+    "addressed_buildings": {"types": ["way", "relation"],
+                            "include": [{"key": "building", "prefix": "addr:"}]},
+    "addresses": {"include": [{"prefix": "addr:"}]},
+    "highways": {"types": ["way"], "include": [{"key": "highway"}]},
+}
+
+
+def compile_value(pattern):
+    '''A test on a tag value, a list is a set of values, a string a regex'''
+    if isinstance(pattern, (list, tuple, set)):
+        return frozenset(pattern).__contains__
+    return re.compile(pattern).search
+
+
+class Rule(object):
+    '''One compiled include or exclude rule'''
+    def __init__(self, rule):
+        unknown = set(rule) - set(RULE_FIELDS)
+        if unknown:
+            raise ValueError("unknown filter rule field {0}, use {1}".format(
+                ", ".join(sorted(unknown)), ", ".join(RULE_FIELDS)))
+        keys = list(rule.get("keys", []))
+        values = dict(rule.get("values", {}))
+        if "key" in rule:
+            keys.append(rule["key"])
+            if "value" in rule:
+                values[rule["key"]] = rule["value"]
+        elif "value" in rule:
+            raise ValueError("filter rule {0!r} has a value but no key".format(rule))
+        prefix = rule.get("prefix")
+        self.keys = tuple(keys)
+        self.prefixes = (prefix,) if isinstance(prefix, basestring) else tuple(prefix or ())
+        self.values = [(k, compile_value(p)) for k, p in values.iteritems()]
+        if not (self.keys or self.prefixes or self.values):
+            raise ValueError("filter rule {0!r} has no condition".format(rule))
+
+    def matches(self, tags):
+        for k in self.keys:
+            if k not in tags:
+                return False
+        if self.prefixes:
+            prefixes = self.prefixes
+            for k in tags:
+                if k.startswith(prefixes):
+                    break
+            else:
+                return False
+        for k, test in self.values:
+            v = tags.get(k)
+            if v is None or not test(v):
+                return False
+        return True
+
+
+class ElementFilter(object):
+    '''A compiled filter spec, see the module docstring'''
+    def __init__(self, spec):
+        unknown = set(spec) - set(("types", "include", "exclude"))
+        if unknown:
+            raise ValueError("unknown filter field {0}, use types, include and exclude".format(
+                ", ".join(sorted(unknown))))
+        types = spec.get("types")
+        if types is not None:
+            bad = set(types) - set(TOP_LEVEL)
+            if bad:
+                raise ValueError("unknown element type {0}".format(", ".join(sorted(bad))))
+        self.types = frozenset(types if types is not None else TOP_LEVEL)
+        self.include = [Rule(rule) for rule in spec.get("include", [])]
+        self.exclude = [Rule(rule) for rule in spec.get("exclude", [])]
+
+    def keep(self, element):
+        '''True when the node, way or relation element is to be shaped'''
+        if element.tag not in self.types:
+            return False
+        if not self.include and not self.exclude:
+            return True
+        tags = {}
+        for tag in element.iter("tag"):
+            attrib = tag.attrib
+            tags[attrib.get("k")] = attrib.get("v")
+        if self.include:
+            for rule in self.include:
+                if rule.matches(tags):
+                    break
+            else:
+                return False
+        for rule in self.exclude:
+            if rule.matches(tags):
+                return False
+        return True
+
+
+def element_filter(spec):
+    '''
+    The ElementFilter of spec, a dictionary, the name of a preset, a JSON
+    file or an ElementFilter already
+    '''
+    if isinstance(spec, ElementFilter):
+        return spec
+    if isinstance(spec, basestring):
+        if spec in PRESETS:
+            spec = PRESETS[spec]
+        elif os.path.exists(spec):
+            with open(spec) as f:
+                spec = json.load(f)
+        else:
+            raise ValueError("{0!r} is not a filter preset ({1}) or a file".format(
+                spec, ", ".join(sorted(PRESETS))))
+    return ElementFilter(spec)
+
+
+def test():
+    from xml.etree.ElementTree import Element, SubElement
+    way = Element("way", id="1")
+    SubElement(way, "tag", k="building", v="yes")
+    SubElement(way, "tag", k="addr:street", v="Main St")
+    for name in sorted(PRESETS):
+        print name, element_filter(name).keep(way)
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
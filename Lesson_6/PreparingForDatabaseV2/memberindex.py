@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Which relations is a node, way or relation a member of
+
+A relation lists its members, the other way round ("which routes use this
+way", "which boundaries hold this node") means reading every relation.
+MemberIndexWriter takes the shaped relations as process_map writes them
+and builds the reverse index on disk:
+
+    (member type, member id, relation id)
+
+records of 17 bytes, sorted so all the relations of a member are next to
+each other. MemberIndex maps the file and finds them by binary search:
+
+    with MemberIndex("Alaska.xml.members") as members:
+        members.relations_of("way", 209809850)    # [1234, 5678]
+
+The sorting is done on disk with nodeindex.sort_records, so a large
+extract needs no more memory than a small one.
+"""
+from bisect import bisect_left
+import mmap
+import os
+import shutil
+import struct
+from nodeindex import FENCE_EVERY, IO_RECORDS, sort_records, truncate
+
+# member type, member id, relation id
+MEMBER = struct.Struct("<Bqq")
+MEMBER_KEY = struct.Struct("<Bq")
+
+MEMBER_TYPES = ["node", "way", "relation"]
+TYPE_CODES = dict((t, i) for i, t in enumerate(MEMBER_TYPES))
+
+
+class MemberIndexWriter(object):
+    '''
+    Collect the members of the relations added and write the sorted index
+    to index_file on close. With sort=False the records are left as they
+    came, for merge_member_parts to sort once for all the parts.
+    A resumable writer keeps its records when the run fails, resume_from
+    is the number of records of a checkpoint to carry on from, see
+    resumable.py
+    '''
+    def __init__(self, index_file, sort=True, resumable=False, resume_from=None):
+        self.index_file = index_file
+        self.sort = sort
+        self.resumable = resumable or resume_from is not None
+        self.unsorted = index_file + ".tmp" if sort else index_file
+        if resume_from is None:
+            self.f = open(self.unsorted, "wb")
+            self.count = 0
+        else:
+            truncate(self.unsorted, resume_from * MEMBER.size)
+            self.f = open(self.unsorted, "ab")
+            self.count = resume_from
+        self.buf = []
+
+    def add(self, el):
+        '''Add the members of a shaped relation, anything else is skipped'''
+        members = el.get("members")
+        if not members:
+            return
+        try:
+            relation_id = int(el["id"])
+        except (KeyError, TypeError, ValueError):
+            return
+        for member in members:
+            code = TYPE_CODES.get(member.get("type"))
+            try:
+                ref = int(member.get("ref"))
+            except (TypeError, ValueError):
+                continue
+            if code is None:
+                continue
+            self.buf.append(MEMBER.pack(code, ref, relation_id))
+        if len(self.buf) >= IO_RECORDS:
+            self.flush()
+
+    def flush(self):
+        self.count += len(self.buf)
+        self.f.write("".join(self.buf))
+        del self.buf[:]
+
+    def checkpoint(self):
+        '''Write the records so far to disk, returns their number'''
+        self.flush()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.count
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.close()
+        self.f = None
+        if self.sort:
+            try:
+                sort_records(self.unsorted, self.index_file, record=MEMBER)
+            finally:
+                os.remove(self.unsorted)
+
+    def abort(self):
+        '''Drop what was written unless resumable, does nothing after close'''
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        if not self.resumable:
+            os.remove(self.unsorted)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def merge_member_parts(parts, index_file):
+    '''Sort the unsorted part files of a parallel run into index_file'''
+    unsorted = index_file + ".tmp"
+    with open(unsorted, "wb") as out:
+        for part in parts:
+            with open(part, "rb") as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part)
+    try:
+        sort_records(unsorted, index_file, record=MEMBER)
+    finally:
+        os.remove(unsorted)
+    return index_file
+
+
+class MemberIndex(object):
+    '''Read only view of a member index file'''
+    def __init__(self, index_file):
+        self.f = open(index_file, "rb")
+        self.count = os.fstat(self.f.fileno()).st_size // MEMBER.size
+        self.mm = None
+        self.fence = []
+        if self.count:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.fence = [self.key(i) for i in xrange(0, self.count, FENCE_EVERY)]
+
+    def key(self, i):
+        return MEMBER_KEY.unpack_from(self.mm, i * MEMBER.size)
+
+    def lower_bound(self, key):
+        '''First record at or after key'''
+        block = max(bisect_left(self.fence, key) - 1, 0)
+        lo = block * FENCE_EVERY
+        hi = min(lo + FENCE_EVERY, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def relations_of(self, member_type, ref):
+        '''Ids of the relations member_type ref is a member of, in id order'''
+        code = TYPE_CODES.get(member_type)
+        if code is None:
+            raise ValueError("unknown member type {0!r}, one of {1}".format(
+                member_type, ", ".join(MEMBER_TYPES)))
+        if not self.count:
+            return []
+        key = (code, int(ref))
+        relations = []
+        i = self.lower_bound(key)
+        while i < self.count:
+            _, member_ref, relation_id = MEMBER.unpack_from(self.mm, i * MEMBER.size)
+            if (code, member_ref) != key:
+                break
+            # A member listed twice in the same relation is one hit
+            if not relations or relations[-1] != relation_id:
+                relations.append(relation_id)
+            i += 1
+        return relations
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def test():
+    with MemberIndexWriter("members.test") as writer:
+        writer.add({"type": "relation", "id": "20",
+                    "members": [{"type": "way", "ref": "10", "role": "outer"},
+                                {"type": "node", "ref": "2", "role": ""}]})
+        writer.add({"type": "relation", "id": "21",
+                    "members": [{"type": "way", "ref": "10", "role": "inner"}]})
+    with MemberIndex("members.test") as members:
+        print members.relations_of("way", 10), members.relations_of("node", 2)
+    os.remove("members.test")
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
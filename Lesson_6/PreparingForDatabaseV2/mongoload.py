@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load the shaped data straight into MongoDB
+
+The write-up imports the .2.json file with mongoimport, which means writing
+the whole extract to disk and reading it back again. process_map_to_mongo
+feeds the shape_element output to a pool of insert threads instead, each
+batch goes in with one insert_many(ordered=False) over a shared, pooled
+MongoClient. Transient errors (lost connection, primary step down) are
+retried with a back off.
+
+load works with anything that has an insert_many(documents, ordered=False)
+method, so it can be tested with mongomock or a small fake collection
+instead of a running mongod.
+
+pymongo is only needed to connect to a real server:
+    pip install pymongo
+"""
+import Queue
+import threading
+import time
+import data
+
+try:
+    import pymongo
+    from pymongo.errors import AutoReconnect
+    # NetworkTimeout and ServerSelectionTimeoutError are AutoReconnect too
+    TRANSIENT_ERRORS = (AutoReconnect,)
+except ImportError:
+    pymongo = None
+    TRANSIENT_ERRORS = ()
+
+MONGO_URI = "mongodb://localhost:27017"
+
+# Documents per insert_many call
+BATCH_SIZE = 1000
+
+# Number of insert threads, also the size of the connection pool
+WORKERS = 4
+
+# Number of times a batch is retried after a transient error, the wait
+# doubles after each try starting at RETRY_DELAY seconds
+RETRIES = 5
+RETRY_DELAY = 0.5
+
+# Duplicate key error code
+DUPLICATE_KEY = 11000
+
+
+def connect(uri=MONGO_URI, db="osm", collection="alaska", pool_size=WORKERS):
+    '''Return the collection on a client with a connection pool of pool_size'''
+    if pymongo is None:
+        raise ImportError("pymongo is needed to connect to MongoDB, pip install pymongo")
+    client = pymongo.MongoClient(uri, maxPoolSize=pool_size)
+    return client[db][collection]
+
+
+def is_duplicate_only(error):
+    '''True when every write error of a bulk write error is a duplicate key'''
+    details = getattr(error, "details", None) or {}
+    write_errors = details.get("writeErrors")
+    if not write_errors or details.get("writeConcernErrors"):
+        return False
+    for write_error in write_errors:
+        if write_error.get("code") != DUPLICATE_KEY:
+            return False
+    return True
+
+
+def insert_batch(collection, batch, retries=RETRIES, delay=RETRY_DELAY, transient=None):
+    '''
+    Insert one batch with insert_many(ordered=False), retrying transient
+    errors. Returns the number of documents in the batch.
+
+    insert_many sets the _id of each document in place, so a retry sends
+    the same ids again. Duplicate key errors after a retry are the
+    documents the failed attempt had already written and are ignored.
+    '''
+    if transient is None:
+        transient = TRANSIENT_ERRORS
+    attempt = 0
+    while True:
+        try:
+            collection.insert_many(batch, ordered=False)
+            return len(batch)
+        except transient:
+            if attempt >= retries:
+                raise
+            time.sleep(delay * (2 ** attempt))
+            attempt += 1
+        except Exception as e:
+            if attempt > 0 and is_duplicate_only(e):
+                return len(batch)
+            raise
+
+
+def iter_batches(docs, batch_size=BATCH_SIZE):
+    '''Group the documents into lists of batch_size'''
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load(docs, collection, batch_size=BATCH_SIZE, workers=WORKERS,
+         retries=RETRIES, delay=RETRY_DELAY, transient=None):
+    '''
+    Insert the documents into the collection in batches on workers threads
+    Returns the number of documents inserted, the first insert error stops
+    the load and is raised again here
+    '''
+    if workers <= 1:
+        inserted = 0
+        for batch in iter_batches(docs, batch_size):
+            inserted += insert_batch(collection, batch, retries, delay, transient)
+        return inserted
+
+    # Bounded queue, the parser never gets more than a few batches ahead
+    # of the inserts
+    batches = Queue.Queue(maxsize=workers * 2)
+    lock = threading.Lock()
+    counts = [0]
+    errors = []
+
+    def worker():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if errors:
+                continue
+            try:
+                n = insert_batch(collection, batch, retries, delay, transient)
+                with lock:
+                    counts[0] += n
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for batch in iter_batches(docs, batch_size):
+            if errors:
+                break
+            batches.put(batch)
+    finally:
+        for t in threads:
+            batches.put(None)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return counts[0]
+
+
+def process_map_to_mongo(file_in, collection=None, batch_size=BATCH_SIZE,
+                         workers=WORKERS, max_rss_mb=None):
+    '''
+    Shape the OSM file and insert it into MongoDB without writing the
+    .2.json file. collection defaults to osm.alaska on the local server.
+    Returns the summary counts like data.process_map with keep_data=False
+    '''
+    if collection is None:
+        collection = connect(pool_size=workers)
+    summary = data.new_summary(None)
+    # Nothing is written to disk
+    del summary["file_out"]
+
+    def counted():
+        for el in data.iter_shaped(file_in, max_rss_mb):
+            data.add_to_summary(summary, el)
+            yield el
+
+    summary["inserted"] = load(counted(), collection, batch_size, workers)
+    return summary
+
+
+def test():
+    summary = process_map_to_mongo('Alaska_Small.xml')
+    print summary
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Node coordinates on disk, to give the ways their geometry
+
+shape_element writes a way as a list of node ids, to draw it we need the
+lat and lon of each of those nodes. Holding every node of a state extract
+in a dictionary does not fit in memory, so this takes two passes:
+
+    1. build_node_index reads the nodes and writes (id, lat, lon) records
+       of 24 bytes each to a file, sorted by id. An extract is usually in
+       id order already, when it is not the file is sorted in runs on disk
+       and merged.
+    2. NodeIndex maps the file into memory and finds the coordinates of a
+       node by its position when the ids have no gaps, by binary search
+       otherwise. Only the pages of the file we touch are read, the
+       operating system keeps the busy ones cached.
+
+add_geometry then adds the positions of the nodes of a way next to its
+node_refs, in the same order and as [lat, lon] like pos, None for a node
+that is not in the file:
+
+    "node_refs": ["2199822281", "2199822390"],
+    "node_pos": [[61.2176, -149.8997], [61.2180, -149.8991]]
+"""
+from array import array
+from bisect import bisect_right
+import heapq
+import mmap
+import os
+import struct
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements
+from records import REF_TYPECODE
+
+# id, lat, lon of one node
+RECORD = struct.Struct("<qdd")
+NODE_ID = struct.Struct("<q")
+COORDS = struct.Struct("<dd")
+
+# Keep the id of every FENCE_EVERY'th record in memory, a lookup bisects
+# those and then searches FENCE_EVERY records of the file
+FENCE_EVERY = 256
+
+# Records sorted in memory at a time when the nodes are out of order
+SORT_RECORDS = 500000
+
+# Records written or read per call
+IO_RECORDS = 4096
+
+
+def replace(src, dst):
+    '''os.rename that also overwrites on windows'''
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def truncate(filename, size):
+    '''Cut filename back to size bytes, what a dead run wrote after its checkpoint'''
+    if not os.path.exists(filename) or os.path.getsize(filename) < size:
+        raise ValueError("{0} is shorter than its checkpoint".format(filename))
+    with open(filename, "r+b") as f:
+        f.truncate(size)
+
+
+def build_node_index(file_in, index_file=None, max_rss_mb=None):
+    '''
+    Pass one, write the id, lat and lon of every node of file_in to
+    index_file, file_in.nodes by default, sorted by id
+    Returns the name of the index file
+    '''
+    if index_file is None:
+        index_file = "{0}.nodes".format(file_in)
+    unsorted = index_file + ".tmp"
+    in_order = True
+    last = None
+    with open(unsorted, "wb") as f:
+        buf = []
+        for _, elem in iter_elements(file_in, max_rss_mb=max_rss_mb):
+            if elem.tag != "node":
+                continue
+            attrib = elem.attrib
+            try:
+                node_id = int(attrib["id"])
+                lat = float(attrib["lat"])
+                lon = float(attrib["lon"])
+            except (KeyError, ValueError):
+                continue
+            if last is not None and node_id < last:
+                in_order = False
+            last = node_id
+            buf.append(RECORD.pack(node_id, lat, lon))
+            if len(buf) >= IO_RECORDS:
+                f.write("".join(buf))
+                del buf[:]
+        f.write("".join(buf))
+    if in_order:
+        replace(unsorted, index_file)
+    else:
+        try:
+            sort_records(unsorted, index_file)
+        finally:
+            os.remove(unsorted)
+    return index_file
+
+
+def node_index_for(file_in, max_rss_mb=None):
+    '''The index of file_in, built unless there is one newer than the file'''
+    index_file = "{0}.nodes".format(file_in)
+    if not os.path.exists(index_file) or \
+       os.path.getmtime(index_file) < os.path.getmtime(file_in):
+        build_node_index(file_in, index_file, max_rss_mb)
+    return index_file
+
+
+def read_records(f, record=RECORD):
+    '''Yield the records of an open index file, (id, lat, lon) by default'''
+    size = record.size
+    while True:
+        buf = f.read(IO_RECORDS * size)
+        if not buf:
+            return
+        for i in xrange(0, len(buf) - size + 1, size):
+            yield record.unpack_from(buf, i)
+
+
+def write_records(f, records, record=RECORD):
+    buf = []
+    for values in records:
+        buf.append(record.pack(*values))
+        if len(buf) >= IO_RECORDS:
+            f.write("".join(buf))
+            del buf[:]
+    f.write("".join(buf))
+
+
+def sort_records(unsorted, index_file, chunk=SORT_RECORDS, record=RECORD):
+    '''
+    External sort: sort chunk records at a time into run files, then merge
+    the runs into index_file. The records sort as tuples, by their first
+    field, then the second ...
+    '''
+    size = record.size
+    runs = []
+    try:
+        with open(unsorted, "rb") as f:
+            while True:
+                buf = f.read(chunk * size)
+                if not buf:
+                    break
+                records = [record.unpack_from(buf, i)
+                           for i in xrange(0, len(buf) - size + 1, size)]
+                records.sort()
+                run = "{0}.run{1:05d}".format(index_file, len(runs))
+                runs.append(run)
+                with open(run, "wb") as out:
+                    write_records(out, records, record)
+        files = [open(run, "rb") for run in runs]
+        try:
+            with open(index_file, "wb") as out:
+                write_records(out, heapq.merge(*[read_records(f, record) for f in files]),
+                              record)
+        finally:
+            for f in files:
+                f.close()
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+
+class NodeIndex(object):
+    '''
+    Read only view of an index file
+    get(node_id) returns (lat, lon), None when the node is not there
+    '''
+    def __init__(self, index_file):
+        self.f = open(index_file, "rb")
+        self.count = os.fstat(self.f.fileno()).st_size // RECORD.size
+        self.mm = None
+        self.first = None
+        self.fence = array(REF_TYPECODE)
+        if self.count:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.first = self.node_id(0)
+            self.fence.extend(self.node_id(i) for i in xrange(0, self.count, FENCE_EVERY))
+        # No gaps between the first and the last id, the record of a node
+        # is at node_id - first
+        self.dense = bool(self.count) and \
+            self.node_id(self.count - 1) - self.first + 1 == self.count
+
+    def node_id(self, i):
+        return NODE_ID.unpack_from(self.mm, i * RECORD.size)[0]
+
+    def position(self, node_id):
+        '''Record number of node_id, None when it is not in the index'''
+        if not self.count:
+            return None
+        if self.dense:
+            i = node_id - self.first
+            if 0 <= i < self.count and self.node_id(i) == node_id:
+                return i
+        block = bisect_right(self.fence, node_id) - 1
+        if block < 0:
+            return None
+        lo = block * FENCE_EVERY
+        hi = min(lo + FENCE_EVERY, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.node_id(mid) < node_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.node_id(lo) == node_id:
+            return lo
+        return None
+
+    def get(self, node_id):
+        i = self.position(node_id)
+        if i is None:
+            return None
+        return COORDS.unpack_from(self.mm, i * RECORD.size + NODE_ID.size)
+
+    def locate(self, refs):
+        '''[lat, lon] of each ref, the refs are id strings as in node_refs'''
+        out = []
+        for ref in refs:
+            try:
+                coords = self.get(int(ref))
+            except ValueError:
+                coords = None
+            out.append(list(coords) if coords is not None else None)
+        return out
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def add_geometry(el, nodes):
+    '''Pass two, add node_pos to a shaped way from the NodeIndex nodes'''
+    refs = el.get("node_refs")
+    if refs:
+        el["node_pos"] = nodes.locate(refs)
+    return el
+
+
+def test():
+    index_file = build_node_index('Alaska_Small.xml')
+    with NodeIndex(index_file) as nodes:
+        print nodes.count, "nodes", "dense" if nodes.dense else "sparse"
+        print nodes.get(nodes.first)
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
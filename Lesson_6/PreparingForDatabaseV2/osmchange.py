@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Keep the shaped data current with the osmChange diffs
+
+Re-running process_map over the whole extract every day to pick up a few
+thousand edits takes hours. The daily (or minutely) .osc diffs list only
+what changed:
+
+    <osmChange version="0.6">
+      <create> <node id="..." .../> </create>
+      <modify> <way id="..."> ... </way> </modify>
+      <delete> <node id="..."/> </delete>
+    </osmChange>
+
+The created and modified elements go through the same shape_element as
+the full run and are applied to what the full run produced, either
+
+    apply_to_json   the .2.json file of process_map (pretty=False, not
+                    compressed). An index of the (type, id) of every line
+                    to its offset, file_out.idx, is built once and kept up
+                    to date. A changed element is blanked out with spaces
+                    where it was and written again at the end of the file,
+                    a deleted one is blanked. mongoimport skips the blank
+                    space, compact_json squeezes it out when it adds up.
+
+    apply_to_mongo  the collection loaded by mongoimport or
+                    mongoload.process_map_to_mongo, with ordered bulk
+                    writes of replace (upsert) and delete by type and id.
+
+Both return the number of elements created, modified and deleted.
+apply_to_json adds "missing", the modified or deleted elements that were
+not in the file, apply_to_mongo the "upserted" and "deleted" counts
+MongoDB reports.
+
+Ways are shaped without node_pos and the member index is not updated,
+run the full process_map to refresh those.
+"""
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from bisect import bisect_left
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import open_osm
+import data
+import mongoload
+from memberindex import TYPE_CODES
+from nodeindex import FENCE_EVERY, IO_RECORDS, read_records, replace, sort_records
+from records import shaped_kind
+from timestamps import json_default
+
+try:
+    from pymongo import DeleteOne, ReplaceOne
+except ImportError:
+    DeleteOne = ReplaceOne = None
+
+ACTIONS = ("create", "modify", "delete")
+
+# element type, id, offset and length of its line in the JSON file
+ENTRY = struct.Struct("<Bqqq")
+ENTRY_KEY = struct.Struct("<Bq")
+ENTRY_VALUE = struct.Struct("<qq")
+
+# Offset of a deleted element
+DELETED = -1
+
+# Fold the entries added since the last merge into the sorted index once
+# they are more than this share of it
+MERGE_RATIO = 0.1
+
+
+def iter_changes(osc_file):
+    '''
+    Yield (action, element) for each node, way and relation of the
+    osmChange file, action is "create", "modify" or "delete". Like
+    iter_elements each element is released once the caller is done with it.
+    '''
+    f = open_osm(osc_file)
+    try:
+        root = None
+        block = None
+        depth = 0
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                # <create>, <modify> or <delete>
+                if depth == 2:
+                    block = elem
+                continue
+            depth -= 1
+            if depth == 2:
+                yield block.tag, elem
+                elem.clear()
+                block.clear()
+            elif depth == 1:
+                root.clear()
+    finally:
+        f.close()
+
+
+def change_key(elem):
+    '''(type code, id) of an element of the diff, None for anything else'''
+    code = TYPE_CODES.get(elem.tag)
+    if code is None:
+        return None
+    try:
+        return code, int(elem.attrib["id"])
+    except (KeyError, ValueError):
+        return None
+
+
+def new_change_summary():
+    return {"create": 0, "modify": 0, "delete": 0, "missing": 0}
+
+
+class OffsetIndex(object):
+    '''
+    (type code, id) -> (offset, length) of the lines of the JSON file
+
+    index_file holds the entries sorted by key and is mapped into memory,
+    a changed offset is written over the old one in place. Keys that are
+    not in it are appended to index_file.new and kept in a dictionary,
+    they are merged into index_file on close once there are enough of them.
+    '''
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.new_file = index_file + ".new"
+        if not os.path.exists(index_file):
+            open(index_file, "wb").close()
+        self.f = open(index_file, "r+b")
+        self.count = os.fstat(self.f.fileno()).st_size // ENTRY.size
+        self.mm = None
+        self.fence = []
+        if self.count:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_WRITE)
+            self.fence = [self.key(i) for i in xrange(0, self.count, FENCE_EVERY)]
+        self.added = {}
+        if os.path.exists(self.new_file):
+            with open(self.new_file, "rb") as f:
+                for code, node_id, offset, length in read_records(f, ENTRY):
+                    self.added[(code, node_id)] = (offset, length)
+        self.new = open(self.new_file, "ab")
+
+    def key(self, i):
+        return ENTRY_KEY.unpack_from(self.mm, i * ENTRY.size)
+
+    def find(self, key):
+        '''Position of key in index_file, None when it is not there'''
+        if not self.count:
+            return None
+        block = max(bisect_left(self.fence, key) - 1, 0)
+        lo = block * FENCE_EVERY
+        hi = min(lo + FENCE_EVERY, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.key(lo) == key:
+            return lo
+        return None
+
+    def get(self, key):
+        '''(offset, length) of the line of key, None when there is none'''
+        value = self.added.get(key)
+        if value is None:
+            i = self.find(key)
+            if i is None:
+                return None
+            value = ENTRY_VALUE.unpack_from(self.mm, i * ENTRY.size + ENTRY_KEY.size)
+        if value[0] == DELETED:
+            return None
+        return value
+
+    def set(self, key, offset, length):
+        if key not in self.added:
+            i = self.find(key)
+            if i is not None:
+                ENTRY_VALUE.pack_into(self.mm, i * ENTRY.size + ENTRY_KEY.size, offset, length)
+                return
+        self.added[key] = (offset, length)
+        self.new.write(ENTRY.pack(key[0], key[1], offset, length))
+
+    def delete(self, key):
+        self.set(key, DELETED, 0)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+        self.f.close()
+        self.new.close()
+        if len(self.added) > self.count * MERGE_RATIO:
+            self.merge()
+
+    def merge(self):
+        '''Write index_file again with the added entries, without the deleted ones'''
+        merged = self.index_file + ".tmp"
+        added = sorted((k[0], k[1], v[0], v[1]) for k, v in self.added.iteritems())
+        with open(self.index_file, "rb") as base:
+            with open(merged, "wb") as out:
+                buf = []
+                for entry in merge_entries(read_records(base, ENTRY), added):
+                    if entry[2] != DELETED:
+                        buf.append(ENTRY.pack(*entry))
+                    if len(buf) >= IO_RECORDS:
+                        out.write("".join(buf))
+                        del buf[:]
+                out.write("".join(buf))
+        replace(merged, self.index_file)
+        os.remove(self.new_file)
+        self.added = {}
+
+
+def merge_entries(base, added):
+    '''Merge two key sorted streams of entries, the keys of base and added do not overlap'''
+    added = iter(added)
+    pending = next(added, None)
+    for entry in base:
+        while pending is not None and pending[:2] < entry[:2]:
+            yield pending
+            pending = next(added, None)
+        yield entry
+    while pending is not None:
+        yield pending
+        pending = next(added, None)
+
+
+def last_of_each(entries):
+    '''Keep the last of the sorted entries with the same key'''
+    previous = None
+    for entry in entries:
+        if previous is not None and previous[:2] != entry[:2]:
+            yield previous
+        previous = entry
+    if previous is not None:
+        yield previous
+
+
+def build_offset_index(file_out, index_file):
+    '''
+    Read the JSON file once and write the sorted index of its lines, an
+    element found more than once is indexed at its last line
+    '''
+    unsorted = index_file + ".tmp"
+    offset = 0
+    with open(file_out, "rb") as f:
+        with open(unsorted, "wb") as out:
+            buf = []
+            for line in f:
+                text = line.strip()
+                if text:
+                    try:
+                        el = json.loads(text)
+                        key = (TYPE_CODES[shaped_kind(el)], int(el["id"]))
+                    except (ValueError, KeyError, TypeError):
+                        raise ValueError("{0} is not one element per line, apply the changes to "
+                                         "the output of process_map with pretty=False".format(file_out))
+                    buf.append(ENTRY.pack(key[0], key[1], offset, len(line.rstrip("\r\n"))))
+                    if len(buf) >= IO_RECORDS:
+                        out.write("".join(buf))
+                        del buf[:]
+                offset += len(line)
+            out.write("".join(buf))
+    try:
+        sort_records(unsorted, unsorted + ".sorted", record=ENTRY)
+        with open(unsorted + ".sorted", "rb") as f:
+            with open(index_file, "wb") as out:
+                for entry in last_of_each(read_records(f, ENTRY)):
+                    out.write(ENTRY.pack(*entry))
+    finally:
+        for name in (unsorted, unsorted + ".sorted"):
+            if os.path.exists(name):
+                os.remove(name)
+    if os.path.exists(index_file + ".new"):
+        os.remove(index_file + ".new")
+    return index_file
+
+
+class JsonUpdater(object):
+    '''Replace, add and remove the lines of the .2.json file by type and id'''
+    def __init__(self, file_out, index_file=None):
+        with open(file_out, "rb") as f:
+            magic = f.read(4)
+        if magic[:3] == "BZh" or magic[:2] == "\x1f\x8b" or magic == "\x28\xb5\x2f\xfd":
+            raise ValueError("{0} is compressed, the changes can only be applied to "
+                             "an uncompressed JSON file".format(file_out))
+        if index_file is None:
+            index_file = "{0}.idx".format(file_out)
+        # The index is only good for the file it was built from
+        if not os.path.exists(index_file) or \
+           os.path.getmtime(index_file) < os.path.getmtime(file_out):
+            build_offset_index(file_out, index_file)
+        self.index_file = index_file
+        self.index = OffsetIndex(index_file)
+        self.f = open(file_out, "r+b")
+        self.f.seek(0, os.SEEK_END)
+        self.end = self.f.tell()
+        if self.end:
+            self.f.seek(-1, os.SEEK_END)
+            if self.f.read(1) != "\n":
+                self.f.write("\n")
+                self.end += 1
+        self.encode = json.JSONEncoder(default=json_default).encode
+        self.blanked = 0
+
+    def blank(self, key):
+        '''Overwrite the line of key with spaces, False when there is none'''
+        value = self.index.get(key)
+        if value is None:
+            return False
+        offset, length = value
+        self.f.seek(offset)
+        self.f.write(" " * length)
+        self.blanked += length
+        return True
+
+    def put(self, key, el):
+        '''Write el as the line of key, True when it replaced a line'''
+        replaced = self.blank(key)
+        line = self.encode(el)
+        self.f.seek(self.end)
+        self.f.write(line + "\n")
+        self.index.set(key, self.end, len(line))
+        self.end += len(line) + 1
+        return replaced
+
+    def delete(self, key):
+        '''Blank the line of key, True when there was one'''
+        if self.blank(key):
+            self.index.delete(key)
+            return True
+        return False
+
+    def close(self):
+        self.f.close()
+        self.index.close()
+        # Newer than the JSON file, so the next run trusts it
+        now = time.time()
+        for name in (self.index_file, self.index.new_file):
+            if os.path.exists(name):
+                os.utime(name, (now, now))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def apply_to_json(osc_file, file_out, index_file=None):
+    '''
+    Apply the osmChange file to the JSON file process_map wrote
+    Returns the counts of the changes, see new_change_summary
+    '''
+    summary = new_change_summary()
+    with JsonUpdater(file_out, index_file) as out:
+        for action, elem in iter_changes(osc_file):
+            key = change_key(elem)
+            if key is None or action not in ACTIONS:
+                continue
+            if action == "delete":
+                if not out.delete(key):
+                    summary["missing"] += 1
+            else:
+                el = data.shape_element(elem)
+                if el is None:
+                    continue
+                if not out.put(key, el) and action == "modify":
+                    summary["missing"] += 1
+            summary[action] += 1
+        summary["blanked_bytes"] = out.blanked
+    return summary
+
+
+def compact_json(file_out, index_file=None):
+    '''
+    Write the JSON file again without the blanked lines and drop its index,
+    the next apply_to_json builds it again
+    '''
+    if index_file is None:
+        index_file = "{0}.idx".format(file_out)
+    compacted = file_out + ".tmp"
+    with open(file_out, "rb") as f:
+        with open(compacted, "wb") as out:
+            for line in f:
+                if line.strip():
+                    out.write(line)
+    replace(compacted, file_out)
+    for name in (index_file, index_file + ".new"):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def iter_mongo_ops(osc_file, summary):
+    '''The bulk write operations of the osmChange file'''
+    for action, elem in iter_changes(osc_file):
+        if action not in ACTIONS or change_key(elem) is None:
+            continue
+        selector = {"type": elem.tag, "id": elem.attrib["id"]}
+        if action == "delete":
+            op = DeleteOne(selector)
+        else:
+            el = data.shape_element(elem)
+            if el is None:
+                continue
+            op = ReplaceOne(selector, el, upsert=True)
+        summary[action] += 1
+        yield op
+
+
+def write_batch(collection, ops, retries=mongoload.RETRIES, delay=mongoload.RETRY_DELAY,
+                transient=None):
+    '''
+    One ordered bulk_write, retrying transient errors. Replacing and
+    deleting by type and id gives the same result when done twice, so a
+    batch that failed half way is simply sent again.
+    '''
+    if transient is None:
+        transient = mongoload.TRANSIENT_ERRORS
+    attempt = 0
+    while True:
+        try:
+            return collection.bulk_write(ops, ordered=True)
+        except transient:
+            if attempt >= retries:
+                raise
+            time.sleep(delay * (2 ** attempt))
+            attempt += 1
+
+
+def apply_to_mongo(osc_file, collection=None, batch_size=mongoload.BATCH_SIZE,
+                   retries=mongoload.RETRIES, delay=mongoload.RETRY_DELAY, transient=None):
+    '''
+    Apply the osmChange file to the collection, in the order of the file
+    collection defaults to osm.alaska on the local server
+    Returns the counts of the changes and the upserted and deleted counts
+    of the bulk writes
+    '''
+    if ReplaceOne is None:
+        raise ImportError("pymongo is needed to apply changes to MongoDB, pip install pymongo")
+    if collection is None:
+        collection = mongoload.connect(pool_size=1)
+    collection.create_index([("type", 1), ("id", 1)])
+    summary = {"create": 0, "modify": 0, "delete": 0, "upserted": 0, "deleted": 0}
+    for batch in mongoload.iter_batches(iter_mongo_ops(osc_file, summary), batch_size):
+        result = write_batch(collection, batch, retries, delay, transient)
+        summary["upserted"] += result.upserted_count
+        summary["deleted"] += result.deleted_count
+    return summary
+
+
+def test():
+    print apply_to_json('Alaska_Small.osc', 'Alaska_Small.xml.2.json')
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shape the OSM file on every core
+
+data.process_map runs shape_element on a single core. process_map_parallel
+splits the input file into byte ranges that start on a top level <node,
+<way or <relation tag, parses and shapes each range in a process pool and
+writes each range to its own part file. The part files are then joined in
+order, so the output is the same as the serial run, line for line.
+
+With compression each part is compressed on its own and the output is a
+file of several gzip members or zstd frames, which gzip, zstd and Python's
+gzip module read as one stream. bzip2 reads multi stream files as well, but
+the Python 2 bz2 module stops after the first one.
+
+A "<" can not appear inside an attribute value in XML (it has to be
+written as &lt;), so any "<node", "<way" or "<relation" we find in the raw
+bytes is the start of a top level element.
+
+profile=True collects the stage timings of every chunk and prints them
+added up at the end, cprofile_dir writes a cProfile file per chunk.
+"""
+import cProfile
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements, osm_format
+import data
+from sinks import JsonSink, output_name
+from stageprof import StageProfile, instrument
+from nodeindex import NodeIndex, node_index_for, add_geometry
+from memberindex import MemberIndexWriter, merge_member_parts
+
+# Start of a top level element in the raw file
+top_level_re = re.compile(r'<(?:node|way|relation)\b')
+
+# End of the document
+OSM_END = "</osm>"
+
+# Default size of one range, small enough to keep every worker busy
+# until the end, big enough that the per range overhead does not matter
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# How much of the file to read at a time when looking for a boundary
+SCAN_BYTES = 1024 * 1024
+
+
+class RangeReader(object):
+    '''
+    File like object reading bytes start to end of a file, wrapped in
+    <osm> and </osm> so the range parses as a document of its own
+    '''
+    def __init__(self, filename, start, end):
+        self.f = open(filename, "rb")
+        self.f.seek(start)
+        self.remaining = end - start
+        self.head = "<osm>"
+        self.tail = "</osm>"
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining + len(self.head) + len(self.tail)
+        out = ""
+        if self.head:
+            out, self.head = self.head[:size], self.head[size:]
+            size -= len(out)
+        if size > 0 and self.remaining > 0:
+            chunk = self.f.read(min(size, self.remaining))
+            self.remaining -= len(chunk)
+            if not chunk:
+                self.remaining = 0
+            out += chunk
+            size -= len(chunk)
+        if size > 0 and self.remaining <= 0 and self.tail:
+            piece, self.tail = self.tail[:size], self.tail[size:]
+            out += piece
+        return out
+
+    def close(self):
+        self.f.close()
+
+
+def find_top_level(f, offset, limit):
+    '''
+    Return the offset of the first top level element at or after offset,
+    or limit if there is none before it
+    '''
+    # Keep a few bytes of the previous block so a tag split across
+    # two reads is still found
+    overlap = len("<relation ")
+    pos = offset
+    f.seek(pos)
+    while pos < limit:
+        block = f.read(min(SCAN_BYTES, limit - pos + overlap))
+        if not block:
+            break
+        m = top_level_re.search(block)
+        if m:
+            return min(pos + m.start(), limit)
+        if len(block) <= overlap:
+            break
+        pos += len(block) - overlap
+        f.seek(pos)
+    return limit
+
+
+def find_document_end(f, size):
+    '''Return the offset of the closing </osm> tag'''
+    tail = min(size, SCAN_BYTES)
+    f.seek(size - tail)
+    block = f.read(tail)
+    index = block.rfind(OSM_END)
+    if index < 0:
+        raise ValueError("{0} does not end with {1}".format(f.name, OSM_END))
+    return size - tail + index
+
+
+def split_ranges(file_in, chunk_bytes=CHUNK_BYTES, start=0):
+    '''
+    Split the file into a list of (start, end) byte ranges, each range
+    starts on a top level element and the last one stops at </osm>
+    start is where to begin looking for the first top level element
+    '''
+    size = os.path.getsize(file_in)
+    with open(file_in, "rb") as f:
+        end = find_document_end(f, size)
+        first = find_top_level(f, start, end)
+        bounds = [first]
+        pos = first + chunk_bytes
+        while pos < end:
+            boundary = find_top_level(f, pos, end)
+            if boundary > bounds[-1]:
+                bounds.append(boundary)
+            pos = max(boundary, pos) + chunk_bytes
+    if bounds[-1] != end:
+        bounds.append(end)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def shape_range(job):
+    '''
+    Worker: shape the elements of one byte range into its own part file
+    Returns the part file name, the summary counts of the part and the
+    StageProfile of the part when profiling
+    '''
+    (file_in, start, end, part_out, pretty, compression, profile, cprofile_out,
+     index_file, members_out) = job
+    reader = RangeReader(file_in, start, end)
+    nodes = NodeIndex(index_file) if index_file else None
+    members = MemberIndexWriter(members_out, sort=False) if members_out else None
+    stages = StageProfile() if profile else None
+    profiler = cProfile.Profile() if cprofile_out else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with JsonSink(part_out, pretty, compression) as fo, instrument(data, stages):
+            summary = data.new_summary(fo.file_out)
+            elements = iter_elements(reader)
+            if stages is not None:
+                fo.encode = stages.wrap("json", fo.encode)
+                elements = stages.timed_iter("parse", elements)
+            for _, element in elements:
+                el = data.shape_element(element)
+                if el:
+                    if nodes is not None:
+                        add_geometry(el, nodes)
+                    if members is not None:
+                        members.add(el)
+                    data.add_to_summary(summary, el)
+                    fo.write(el)
+        if members is not None:
+            members.close()
+    finally:
+        reader.close()
+        if nodes is not None:
+            nodes.close()
+        if members is not None:
+            members.abort()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_out)
+    if stages is not None:
+        stages.finish()
+    return fo.file_out, summary, stages
+
+
+def process_map_parallel(file_in, pretty=False, processes=None, chunk_bytes=CHUNK_BYTES,
+                         compression=None, profile=False, cprofile_dir=None, geometry=False,
+                         member_index=False):
+    '''
+    Same output file as data.process_map, shaped on a pool of processes
+    processes defaults to the number of cores
+    cprofile_dir, when given, gets a chunkNNNNN.prof cProfile file per chunk
+    geometry=True builds the node index first and adds node_pos to the ways,
+    every worker maps the same index file, see nodeindex.py
+    member_index=True writes file_in.members like data.process_map, every
+    worker collects the members of its relations and they are sorted once
+    at the end, see memberindex.py
+    Returns the summary counts like data.process_map with keep_data=False,
+    the shaped elements are not kept
+    '''
+    if osm_format(file_in) != "xml":
+        raise ValueError("{0} is not an XML file, byte ranges need the plain XML file, "
+                         "use data.process_map which decompresses and decodes "
+                         "in parallel".format(file_in))
+    file_out = "{0}.2.json".format(file_in)
+    ranges = split_ranges(file_in, chunk_bytes)
+    index_file = node_index_for(file_in) if geometry else None
+    jobs = [(file_in, start, end, "{0}.part{1:05d}".format(file_out, i), pretty, compression,
+             profile, os.path.join(cprofile_dir, "chunk{0:05d}.prof".format(i)) if cprofile_dir else None,
+             index_file, "{0}.members.part{1:05d}".format(file_in, i) if member_index else None)
+            for i, (start, end) in enumerate(ranges)]
+    file_out = output_name(file_out, compression)
+
+    summary = data.new_summary(file_out)
+    stages = StageProfile() if profile else None
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(file_out, "wb") as fo:
+            # imap hands the parts back in order, append each one as soon
+            # as it is ready and drop it
+            for part_out, part_summary, part_stages in pool.imap(shape_range, jobs):
+                with open(part_out, "rb") as part:
+                    shutil.copyfileobj(part, fo)
+                os.remove(part_out)
+                data.merge_summary(summary, part_summary)
+                if stages is not None:
+                    stages.merge(part_stages)
+        pool.close()
+        if member_index:
+            merge_member_parts([job[9] for job in jobs], "{0}.members".format(file_in))
+    except:
+        pool.terminate()
+        for job in jobs:
+            for part_out in (output_name(job[3], compression), job[9]):
+                if part_out and os.path.exists(part_out):
+                    os.remove(part_out)
+        raise
+    finally:
+        pool.join()
+    if stages is not None:
+        # The wall time is the time of all the chunks added up
+        stages.report()
+    return summary
+
+
+def test():
+    summary = process_map_parallel('Alaska_Small.xml', False)
+    print summary
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
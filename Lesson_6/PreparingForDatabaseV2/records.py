@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact records for the shaped nodes, ways and relations
+
+A shaped element is a dictionary holding a 'created' dictionary, a 'pos'
+list, the id and the node refs as strings and a fresh copy of every tag
+key and value. Kept by the million in process_map that is several hundred
+bytes per node.
+
+NodeRecord, WayRecord and RelationRecord hold the same data in __slots__:
+
+    - id, version, changeset and uid as integers
+    - lat and lon as floats
+    - node_refs as an array of machine integers, node_pos as an array
+      of doubles
+    - the members of a relation as one flat tuple
+    - the other keys and values, the address and the user names interned,
+      "highway", "residential" or "user1" is stored once per run however
+      many elements use it
+
+to_dict gives back the shaped dictionary, so the records only turn into
+dictionaries again when they are written out.
+
+    strings = {}
+    record = to_record(shape_element(element), strings)
+    record.to_dict() == shape_element(element)
+"""
+from array import array
+
+# Typecode for the node refs, 'l' is 64 bits on linux and mac. Where it
+# is not (windows) store them as doubles, exact up to 2**53
+REF_TYPECODE = "l" if array("l").itemsize >= 8 else "d"
+
+CREATED = ("version", "changeset", "timestamp", "user", "uid")
+
+NO_FIELDS = ()
+
+
+def as_int(value):
+    '''value as an int if it turns back into the same string, value otherwise'''
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return value
+    if str(number) == value:
+        return number
+    return value
+
+
+def as_text(value):
+    '''Undo as_int'''
+    if isinstance(value, (int, long)):
+        return str(value)
+    return value
+
+
+def intern_value(strings, value):
+    '''The copy of value already in strings, value itself the first time'''
+    if isinstance(value, basestring):
+        return strings.setdefault(value, value)
+    return value
+
+
+def flatten(pairs, strings):
+    '''(k1, v1, k2, v2, ...) of the interned keys and values'''
+    flat = []
+    for k, v in pairs:
+        flat.append(intern_value(strings, k))
+        flat.append(intern_value(strings, v))
+    return tuple(flat) if flat else NO_FIELDS
+
+
+def pack_refs(refs):
+    '''node refs as an array, None when a ref is not a plain number'''
+    numbers = [as_int(r) for r in refs]
+    for n in numbers:
+        if not isinstance(n, (int, long)):
+            return None
+    try:
+        return array(REF_TYPECODE, numbers)
+    except OverflowError:
+        return None
+
+
+class ShapedRecord(object):
+    '''What the shaped elements have in common, see the classes below'''
+    __slots__ = ("id", "version", "changeset", "timestamp", "user", "uid",
+                 "fields", "address")
+    kind = None
+
+    def __init__(self, shaped, strings):
+        # Keys the record does not know what to do with stay as they are,
+        # they come back unchanged in to_dict
+        rest = dict(shaped)
+
+        self.id = as_int(rest.pop("id", None))
+
+        created = rest.get("created")
+        self.version = self.changeset = self.timestamp = self.user = self.uid = None
+        if isinstance(created, dict) and set(created) <= set(CREATED):
+            del rest["created"]
+            self.version = as_int(created.get("version"))
+            self.changeset = as_int(created.get("changeset"))
+            self.timestamp = created.get("timestamp")
+            self.user = intern_value(strings, created.get("user"))
+            self.uid = as_int(created.get("uid"))
+
+        if rest.get("type") == self.kind:
+            del rest["type"]
+
+        self.address = None
+        if isinstance(rest.get("address"), dict):
+            self.address = flatten(rest.pop("address").iteritems(), strings)
+
+        self.shape(rest, strings)
+        self.fields = flatten(rest.iteritems(), strings)
+
+    def shape(self, rest, strings):
+        '''Take the kind specific keys out of rest'''
+        pass
+
+    def position(self):
+        return [0, 0]
+
+    def created(self):
+        created = {}
+        for k in CREATED:
+            v = getattr(self, k)
+            if v is not None:
+                created[k] = as_text(v)
+        return created
+
+    def to_dict(self):
+        '''The shaped dictionary, as shape_element returned it'''
+        node = {"created": self.created(), "pos": self.position(), "type": self.kind}
+        if self.id is not None:
+            node["id"] = as_text(self.id)
+        fields = self.fields
+        for i in xrange(0, len(fields), 2):
+            node[fields[i]] = fields[i + 1]
+        if self.address is not None:
+            address = self.address
+            node["address"] = dict((address[i], address[i + 1])
+                                   for i in xrange(0, len(address), 2))
+        return node
+
+    def __repr__(self):
+        return "<{0} {1}>".format(self.__class__.__name__, self.id)
+
+
+class NodeRecord(ShapedRecord):
+    __slots__ = ("lat", "lon")
+    kind = "node"
+
+    def shape(self, rest, strings):
+        self.lat = self.lon = None
+        pos = rest.get("pos")
+        if isinstance(pos, list) and len(pos) == 2 and \
+           isinstance(pos[0], float) and isinstance(pos[1], float):
+            del rest["pos"]
+            self.lat, self.lon = pos
+
+    def position(self):
+        # pos was not a pair of floats, it is in the fields
+        if self.lat is None:
+            return [0, 0]
+        return [self.lat, self.lon]
+
+
+def take_empty_pos(rest):
+    '''
+    Ways and relations have no position, shape_element leaves pos at [0, 0],
+    drop it from rest when that is what it is
+    '''
+    pos = rest.get("pos")
+    if pos == [0, 0] and not isinstance(pos[0], float) and not isinstance(pos[1], float):
+        del rest["pos"]
+
+
+def pack_positions(positions):
+    '''node_pos as a flat array of doubles, None unless every one is a float pair'''
+    flat = []
+    for pos in positions:
+        if not (isinstance(pos, list) and len(pos) == 2 and
+                isinstance(pos[0], float) and isinstance(pos[1], float)):
+            return None
+        flat.extend(pos)
+    return array("d", flat)
+
+
+class WayRecord(ShapedRecord):
+    __slots__ = ("node_refs", "node_pos")
+    kind = "way"
+
+    def shape(self, rest, strings):
+        take_empty_pos(rest)
+        self.node_refs = self.node_pos = None
+        if isinstance(rest.get("node_refs"), list):
+            refs = pack_refs(rest["node_refs"])
+            if refs is not None:
+                del rest["node_refs"]
+                self.node_refs = refs
+        # The geometry added by nodeindex.add_geometry
+        if isinstance(rest.get("node_pos"), list):
+            positions = pack_positions(rest["node_pos"])
+            if positions is not None:
+                del rest["node_pos"]
+                self.node_pos = positions
+
+    def to_dict(self):
+        node = ShapedRecord.to_dict(self)
+        if self.node_refs is not None:
+            node["node_refs"] = ["%d" % ref for ref in self.node_refs]
+        if self.node_pos is not None:
+            flat = self.node_pos
+            node["node_pos"] = [[flat[i], flat[i + 1]] for i in xrange(0, len(flat), 2)]
+        return node
+
+
+MEMBER_KEYS = set(["type", "ref", "role"])
+
+
+class RelationRecord(ShapedRecord):
+    __slots__ = ("members",)
+    kind = "relation"
+
+    def shape(self, rest, strings):
+        take_empty_pos(rest)
+        self.members = None
+        members = rest.get("members")
+        if isinstance(members, list) and \
+           all(isinstance(m, dict) and set(m) == MEMBER_KEYS for m in members):
+            del rest["members"]
+            flat = []
+            for m in members:
+                flat.append(intern_value(strings, m["type"]))
+                flat.append(as_int(m["ref"]))
+                flat.append(intern_value(strings, m["role"]))
+            self.members = tuple(flat)
+
+    def to_dict(self):
+        node = ShapedRecord.to_dict(self)
+        if self.members is not None:
+            flat = self.members
+            node["members"] = [{"type": flat[i], "ref": as_text(flat[i + 1]), "role": flat[i + 2]}
+                               for i in xrange(0, len(flat), 3)]
+        return node
+
+
+RECORDS = {"node": NodeRecord, "way": WayRecord, "relation": RelationRecord}
+
+
+def shaped_kind(shaped):
+    '''"node", "way" or "relation", the element a shaped dictionary came from'''
+    kind = shaped.get("type")
+    if kind in RECORDS:
+        return kind
+    # A "type" tag replaced the element type, a way is the one with refs
+    if "node_refs" in shaped:
+        return "way"
+    if "members" in shaped:
+        return "relation"
+    return "node"
+
+
+def to_record(shaped, strings=None):
+    '''
+    Compact record of a shaped node, way or relation dictionary, strings is the
+    intern table shared by the records of a run
+    '''
+    if strings is None:
+        strings = {}
+    return RECORDS[shaped_kind(shaped)](shaped, strings)
+
+
+def expand(records):
+    '''Yield the shaped dictionaries of the records'''
+    for record in records:
+        yield record.to_dict()
+
+
+def test():
+    strings = {}
+    node = {"created": {"version": "2", "changeset": "17206049", "timestamp": "2013-08-03T16:43:42Z",
+                        "user": "linuxUser16", "uid": "1219059"},
+            "pos": [41.9757030, -87.6921867], "type": "node", "id": "2406124091",
+            "visible": "true", "amenity": "cafe",
+            "address": {"street": "North Lincoln Avenue", "housenumber": "5157"}}
+    way = {"created": {"version": "1", "user": "linuxUser16"}, "pos": [0, 0], "type": "way",
+           "id": "209809850", "highway": "residential", "node_refs": ["2199822281", "2199822390"]}
+    for shaped in (node, way):
+        record = to_record(shaped, strings)
+        print record, record.to_dict() == shaped
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
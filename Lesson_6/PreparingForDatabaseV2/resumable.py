@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shape a large OSM file in pieces that survive a crash
+
+process_map starts again from the first byte when the process dies, which
+on a state extract and a spot instance can be hours of work lost.
+process_map(resume=...) writes the same output piece by piece and after
+each piece saves a checkpoint next to the output file:
+
+    Alaska.xml.2.json.checkpoint
+    {"input_offset": 536870912, "events": null, "last_type": "way",
+     "last_id": "209809850", "parts": {"output": 221044736, ...}}
+
+With resume=True a run picks up at the last checkpoint: the output file,
+the member index and the column store are cut back to what they held at
+the checkpoint, dropping whatever the dead run wrote after it, and the
+input is read on from there. resume=False starts over and removes the
+checkpoint of an earlier run first.
+
+    - plain XML input is split into byte ranges that start on a top level
+      element, see parallel.split_ranges, and a resumed run seeks straight
+      to input_offset
+    - bz2, gzip and PBF input can not be seeked into, the checkpoint keeps
+      the number of parse events instead and a resumed run parses up to
+      there again without shaping or writing anything
+
+A clip remembers the nodes and ways it kept, a resumed run with a clip
+reads the input up to the checkpoint again through the clip only.
+
+At each checkpoint the output ends a gzip member or zstd frame, a
+compressed output file is a series of them like the parallel run writes.
+bz2 output can not be appended to with Python 2.
+"""
+import itertools
+import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements, osm_format
+from nodeindex import replace
+# parallel imports data, which imports this module, bind the module only
+import parallel
+
+# Checkpoint after this many bytes of plain XML input
+CHECKPOINT_BYTES = 32 * 1024 * 1024
+
+# Checkpoint after this many top level elements of compressed or PBF input
+CHECKPOINT_ELEMENTS = 500000
+
+TOP_LEVEL = ("node", "way", "relation")
+
+
+def save_checkpoint(checkpoint, state):
+    '''Write the checkpoint file so that it is either the old or the new one'''
+    tmp = checkpoint + ".tmp"
+    with open(tmp, "wb") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    replace(tmp, checkpoint)
+
+
+def load_checkpoint(checkpoint, settings):
+    '''
+    The saved state, None when there is no checkpoint. ValueError when it
+    was written by a run on another file or with other options.
+    '''
+    if not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, "rb") as f:
+        state = json.load(f)
+    for k, v in settings.iteritems():
+        if state.get(k) != v:
+            raise ValueError("{0} is for a run with {1}={2!r}, not {3!r}, remove it "
+                             "to start over".format(checkpoint, k, state.get(k), v))
+    return state
+
+
+class Checkpoint(object):
+    '''
+    The checkpoint of a process_map run writing file_out, see the module
+    docstring. settings are the options a resumed run has to agree on.
+    Each output of the run is a part, add_part gives the function that
+    makes it durable and returns its position, position(name) is where
+    a resumed part starts from.
+    '''
+    def __init__(self, file_in, file_out, settings, resume=False,
+                 checkpoint_bytes=CHECKPOINT_BYTES, checkpoint_elements=CHECKPOINT_ELEMENTS):
+        self.file_in = file_in
+        self.filename = file_out + ".checkpoint"
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checkpoint_elements = checkpoint_elements
+        settings = dict(settings, file_in=os.path.abspath(file_in),
+                        input_bytes=os.path.getsize(file_in))
+        state = load_checkpoint(self.filename, settings) if resume else None
+        self.resumed = state is not None
+        if state is None:
+            # A checkpoint left by an earlier run must not be picked up
+            # if this one dies before its first commit
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            state = dict(settings, input_offset=None, events=None, last_type=None,
+                         last_id=None, parts={})
+        self.state = state
+        # part name => function making it durable, returns its position
+        self.parts = {}
+
+    def position(self, name):
+        '''Position of part name at the checkpoint, None when starting over'''
+        if not self.resumed:
+            return None
+        if name not in self.state["parts"]:
+            raise ValueError("{0} has no position for {1}".format(self.filename, name))
+        return self.state["parts"][name]
+
+    def add_part(self, name, checkpoint):
+        self.parts[name] = checkpoint
+
+    def commit(self, **position):
+        '''End a piece, position is where the input is at'''
+        for name, checkpoint in self.parts.iteritems():
+            self.state["parts"][name] = checkpoint()
+        self.state.update(position)
+        save_checkpoint(self.filename, self.state)
+
+    def done(self):
+        '''The run is complete, remove the checkpoint'''
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def elements(self, max_rss_mb=None, replay=None):
+        '''
+        (event, element) of the input from the checkpoint on, commit() is
+        called at the end of every piece. replay is called on each element
+        before the checkpoint, for a clip to see them again.
+        '''
+        if osm_format(self.file_in) == "xml":
+            return self.xml_pieces(max_rss_mb, replay)
+        return self.event_pieces(max_rss_mb, replay)
+
+    def seen(self, element):
+        if element.tag in TOP_LEVEL:
+            self.state["last_type"] = element.tag
+            self.state["last_id"] = element.attrib.get("id")
+
+    def xml_pieces(self, max_rss_mb, replay):
+        '''Plain XML, one piece per byte range'''
+        file_in = self.file_in
+        start = self.state["input_offset"] or 0
+        if start and replay is not None:
+            with open(file_in, "rb") as f:
+                first = parallel.find_top_level(f, 0, start)
+            reader = parallel.RangeReader(file_in, first, start)
+            try:
+                for _, element in iter_elements(reader, max_rss_mb=max_rss_mb):
+                    replay(element)
+            finally:
+                reader.close()
+        for start, end in parallel.split_ranges(file_in, self.checkpoint_bytes, start):
+            reader = parallel.RangeReader(file_in, start, end)
+            try:
+                for event, element in iter_elements(reader, max_rss_mb=max_rss_mb):
+                    self.seen(element)
+                    yield event, element
+            finally:
+                reader.close()
+            self.commit(input_offset=end)
+
+    def event_pieces(self, max_rss_mb, replay):
+        '''Compressed or PBF input, one piece per checkpoint_elements elements'''
+        state = self.state
+        events = iter_elements(self.file_in, max_rss_mb=max_rss_mb)
+        count = state["events"] or 0
+        if count:
+            # Parse what the last run had done again, keep only its last element
+            last = None
+            for _, element in itertools.islice(events, count):
+                if element.tag in TOP_LEVEL:
+                    last = (element.tag, element.attrib.get("id"))
+                if replay is not None:
+                    replay(element)
+            if last != (state["last_type"], state["last_id"]):
+                raise ValueError("{0} does not match the checkpoint, element {1} where the "
+                                 "last run stopped at {2} {3}".format(
+                                     self.file_in, last, state["last_type"], state["last_id"]))
+        since = 0
+        for event, element in events:
+            count += 1
+            self.seen(element)
+            yield event, element
+            if element.tag in TOP_LEVEL:
+                since += 1
+                if since >= self.checkpoint_elements:
+                    self.commit(events=count)
+                    since = 0
+        self.commit(events=count)
+
+
+def test():
+    import data
+    summary = data.process_map('Alaska_Small.xml', keep_data=False, resume=True)
+    print summary
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
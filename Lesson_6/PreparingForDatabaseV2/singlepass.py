@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Audit and shape the OSM file in a single pass
+
+Auditing an extract used to take five full parses of the XML file, one each
+for count_tags, tags.process_map, users.process_map, audit.audit and
+data.process_map. Parsing is most of the run time on the large extracts,
+so run_analyzers parses the file once and hands every element to a set of
+analyzers, each one doing the work of one of the exercises.
+
+An analyzer is any object with the methods below, see Analyzer:
+    begin()      called once before the parse
+    start(elem)  called for every "start" event, if "start" in events
+    end(elem)    called for every "end" event, if "end" in events
+    finish()     called once after the parse, returns the result
+    close()      always called last, even when the parse fails
+
+DistinctCounter counts the distinct uids, tag keys, values of each key and
+street names, exactly or with HyperLogLog sketches of a fixed size, see
+IterativeParsing/distinct.py. count_distinct runs it on byte ranges of the
+file in a process pool and merges the counts of the ranges.
+"""
+import multiprocessing
+import pprint
+import os
+import sys
+# The exercises live in their own lesson folders
+LESSON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for lesson in ("IterativeParsing", "TagTypes", "ExploringUsers", "ImprovingStreetNames"):
+    sys.path.append(os.path.join(LESSON_DIR, lesson))
+from osmstream import iter_elements, osm_format
+import tags
+import users
+import audit
+import data
+from sinks import JsonSink
+from distinct import distinct_counter, KeyedCounts
+from parallel import CHUNK_BYTES, RangeReader, split_ranges
+
+
+class Analyzer(object):
+    '''
+    Base analyzer, does nothing
+    name is the key of the result in the dictionary returned by run_analyzers
+    events are the iterparse events the analyzer wants to see
+    '''
+    name = None
+    events = ("end",)
+
+    def begin(self):
+        pass
+
+    def start(self, elem):
+        pass
+
+    def end(self, elem):
+        pass
+
+    def finish(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class TagCounter(Analyzer):
+    '''Count every xml tag in the file, same as mapparser.count_tags'''
+    name = "tags"
+    events = ("start",)
+
+    def begin(self):
+        self.counts = {}
+
+    def start(self, elem):
+        key = elem.tag
+        if key in self.counts:
+            self.counts[key] += 1
+        else:
+            self.counts[key] = 1
+
+    def finish(self):
+        return self.counts
+
+
+class KeyClassifier(Analyzer):
+    '''Classify the "k" value of each <tag>, same as tags.process_map'''
+    name = "keys"
+
+    def begin(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def end(self, elem):
+        if elem.tag == "tag":
+            tags.key_type(elem, self.keys)
+
+    def finish(self):
+        return self.keys
+
+
+class UserCollector(Analyzer):
+    '''Collect the unique user ids ("uid"), same as users.process_map'''
+    name = "users"
+
+    def begin(self):
+        self.users = set()
+
+    def end(self, elem):
+        if "uid" in elem.attrib:
+            self.users.add(users.get_user(elem))
+
+    def finish(self):
+        return self.users
+
+
+class StreetAuditor(Analyzer):
+    '''Collect the unexpected street types, same as audit.audit'''
+    name = "streets"
+
+    def begin(self):
+        self.street_types = audit.defaultdict(set)
+
+    def end(self, elem):
+        if elem.tag == "node" or elem.tag == "way":
+            for tag in elem.iter("tag"):
+                if audit.is_street_name(tag):
+                    audit.audit_street_type(self.street_types, tag.attrib['v'])
+
+    def finish(self):
+        return self.street_types
+
+
+class DistinctCounter(Analyzer):
+    '''
+    Number of distinct uids, tag keys, values per key and street names
+    error=None counts exactly with sets, an error rate like 0.01 estimates
+    with HyperLogLog sketches in a fixed amount of memory
+    The result is the analyzer itself, merge() adds the counts of another
+    part of the file and summary() has the numbers
+    '''
+    name = "distinct"
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def begin(self):
+        self.uids = distinct_counter(self.error)
+        self.keys = distinct_counter(self.error)
+        self.values = KeyedCounts(self.error)
+        self.streets = distinct_counter(self.error)
+
+    def end(self, elem):
+        if elem.tag == "tag":
+            k = elem.attrib.get("k")
+            if k is not None:
+                self.keys.add(k)
+                self.values.add(k, elem.attrib.get("v"))
+            return
+        if elem.tag == "node" or elem.tag == "way" or elem.tag == "relation":
+            uid = elem.attrib.get("uid")
+            if uid is not None:
+                self.uids.add(uid)
+            for tag in elem.iter("tag"):
+                if audit.is_street_name(tag):
+                    self.streets.add(tag.attrib["v"])
+
+    def finish(self):
+        return self
+
+    def merge(self, other):
+        self.uids.merge(other.uids)
+        self.keys.merge(other.keys)
+        self.values.merge(other.values)
+        self.streets.merge(other.streets)
+        return self
+
+    def summary(self):
+        return {"uids": self.uids.count(),
+                "keys": self.keys.count(),
+                "values": self.values.counts(),
+                "streets": self.streets.count(),
+                "error": self.error}
+
+
+class ShapeWriter(Analyzer):
+    '''
+    Shape each node/way with data.shape_element and write it to file_out
+    The shaped elements are not kept, the result is the summary counts
+    data.process_map returns with keep_data=False
+    '''
+    name = "shaped"
+
+    def __init__(self, file_out, pretty=False, compression=None):
+        self.file_out = file_out
+        self.pretty = pretty
+        self.compression = compression
+        self.fo = None
+
+    def begin(self):
+        self.fo = JsonSink(self.file_out, self.pretty, self.compression)
+        self.summary = data.new_summary(self.fo.file_out)
+
+    def end(self, elem):
+        el = data.shape_element(elem)
+        if el:
+            data.add_to_summary(self.summary, el)
+            self.fo.write(el)
+
+    def finish(self):
+        return self.summary
+
+    def close(self):
+        if self.fo is not None:
+            self.fo.close()
+            self.fo = None
+
+
+def default_analyzers(file_in, pretty=False, compression=None):
+    '''
+    All five exercises, the shaped data is written next to the input
+    file with the same name as data.process_map uses
+    '''
+    return [TagCounter(), KeyClassifier(), UserCollector(), StreetAuditor(),
+            ShapeWriter("{0}.2.json".format(file_in), pretty, compression)]
+
+
+def run_analyzers(file_in, analyzers=None, pretty=False, max_rss_mb=None, compression=None):
+    '''
+    Parse file_in once and feed every element to each analyzer
+    Returns a dictionary of analyzer name => analyzer result
+    '''
+    if analyzers is None:
+        analyzers = default_analyzers(file_in, pretty, compression)
+
+    # Build the dispatch lists once, instead of asking every analyzer
+    # about every event
+    starts = [a.start for a in analyzers if "start" in a.events]
+    ends = [a.end for a in analyzers if "end" in a.events]
+    events = []
+    if starts:
+        events.append("start")
+    if ends:
+        events.append("end")
+
+    try:
+        for a in analyzers:
+            a.begin()
+
+        for event, elem in iter_elements(file_in, events=events, max_rss_mb=max_rss_mb):
+            if event == "start":
+                for handler in starts:
+                    handler(elem)
+            else:
+                for handler in ends:
+                    handler(elem)
+
+        results = {}
+        for a in analyzers:
+            results[a.name] = a.finish()
+        return results
+    finally:
+        for a in analyzers:
+            a.close()
+
+
+def count_range(job):
+    '''Worker: DistinctCounter over one byte range of the file'''
+    file_in, start, end, error = job
+    reader = RangeReader(file_in, start, end)
+    try:
+        return run_analyzers(reader, [DistinctCounter(error)])["distinct"]
+    finally:
+        reader.close()
+
+
+def count_distinct(file_in, error=None, processes=None, chunk_bytes=CHUNK_BYTES,
+                   max_rss_mb=None):
+    '''
+    The DistinctCounter summary of file_in, error as in DistinctCounter
+    processes=None parses in this process, any other number splits a plain
+    XML file into byte ranges counted on a pool of that many processes
+    (0 for one per core) and merges their counts
+    '''
+    if processes is None:
+        return run_analyzers(file_in, [DistinctCounter(error)],
+                             max_rss_mb=max_rss_mb)["distinct"].summary()
+    if osm_format(file_in) != "xml":
+        raise ValueError("{0} is not an XML file, count it with processes=None".format(file_in))
+    jobs = [(file_in, start, end, error) for start, end in split_ranges(file_in, chunk_bytes)]
+    pool = multiprocessing.Pool(processes or None)
+    try:
+        counter = DistinctCounter(error)
+        counter.begin()
+        for part in pool.imap_unordered(count_range, jobs):
+            counter.merge(part)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counter.summary()
+
+
+def test():
+    results = run_analyzers('Alaska_Small.xml')
+    pprint.pprint(results["tags"])
+    pprint.pprint(results["keys"])
+    pprint.pprint(len(results["users"]))
+    pprint.pprint(dict(results["streets"]))
+    pprint.pprint(results["shaped"])
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Buffered JSON output for the shaped data
+
+process_map used to call json.dumps and make a small write through
+codecs.open for every element. JsonSink keeps one encoder for the whole
+run, collects the encoded lines and writes them in batches, and can
+compress the output as it goes:
+
+    None     Alaska.xml.2.json
+    "gzip"   Alaska.xml.2.json.gz
+    "bz2"    Alaska.xml.2.json.bz2
+    "zstd"   Alaska.xml.2.json.zst  (needs pip install zstandard)
+
+The lines are the same as json.dumps(el) and json.dumps(el, indent=2)
+write, so the uncompressed output does not change. The datetime of
+created.timestamp is written as {"$date": "2013-08-03T16:43:42Z"}, see
+IterativeParsing/timestamps.py.
+"""
+import bz2
+import gzip
+import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from timestamps import json_default
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File name extension for each compression
+EXTENSIONS = {None: "", "gzip": ".gz", "bz2": ".bz2", "zstd": ".zst"}
+
+# Write the buffered lines once we have this many
+BATCH_RECORDS = 1000
+
+# Buffer size of the output file
+BUFFER_BYTES = 1024 * 1024
+
+# Compression levels, tuned for speed over size
+GZIP_LEVEL = 1
+BZ2_LEVEL = 1
+ZSTD_LEVEL = 3
+
+
+def output_name(file_out, compression=None):
+    '''Return the output file name with the extension of the compression'''
+    if compression not in EXTENSIONS:
+        raise ValueError("Unknown compression {0!r}, use one of {1}".format(
+            compression, sorted(k for k in EXTENSIONS if k)))
+    return file_out + EXTENSIONS[compression]
+
+
+class JsonSink(object):
+    '''
+    Write shaped elements as lines of JSON
+    Use it as a context manager or call close() when done
+    With append=True the lines go at the end of an existing file, as a new
+    gzip member or zstd frame when compressed. The Python 2 bz2 module can
+    not append.
+    '''
+    def __init__(self, file_out, pretty=False, compression=None,
+                 batch_records=BATCH_RECORDS, append=False):
+        self.file_out = output_name(file_out, compression)
+        self.compression = compression
+        self.mode = "ab" if append else "wb"
+        if append and compression == "bz2":
+            raise ValueError("bz2 output can not be appended to, use gzip or zstd")
+        self.batch_records = batch_records
+        self.lines = []
+        self.count = 0
+        self.raw = None
+        # One encoder for the run, json.dumps builds a new one every call
+        # as soon as it is given indent
+        if pretty:
+            self.encode = json.JSONEncoder(indent=2, default=json_default).encode
+        else:
+            self.encode = json.JSONEncoder(default=json_default).encode
+        self.fo = self.open()
+
+    def open(self):
+        if self.compression == "gzip":
+            return gzip.GzipFile(self.file_out, self.mode, GZIP_LEVEL)
+        if self.compression == "bz2":
+            return bz2.BZ2File(self.file_out, "wb", BUFFER_BYTES, BZ2_LEVEL)
+        if self.compression == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd output needs the zstandard module, pip install zstandard")
+            self.raw = open(self.file_out, self.mode, BUFFER_BYTES)
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(self.raw)
+        return open(self.file_out, self.mode, BUFFER_BYTES)
+
+    def write(self, el):
+        '''Encode one element, the line is written with the next batch'''
+        self.lines.append(self.encode(el))
+        self.count += 1
+        if len(self.lines) >= self.batch_records:
+            self.flush()
+
+    def flush(self):
+        '''Write the buffered lines'''
+        if self.lines:
+            self.lines.append("")
+            self.fo.write("\n".join(self.lines))
+            self.lines = []
+
+    def checkpoint(self):
+        '''
+        Write out the lines so far and make sure they are on disk, returns
+        the size of the file. A compressed file ends its gzip member or
+        zstd frame there, the next lines go in a new one.
+        '''
+        if self.compression == "bz2":
+            raise ValueError("bz2 output can not be checkpointed, use gzip or zstd")
+        self.flush()
+        if self.compression == "gzip":
+            self.fo.close()
+            self.fo = None
+        elif self.raw is not None:
+            self.fo.flush(zstandard.FLUSH_FRAME)
+            self.raw.flush()
+        else:
+            self.fo.flush()
+        with open(self.file_out, "ab") as f:
+            os.fsync(f.fileno())
+        size = os.path.getsize(self.file_out)
+        if self.fo is None:
+            self.mode = "ab"
+            self.fo = self.open()
+        return size
+
+    def close(self):
+        if self.fo is None:
+            return
+        try:
+            self.flush()
+            if self.raw is not None:
+                # End the zstd frame, then close the file under it
+                self.fo.flush(zstandard.FLUSH_FRAME)
+                self.raw.close()
+            else:
+                self.fo.close()
+        finally:
+            self.fo = None
+            self.raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Where does the time go in process_map
+
+StageProfile counts the calls and the time spent in each stage of the
+shaping pipeline:
+
+    parse              reading the next element from the XML file
+    shape_element      the whole of shape_element, the stages below included
+    attributes         the attribute loop, shape_attributes
+    is_valid_tag       the problem character check
+    clean_address      the address cleaning rules, see addressrules.py
+    json               encoding the element for the output file
+
+Nothing is timed unless profiling is asked for, instrument swaps the
+functions of the data module for timed versions for the length of the run
+and puts the originals back afterwards, so the normal run pays nothing.
+
+For a deeper look the parallel run can also write one cProfile file per
+chunk, pstats.Stats reads them all back together.
+"""
+from contextlib import contextmanager
+import sys
+import time
+
+# (stage, name of the function in the data module), in the order of the report
+STAGES = [("shape_element", "shape_element"),
+          ("attributes", "shape_attributes"),
+          ("is_valid_tag", "is_valid_tag"),
+          ("clean_address", "clean_address")]
+
+REPORT_ORDER = ["parse"] + [stage for stage, name in STAGES] + ["json"]
+
+# Stages that are part of shape_element
+SHAPE_PARTS = ["attributes", "is_valid_tag", "clean_address"]
+
+
+class StageProfile(object):
+    '''Call counts and cumulative seconds per stage'''
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+        self.started = time.time()
+        self.wall = None
+
+    def add(self, stage, calls, seconds):
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def wrap(self, stage, func):
+        '''Return func timed under stage'''
+        calls = self.calls
+        total = self.seconds
+        calls.setdefault(stage, 0)
+        total.setdefault(stage, 0.0)
+        clock = time.time
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                total[stage] += clock() - start
+                calls[stage] += 1
+        return timed
+
+    def timed_iter(self, stage, iterable):
+        '''Yield from iterable, timing each step under stage'''
+        clock = time.time
+        iterator = iter(iterable)
+        calls = 0
+        seconds = 0.0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += clock() - start
+                    return
+                seconds += clock() - start
+                calls += 1
+                yield item
+        finally:
+            self.add(stage, calls, seconds)
+
+    def finish(self):
+        self.wall = time.time() - self.started
+
+    def merge(self, other):
+        '''
+        Add the counts of another profile, the chunks of a parallel run,
+        the wall time becomes the sum of the wall time of the chunks
+        '''
+        for stage in other.calls:
+            self.add(stage, other.calls[stage], other.seconds[stage])
+        if other.wall is not None:
+            self.wall = (self.wall or 0.0) + other.wall
+
+    def report(self, out=None):
+        '''Print the breakdown table'''
+        if out is None:
+            out = sys.stdout
+        if self.wall is None:
+            self.finish()
+        rows = [s for s in REPORT_ORDER if s in self.calls]
+        rows += sorted(s for s in self.calls if s not in REPORT_ORDER)
+        out.write("{0:<20}{1:>12}{2:>12}{3:>12}{4:>8}\n".format(
+            "stage", "calls", "seconds", "us/call", "%"))
+        for stage in rows:
+            calls = self.calls[stage]
+            seconds = self.seconds[stage]
+            out.write("{0:<20}{1:>12}{2:>12.3f}{3:>12.2f}{4:>8.1f}\n".format(
+                stage, calls, seconds, seconds * 1e6 / calls if calls else 0,
+                100.0 * seconds / self.wall if self.wall else 0))
+        if "shape_element" in self.seconds:
+            rest = self.seconds["shape_element"] - sum(self.seconds.get(s, 0.0) for s in SHAPE_PARTS)
+            out.write("{0:<20}{1:>12}{2:>12.3f}{3:>12}{4:>8.1f}\n".format(
+                "  shape_element rest", "", rest, "",
+                100.0 * rest / self.wall if self.wall else 0))
+        out.write("{0:<20}{1:>12}{2:>12.3f}\n".format("wall", "", self.wall))
+
+
+@contextmanager
+def instrument(module, profile, stages=STAGES):
+    '''
+    Time the functions of module listed in stages for the with block,
+    does nothing when profile is None
+    '''
+    if profile is None:
+        yield None
+        return
+    saved = []
+    for stage, name in stages:
+        func = getattr(module, name)
+        saved.append((name, func))
+        setattr(module, name, profile.wrap(stage, func))
+    try:
+        yield profile
+    finally:
+        for name, func in saved:
+            setattr(module, name, func)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Classify the "k" value of a <tag> once per distinct key
+
+key_type runs up to three regular expressions on every <tag> and
+data.is_valid_tag runs problemchars on the same keys again, tens of
+millions of times on a state extract. Keys are the tag names of the OSM
+wiki and their variants, a state extract uses a few thousand of them, so
+classify_key keeps the verdict of each key it has seen and both use it:
+
+    "lower"         only lower case letters and _, "highway"
+    "lower_colon"   the same with one colon, "addr:street"
+    "problemchars"  a character MongoDB or we can not have in a key
+    "other"         everything else, "FIXME", "name_1"
+
+KeyHistogram counts the tags of each distinct key, which gives the four
+counters of key_type and also which keys are behind each of them:
+
+    hist = KeyHistogram()
+    for k in keys:
+        hist.add(k)
+    hist.counts()       {"lower": 5, "lower_colon": 2, ...}
+    hist.histogram()    {"lower": {"highway": 3, "name": 2}, ...}
+"""
+import re
+
+#Check for all lower case characters in a string
+lower = re.compile(r'^([a-z]|_)*$')
+
+#check for colon values
+lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+
+#check for mongodb specific characters
+problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+CLASSES = ("lower", "lower_colon", "problemchars", "other")
+
+# Stop remembering new keys past this many, a file full of generated keys
+# should not take all the memory
+MAX_KEYS = 200000
+
+# key => class, shared by everything in the process
+verdicts = {}
+
+
+def classify(k):
+    '''The class of key k, the regular expressions in the order of key_type'''
+    if lower.search(k):
+        return "lower"
+    if lower_colon.search(k):
+        return "lower_colon"
+    if problemchars.search(k):
+        return "problemchars"
+    return "other"
+
+
+def classify_key(k):
+    '''classify with the verdict kept for the next time k comes up'''
+    verdict = verdicts.get(k)
+    if verdict is None:
+        verdict = classify(k)
+        if len(verdicts) < MAX_KEYS:
+            verdicts[k] = verdict
+    return verdict
+
+
+def is_valid_key(k):
+    '''False when the key has a problem character, same as problemchars.search'''
+    # lower and lower_colon keys can not hold a problem character, and
+    # "other" is what is left when problemchars did not match
+    return classify_key(k) != "problemchars"
+
+
+class KeyHistogram(object):
+    '''Number of tags of each distinct key, grouped by class'''
+    def __init__(self):
+        self.tags = {}
+
+    def add(self, k):
+        tags = self.tags
+        tags[k] = tags.get(k, 0) + 1
+
+    def histogram(self):
+        '''{class: {key: number of tags}} with every class present'''
+        out = dict((c, {}) for c in CLASSES)
+        for k, n in self.tags.iteritems():
+            out[classify_key(k)][k] = n
+        return out
+
+    def counts(self):
+        '''Number of tags per class, the counters of tags.key_type'''
+        out = dict((c, 0) for c in CLASSES)
+        for k, n in self.tags.iteritems():
+            out[classify_key(k)] += n
+        return out
+
+    def distinct(self):
+        '''Number of distinct keys per class'''
+        out = dict((c, 0) for c in CLASSES)
+        for k in self.tags:
+            out[classify_key(k)] += 1
+        return out
+
+
+def test():
+    hist = KeyHistogram()
+    for k in ["highway", "name", "highway", "addr:street", "addr:street:name", "FIXME", "note 1"]:
+        hist.add(k)
+    print hist.counts()
+    print hist.distinct()
+    print hist.histogram()
+    print "DONE"
+
+if __name__ == "__main__":
+    test()
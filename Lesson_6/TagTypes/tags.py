@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
 import pprint
-import re
+import os
+import sys
+# The shared streaming reader lives with the iterative parsing lesson
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "IterativeParsing"))
+from osmstream import iter_elements
+from distinct import distinct_counter, KeyedCounts
 """
 Your task is to explore the data a bit more.
 
@@ -21,14 +26,9 @@ So, we have to see if we have such tags, and if we have any tags with problemati
 Please complete the function 'key_type'.
 """
 
-#Check for all lower case characters in a string
-lower = re.compile(r'^([a-z]|_)*$')
-
-#check for colon values
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-
-#check for mongodb specific characters
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+# The 3 regular expressions (lower, lower_colon, problemchars) live in
+# keyclass.py, which runs them once per distinct key and remembers the answer
+from keyclass import lower, lower_colon, problemchars, classify_key, KeyHistogram
 
 
 # Scan the element tag and count the occurances of the key type
@@ -38,29 +38,48 @@ def key_type(element, keys):
     #Review only the xml element tag        
     if element.tag == "tag":
         k = element.attrib['k']
-        if lower.search(k):
-            keys['lower'] +=1 
-        #check for lower case words with a colon eg. "source:name"   
-        elif lower_colon.search(k):
-             keys['lower_colon'] += 1    
-        #check for reserved keywords for monogo db        
-        elif problemchars.search(k):
-             keys['problemchars'] += 1  
-             print 'Problem Char: ' + k
-        #count all the others
-        else:
-            keys['other'] += 1 
+        # lower, lower_colon (eg. "source:name"), problemchars (reserved
+        # keywords for mongo db) or other
+        verdict = classify_key(k)
+        keys[verdict] += 1
+        if verdict == 'problemchars':
+            print 'Problem Char: ' + k
             
     return keys
 
 #Read file and interate over the elements
-def process_map(filename):
+#Each node/way/relation is released once its tags have been counted
+def process_map(filename, max_rss_mb=None):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
+    for _, element in iter_elements(filename, max_rss_mb=max_rss_mb):
         keys = key_type(element, keys)
 
     return keys
 
+#Read file and count the tags of each distinct key, the KeyHistogram gives
+#the counts of process_map and the keys behind each of them
+def key_histogram(filename, max_rss_mb=None):
+    hist = KeyHistogram()
+    for _, element in iter_elements(filename, max_rss_mb=max_rss_mb):
+        if element.tag == "tag":
+            hist.add(element.attrib['k'])
+
+    return hist
+
+#Read file and count the distinct keys and the distinct values of each key
+#error=None counts them exactly, an error rate like 0.01 estimates them in
+#a fixed amount of memory, see distinct.py
+def distinct_tags(filename, error=None, max_rss_mb=None):
+    keys = distinct_counter(error)
+    values = KeyedCounts(error)
+    for _, element in iter_elements(filename, max_rss_mb=max_rss_mb):
+        if element.tag == "tag":
+            k = element.attrib['k']
+            keys.add(k)
+            values.add(k, element.attrib.get('v'))
+
+    return keys.count(), values.counts()
+
 
 # Test
 def test():
@@ -68,6 +87,8 @@ def test():
     # Note that the assertions will be incorrect then.
     keys = process_map('Alaska.xml')
     pprint.pprint(keys)
+    pprint.pprint(key_histogram('Alaska.xml').distinct())
+    pprint.pprint(distinct_tags('Alaska.xml', error=0.01)[0])
     #assert keys == {'lower': 5, 'lower_colon': 0, 'other': 1, 'problemchars': 1}
 
 